@@ -38,11 +38,13 @@ deploy config file as used by Pylons. It can be used directly like this:
 import types
 import warnings
 import logging
+import threading
 import os
 import os.path
 
 from paste.util.import_string import eval_import
-from multi import MultiHandler, status_checker
+from multi import MultiHandler, status_checker, collapse_multi_handlers, \
+    compile_status_checkers
 from pkg_resources import iter_entry_points, load_entry_point
 from paste.deploy.converters import asbool
 
@@ -51,7 +53,7 @@ import webob.exc
 
 from authkit.authorize import authorize_request
 from authkit.permissions import RemoteUser, no_authkit_users_in_environ, \
-    AuthKitConfigError
+    AuthKitConfigError, PermissionRegistry, catalog_interval
 
 # Main middleware base classes
 
@@ -72,6 +74,10 @@ class AuthKitUserSetter(object):
     The base class for all middleware responsible for attempting to set
     REMOTE_USER on each request. The class is overridden by the induvidual
     handlers.
+
+    User setters which only change the ``environ`` before calling the next
+    application can do that work in an ``update_environ(environ)`` method so
+    that ``compile_pipeline()`` can call them directly.
     """
     pass
 
@@ -151,28 +157,152 @@ def digest_password(environ, realm, username):
     )
     if not environ.has_key('authkit.users'):
         raise no_authkit_users_in_environ
+    # Imported here because authkit.users imports this module
+    from authkit.users import AuthKitNoSuchUserError, lookup_user
     users = environ['authkit.users']
-    if users.user_exists(username):
-        password = users.user(username)['password']
-        return digest.digest_password(realm, username, password)
-    # After speaking to Clark Evans who wrote the origianl code, this is the 
-    # correct thing:
-    return None
+    try:
+        password = lookup_user(users, username, 'user')['password']
+    except AuthKitNoSuchUserError:
+        # After speaking to Clark Evans who wrote the origianl code, this is 
+        # the correct thing:
+        return None
+    return digest.digest_password(realm, username, password)
+
+class UsersProxy(object):
+    """
+    A lightweight stand-in for a ``Users`` object which binds it to the 
+    ``environ`` of the current request. 
+    
+    The real object is only obtained by calling ``get_users(environ)`` the 
+    first time one of its attributes other than ``environ`` is looked up, so
+    requests which never use ``authkit.users`` don't pay for creating it.
+
+    If ``users_class`` is given the proxy reports it as its ``__class__`` so
+    ``isinstance()`` checks against the ``Users`` class still pass without
+    creating the object.
+    """
+    __slots__ = ('environ', 'get_users', 'users_class', '_users')
+
+    def __init__(self, get_users, environ, users_class=None):
+        self.get_users = get_users
+        self.environ = environ
+        self.users_class = users_class
+        self._users = None
+
+    def __class__(self):
+        if self.users_class is None:
+            return UsersProxy
+        return self.users_class
+    __class__ = property(__class__)
+
+    def users(self):
+        if self._users is None:
+            self._users = self.get_users(self.environ)
+        return self._users
+    users = property(users)
+
+    def __getattr__(self, name):
+        return getattr(self.users, name)
 
 class AddUsersObjectToEnviron(object):
-    """Simple middleware which adds a Users object to the environ."""
+    """
+    Simple middleware which adds a Users object to the environ.
+
+    How often the object is created depends on the ``instance_scope`` 
+    attribute of the ``Users`` class:
+
+    ``request`` (the default)
+        A new object is created for each request with the request's 
+        ``environ``.
+
+    ``thread``
+        One object is created per thread and reused.
+
+    ``process``
+        One object is created and shared by every thread in the process.
+        
+    Drivers should only declare ``thread`` or ``process`` if they don't rely
+    on the ``environ`` they were created with, since shared objects are 
+    created with an ``environ`` of ``None``. In every scope the object is 
+    added as a ``UsersProxy`` so it is only created, or fetched, once 
+    something uses it. The ``environ`` of each request is available as the
+    ``environ`` attribute of the proxy and ``isinstance()`` checks against 
+    the ``Users`` class work on the proxy.
+
+    The ``requests`` and ``used`` attributes count the requests seen and 
+    the requests which used the object. ``stats()`` returns them along 
+    with the number of requests which never used the object. They aren't 
+    locked, to keep them off the request path, so under concurrent requests
+    they are approximate.
+    """
     def __init__(self, app, key, value, *k, **p):
         self.app = app
         self.k = k
         self.p = p
         self.key = key
         self.value = value
-
-    def __call__(self, environ, start_response):
+        self.scope = getattr(value, 'instance_scope', 'request')
+        if self.scope not in ['request', 'thread', 'process']:
+            raise AuthKitConfigError(
+                'Unknown instance_scope %r for the %r user management API '
+                'object'%(self.scope, value)
+            )
+        self.users_class = None
+        if isinstance(value, type):
+            self.users_class = value
+        self.instance = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.requests = 0
+        self.used = 0
+
+    def create(self, environ):
         p = {}
         p.update(self.p)
         p['environ'] = environ
-        environ[self.key] = self.value(*self.k, **p)
+        return self.value(*self.k, **p)
+
+    def get_users(self, environ):
+        if self.scope == 'request':
+            return self.create(environ)
+        elif self.scope == 'thread':
+            users = getattr(self.local, 'users', None)
+            if users is None:
+                users = self.local.users = self.create(None)
+            return users
+        users = self.instance
+        if users is None:
+            self.lock.acquire()
+            try:
+                if self.instance is None:
+                    self.instance = self.create(None)
+                users = self.instance
+            finally:
+                self.lock.release()
+        return users
+
+    def use_users(self, environ):
+        # Called by the proxy the first time a request uses the object
+        self.used += 1
+        return self.get_users(environ)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'used': self.used,
+            'unused': self.requests - self.used,
+        }
+
+    def update_environ(self, environ):
+        self.requests += 1
+        environ[self.key] = UsersProxy(
+            self.use_users, 
+            environ, 
+            self.users_class,
+        )
+
+    def __call__(self, environ, start_response):
+        self.update_environ(environ)
         return self.app(environ, start_response)
 
 def get_authenticate_function(app, authenticate_conf, format, prefix):
@@ -315,6 +445,10 @@ class AddToEnviron(object):
         self.app = app
         self.key = key
         self.object = object
+        self.values = {key: object}
+
+    def update_environ(self, environ):
+        environ[self.key] = self.object
         
     def __call__(self, environ, start_response):
         environ[self.key] = self.object
@@ -325,6 +459,10 @@ class AddDictToEnviron(object):
     def __init__(self, app, dct):
         self.app = app
         self.dct = dct
+        self.values = dct
+
+    def update_environ(self, environ):
+        environ.update(self.dct)
         
     def __call__(self, environ, start_response):
         environ.update(self.dct)
@@ -337,12 +475,140 @@ class RequireEnvironKey(object):
         self.missing_error = missing_error or \
             'Missing the key %(key)s from the environ. Have you setup the ' \
             'correct middleware?'
-        
-    def __call__(self, environ, start_response):
+
+    def update_environ(self, environ):
         if not environ.has_key(self.key):
             raise Exception(self.missing_error%{'key':self.key})
+        
+    def __call__(self, environ, start_response):
+        self.update_environ(environ)
         return self.app(environ, start_response)
 
+class Pipeline(object):
+    """
+    A single piece of middleware which does the work of a run of simpler 
+    middleware that only change the ``environ`` before calling the next 
+    application.
+
+    ``steps`` is a list of ``(values, update_environ)`` pairs applied in 
+    order. Where ``values`` is a dictionary the ``environ`` is updated with it,
+    otherwise ``update_environ(environ)`` is called. If 
+    ``httpexception_handler`` is an ``HTTPExceptionHandler`` the pipeline 
+    also does its job for the application it wraps.
+
+    Pipelines are created by ``compile_pipeline()`` rather than directly.
+    """
+    def __init__(self, app, steps, httpexception_handler=None):
+        self.app = app
+        self.steps = steps
+        self.httpexception_handler = httpexception_handler
+
+    def __call__(self, environ, start_response):
+        for values, update_environ in self.steps:
+            if values is None:
+                update_environ(environ)
+            else:
+                environ.update(values)
+        if self.httpexception_handler is None:
+            return self.app(environ, start_response)
+        environ['paste.httpexceptions'] = self.httpexception_handler
+        environ.setdefault('paste.expected_exceptions',
+                           []).extend([paste.httpexceptions.HTTPException,
+                                       webob.exc.HTTPException])
+        try:
+            return self.app(environ, start_response)
+        except (paste.httpexceptions.HTTPException, 
+                webob.exc.HTTPException), exc:
+            return exc(environ, start_response)
+
+def _next_app(app):
+    for name in ['app', 'application']:
+        if hasattr(app, name):
+            return name, getattr(app, name)
+    return None, None
+
+def find_users(app, until=None):
+    """
+    Walks the middleware stack ``app`` until ``until`` looking for the 
+    middleware which adds ``authkit.users`` to the ``environ``. Returns the 
+    ``Users`` object or ``None`` if there isn't one or it can't be created 
+    outside a request.
+    """
+    while app is not None and app is not until:
+        if isinstance(app, AddUsersObjectToEnviron) and \
+           app.key == 'authkit.users':
+            if app.scope == 'request':
+                return None
+            return app.create(None)
+        if isinstance(app, AddToEnviron) and app.key == 'authkit.users':
+            return app.object
+        name, app = _next_app(app)
+    return None
+
+def find_permissions(app):
+    """
+    Walks the middleware stack ``app`` and returns the permissions checked
+    by the authorization middleware and ``ACL`` rules it finds
+    """
+    permissions = []
+    seen = {}
+    while app is not None and not seen.has_key(id(app)):
+        seen[id(app)] = True
+        permission = getattr(app, 'permission', None)
+        if hasattr(permission, 'check'):
+            permissions.append(permission)
+        permissions.extend(getattr(app, 'rule_permissions', []))
+        name, app = _next_app(app)
+    return permissions
+
+def compile_pipeline(app, until=None):
+    """
+    Walks the middleware stack ``app`` in the same way as 
+    ``authkit.authenticate.multi.find_multi_app()`` and replaces each run of
+    middleware which only changes the ``environ`` with a single ``Pipeline``.
+
+    ``AddToEnviron`` and ``AddDictToEnviron`` are merged into one 
+    ``dict.update()`` and middleware with an ``update_environ(environ)`` 
+    method, such as the user setters for the ``basic`` and ``digest`` 
+    methods, are called directly. Anything else, for example a 
+    ``MultiHandler`` which needs to see the response, is kept in the stack
+    and the middleware beneath it is compiled in turn. An 
+    ``HTTPExceptionHandler`` is absorbed if it is the last middleware in a 
+    run. The walk stops at ``until``, usually the application the AuthKit 
+    middleware is wrapping, which is left untouched. Returns the new stack.
+    """
+    steps = []
+    handler = None
+    ref = app
+    while ref is not until:
+        if isinstance(ref, (AddToEnviron, AddDictToEnviron)):
+            if steps and steps[-1][0] is not None:
+                values = steps[-1][0].copy()
+                values.update(ref.values)
+                steps[-1] = (values, None)
+            else:
+                steps.append((ref.values, None))
+        elif hasattr(ref, 'update_environ'):
+            steps.append((None, ref.update_environ))
+        elif isinstance(ref, HTTPExceptionHandler) and steps:
+            handler = ref
+            ref = ref.application
+            break
+        else:
+            break
+        ref = _next_app(ref)[1]
+    name, next = _next_app(ref)
+    if ref is not until and next is not None:
+        compiled = compile_pipeline(next, until)
+        if compiled is not next:
+            if isinstance(ref, MultiHandler) and ref.default is next:
+                ref.default = compiled
+            setattr(ref, name, compiled)
+    if not steps:
+        return ref
+    log.debug("Compiled %s middleware steps into one pipeline", len(steps))
+    return Pipeline(ref, steps, handler)
+
 def get_methods():
     """Get a dictionary of the available method entry points."""
     available_methods = {}
@@ -427,6 +693,31 @@ class HTTPExceptionHandler(object):
                 webob.exc.HTTPException), exc:        
             return exc(environ, start_response)
 
+def permission_registry(app, until, interval=catalog_interval, 
+                        validate=False):
+    """
+    Returns a ``PermissionRegistry`` for the ``authkit.users`` object set up
+    in the middleware stack ``app`` holding the permissions found in 
+    ``until``, the application the AuthKit middleware wraps. If ``validate``
+    is true the permissions are validated straight away so that mistakes 
+    are reported when the application starts. The role catalog is refreshed
+    every ``interval`` seconds, or never if it is ``0``.
+
+    Returns ``None`` if the ``Users`` object needs a request to be created.
+    Its permissions then check their roles and groups with the first 
+    request's ``Users`` object instead.
+    """
+    users = find_users(app, until)
+    if users is None:
+        log.debug("The authkit.users object can't be created outside a "
+                  "request so there is no role catalog")
+        return None
+    registry = PermissionRegistry(users, interval)
+    registry.add(find_permissions(until))
+    if validate:
+        registry.validate()
+    return registry
+
 def middleware(app, app_conf=None, global_conf=None, prefix='authkit.', 
                handle_httpexception=True, middleware=None, **options):   
     """
@@ -468,6 +759,7 @@ def middleware(app, app_conf=None, global_conf=None, prefix='authkit.',
     ``authkit.cookie.name`` specified in a config file sets the same options as
     ``cookie_name`` specified directly as an option.
     """
+    wrapped_app = app
     if handle_httpexception:
         app = HTTPExceptionHandler(app)
     
@@ -553,14 +845,27 @@ def middleware(app, app_conf=None, global_conf=None, prefix='authkit.',
                 global_conf=global_conf,
                 prefix=prefix_,
             )
+            # Methods which return a bare MultiHandler directly on top of the
+            # previous method's MultiHandler can share its dispatch layer
+            app = collapse_multi_handlers(app)
+    app = compile_status_checkers(app, intercept, until=wrapped_app)
+    registry = permission_registry(
+        app, 
+        wrapped_app, 
+        int(all_conf.get('setup.validate.interval', catalog_interval)),
+        asbool(all_conf.get('setup.validate', False)),
+    )
     app = AddDictToEnviron(
         app, 
         {
             'authkit.config':strip_base(all_conf, 'config.'),
             'authkit.intercept':intercept,
             'authkit.authenticate': True,
+            'authkit.permissions': registry,
         }
     )
+    if asbool(all_conf.get('setup.pipeline', False)):
+        app = compile_pipeline(app, until=wrapped_app)
     return app           
 
 def sample_app(environ, start_response):
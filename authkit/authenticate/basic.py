@@ -117,12 +117,16 @@ class BasicUserSetter(AuthKitUserSetter):
         self.users = users
         self.authenticate = AuthBasicAuthenticator(realm, authfunc)
 
-    def __call__(self, environ, start_response):
-        environ['authkit.users'] = self.users
+    def update_environ(self, environ):
+        if self.users is not None:
+            environ['authkit.users'] = self.users
         result = self.authenticate(environ)
         if isinstance(result, str):
             AUTH_TYPE.update(environ, 'basic')
             REMOTE_USER.update(environ, result)
+
+    def __call__(self, environ, start_response):
+        self.update_environ(environ)
         return self.application(environ, start_response)
 
 def load_basic_config(
@@ -217,8 +217,9 @@ class DigestUserSetter(object):
         self.users = users
         self.authenticate = AuthDigestAuthenticator(realm, authfunc)
 
-    def __call__(self, environ, start_response):
-        environ['authkit.users'] = self.users
+    def update_environ(self, environ):
+        if self.users is not None:
+            environ['authkit.users'] = self.users
         method = REQUEST_METHOD(environ)
         fullpath = SCRIPT_NAME(environ) + PATH_INFO(environ)
         authorization = AUTHORIZATION(environ)
@@ -226,6 +227,9 @@ class DigestUserSetter(object):
         if isinstance(result, str):
             AUTH_TYPE.update(environ,'digest')
             REMOTE_USER.update(environ, result)
+
+    def __call__(self, environ, start_response):
+        self.update_environ(environ)
         return self.application(environ, start_response)
 
 def load_digest_config(
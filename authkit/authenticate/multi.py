@@ -9,20 +9,110 @@ import logging
 
 log = logging.getLogger('authkit.authenticate.multi')
 
+class _TierDispatcher(object):
+    """
+    Runs a merged ``MultiHandler`` as if it only had its first ``tiers`` 
+    tiers. The bindings of a merged handler wrap one of these so that when
+    they call the application they wrap, the response is still checked by
+    the tiers beneath them, just as it was by the inner ``MultiHandler`` 
+    before the handlers were merged.
+    """
+    def __init__(self, handler, tiers):
+        self.handler = handler
+        self.tiers = tiers
+
+    def __call__(self, environ, start_response):
+        return self.handler.dispatch(environ, start_response, self.tiers)
+
 class MultiHandler(multi.MultiHandler):
 
     def __init__(self, application):
         multi.MultiHandler.__init__(self, application)
         self.checker = []
+        self.methods = []
+        self.merged = []
+        # The merged tier each binding absorbed by merge() belongs to
+        self.merged_names = {}
+
+    def add_method(self, name, factory, *args, **kwargs):
+        multi.MultiHandler.add_method(self, name, factory, *args, **kwargs)
+        self.methods.append((name, factory, args, kwargs))
+
+    def add_predicate(self, name, checker):
+        if self.merged_names.has_key(name):
+            predicate = self.merged[self.merged_names[name]][0]
+        else:
+            predicate = self.predicate
+        predicate.append((checker, self.binding[name]))
 
     def add_checker(self, name, checker):
-        self.checker.append((checker,self.binding[name]))
-            
+        if self.merged_names.has_key(name):
+            checkers = self.merged[self.merged_names[name]][1]
+        else:
+            checkers = self.checker
+        checkers.append((checker, self.binding[name]))
+
+    def merge(self, other):
+        """
+        Absorb ``other``, a ``MultiHandler`` which wraps this one, so that a
+        single layer does the dispatching for both. Any middleware between 
+        the two must only change the ``environ``, see 
+        ``collapse_multi_handlers()``.
+
+        The bindings of ``other`` are rebuilt around a ``_TierDispatcher`` 
+        which re-enters this handler's existing tiers and its predicates and
+        checkers are kept as a separate tier which is checked after them. As
+        with the nested stack, a response produced by a binding from an 
+        earlier tier is re-checked by the later tiers and a binding which 
+        calls the application it wraps gets a response checked by the 
+        earlier tiers. Returns ``False`` without changing anything if 
+        ``other`` can't be merged.
+        """
+        if other.default is not other.application or other.merged:
+            return False
+        for name, factory, args, kwargs in other.methods:
+            if self.binding.has_key(name):
+                return False
+        dispatcher = _TierDispatcher(self, len(self.merged) + 1)
+        rebound = {}
+        bindings = {}
+        for name, factory, args, kwargs in other.methods:
+            binding = factory(dispatcher, *args, **kwargs)
+            rebound[id(other.binding[name])] = binding
+            bindings[name] = binding
+        try:
+            tier = (
+                [(c, rebound[id(b)]) for c, b in other.predicate],
+                [(c, rebound[id(b)]) for c, b in other.checker],
+            )
+        except KeyError:
+            raise Exception(
+                'Cannot merge %r, one of its bindings was not set up with '
+                'add_method()'%other
+            )
+        for name in bindings.keys():
+            self.merged_names[name] = len(self.merged)
+        self.merged.append(tier)
+        self.binding.update(bindings)
+        self.methods.extend(other.methods)
+        return True
+
     def __call__(self, environ, start_response):
+        return self.dispatch(environ, start_response)
+
+    def dispatch(self, environ, start_response, tiers=None):
+        """
+        Calls the application and checks its response against the first 
+        ``tiers`` tiers of predicates and checkers, or all of them if 
+        ``tiers`` is ``None``.
+        """
         status_ = []
         headers_ = []
         exc_info_ = []
         result_ = []
+        all_tiers = [(self.predicate, self.checker)] + self.merged
+        if tiers is not None:
+            all_tiers = all_tiers[:tiers]
 
         def app(environ, start_response):
             def find(status, headers, exc_info=None):
@@ -59,21 +149,21 @@ class MultiHandler(multi.MultiHandler):
                       "exc_info: %r", status, headers, exc_info)
             return start_response(status, headers, exc_info)
         
-        def check():
-            for (checker, binding) in self.predicate:
-                if checker(environ):
+        def check_tier(predicate, checker, start_response):
+            for (checker_, binding) in predicate:
+                if checker_(environ):
                     log.debug(
                         "MultMiddleware self.predicate check() returning %r", 
                         binding)
                     environ['authkit.multi'] = True
-                    return binding(environ, logging_start_response)
-            for (checker, binding) in self.checker:
+                    return binding(environ, start_response)
+            for (checker_, binding) in checker:
                 if not len(status_):
                     raise Exception('No status was returned by the applicaiton')
                 if not len(headers_):
                     raise Exception('No headers were returned by the '
                                     'application')
-                if checker(environ, status_[-1], headers_ and headers_[-1] or []):
+                if checker_(environ, status_[-1], headers_ and headers_[-1] or []):
                     log.debug(
                         "MultiMiddleware self.checker check() returning %r", 
                         binding
@@ -81,8 +171,42 @@ class MultiHandler(multi.MultiHandler):
                     environ['authkit.multi'] = True
                     environ['pylons.error_call'] = 'authkit'
                     environ['pylons.status_code_redirect'] = 'authkit'
-                    return binding(environ, logging_start_response)
+                    return binding(environ, start_response)
             return None
+
+        def check():
+            if len(all_tiers) == 1:
+                return check_tier(all_tiers[0][0], all_tiers[0][1], 
+                                  logging_start_response)
+            # With merged tiers the response from a binding has to be held 
+            # back so that the later tiers get a chance to check it, just as
+            # the outer handlers would have done before they were merged.
+            def capture(status, headers, exc_info=None):
+                status_.append(status)
+                headers_.append(headers)
+                exc_info_.append(exc_info)
+                class NotWritableShouldntBeUsed: pass
+                return NotWritableShouldntBeUsed()
+            result = None
+            for predicate, checker in all_tiers:
+                called = len(status_)
+                tier_result = check_tier(predicate, checker, capture)
+                if tier_result is None:
+                    continue
+                if len(status_) == called:
+                    raise Exception('The binding %r did not call '
+                                    'start_response() before returning'%(
+                                        tier_result))
+                if result is not None and hasattr(result, 'close'):
+                    result.close()
+                result = tier_result
+            if result is not None:
+                logging_start_response(
+                    status_[-1], 
+                    headers_[-1], 
+                    exc_info_[-1],
+                )
+            return result
         
         app_iter = app(environ, start_response)
         if result_ and result_[-1]:
@@ -125,6 +249,52 @@ def status_checker(environ, status, headers):
     log.debug("Status checker returns False")
     return False
 
+def make_status_checker(intercept):
+    """
+    Returns a checker which behaves like ``status_checker()`` but looks the
+    status code up in a ``frozenset`` of the codes in ``intercept`` rather
+    than searching the ``authkit.intercept`` list on every response.
+
+    The set is only used while ``authkit.intercept`` in the ``environ`` is 
+    the ``intercept`` list itself, as put there by the authentication 
+    middleware. If a request replaces it the checker behaves exactly like
+    ``status_checker()``.
+    """
+    codes = frozenset([str(code).strip()[:3] for code in intercept])
+    def compiled_status_checker(environ, status, headers):
+        if environ.get('authkit.intercept') is not intercept:
+            return status_checker(environ, status, headers)
+        if status[:3] in codes:
+            log.debug("Status checker intercepting status %r", status)
+            return True
+        return False
+    compiled_status_checker.intercept = codes
+    return compiled_status_checker
+
+def compile_status_checkers(app, intercept, until=None):
+    """
+    Walks the middleware stack ``app`` in the same way as 
+    ``find_multi_app()`` and replaces every use of ``status_checker()`` in the
+    ``MultiHandler``s it finds with one compiled by 
+    ``make_status_checker()`` for the codes in ``intercept``. The walk stops
+    at ``until``, usually the application the AuthKit middleware is 
+    wrapping.
+    """
+    compiled = make_status_checker(intercept)
+    def replace(checkers):
+        checkers[:] = [
+            (checker is status_checker and compiled or checker, binding)
+            for checker, binding in checkers
+        ]
+    ref = app
+    while ref is not None and ref is not until:
+        if isinstance(ref, MultiHandler):
+            replace(ref.checker)
+            for predicate, checker in ref.merged:
+                replace(checker)
+        ref = getattr(ref, 'app', getattr(ref, 'application', None))
+    return app
+
 class AuthSwitcher:
     def __init__(self):
         pass
@@ -137,3 +307,65 @@ class AuthSwitcher:
     def switch(self, environ, status, headers):
         return False
 
+def find_multi_app(app):
+    """Walks an app assuming it is a middleware stack with apps glued on at 
+    either self.app or self.application
+    
+    Returns a tuple of the MultiHandler app ref and the possibly new app 
+    stack. If a multihandler app wasn't found, then it will be at the top of 
+    the returned app.
+    """
+    path = _multi_path(app)
+    if path is None:
+        app = MultiHandler(app)
+        return app, app
+    return path[-1], app
+
+def _next_app(app):
+    if hasattr(app, 'app'):
+        return 'app', app.app
+    return 'application', getattr(app, 'application', None)
+
+def _multi_path(app):
+    # The middleware from app down to and including the first MultiHandler
+    # found the way find_multi_app() walks, or None if there isn't one
+    path = []
+    while app is not None:
+        path.append(app)
+        if isinstance(app, MultiHandler):
+            return path
+        app = _next_app(app)[1]
+    return None
+
+def collapse_multi_handlers(app):
+    """
+    If the first ``MultiHandler`` in ``app`` wraps another ``MultiHandler``,
+    merge the two and return the stack without the outer one, otherwise 
+    return ``app`` unchanged. Only middleware with an 
+    ``update_environ(environ)`` method, such as the ``basic`` and ``digest``
+    user setters, may come before or between the two handlers since it 
+    doesn't matter whether that runs before or after the dispatching.
+
+    Used by ``authkit.authenticate.middleware()`` when several methods are
+    configured so that each request goes through one dispatch layer rather 
+    than one per method.
+    """
+    path = _multi_path(app)
+    if path is None:
+        return app
+    inner_path = _multi_path(path[-1].application)
+    if inner_path is None:
+        return app
+    for layer in path[:-1] + inner_path[:-1]:
+        if not hasattr(layer, 'update_environ'):
+            return app
+    outer = path[-1]
+    inner = inner_path[-1]
+    if not inner.merge(outer):
+        return app
+    log.debug("Merged %r into %r", outer, inner)
+    if len(path) == 1:
+        return outer.application
+    parent = path[-2]
+    setattr(parent, _next_app(parent)[0], outer.application)
+    return app
@@ -19,7 +19,8 @@ from paste.util.converters import asbool
 from paste.httpexceptions import HTTPNotFound, HTTPSeeOther, HTTPForbidden
 from paste.wsgiwrappers import WSGIRequest
 
-from authkit.authenticate.multi import MultiHandler, status_checker
+from authkit.authenticate.multi import MultiHandler, status_checker, \
+    find_multi_app
 from authkit.authenticate import AuthKitConfigError
 from authkit.authorize import NotAuthenticatedError
 
@@ -101,19 +102,3 @@ class RedirectingAuthMiddleware(object):
         """Construct the redirect URL"""
         raise NotImplemented()
 
-
-def find_multi_app(app):
-    """Walks an app assuming it is a middleware stack with apps glued on at 
-    either self.app or self.application
-    
-    Returns a tuple of the MultiHandler app ref and the possibly new app 
-    stack. If a multihandler app wasn't found, then it will be at the top of 
-    the returned app.
-    """
-    tempref = app
-    while not isinstance(tempref, MultiHandler):
-        tempref = getattr(tempref, 'app', getattr(tempref, 'application', None))
-        if tempref is None:
-            app = MultiHandler(app)
-            tempref = app
-    return tempref, app
@@ -0,0 +1,241 @@
+"""Authorization middleware driven by a table of URL rules
+
+Rather than wrapping an application in a separate
+``authkit.authorize.middleware`` for each part of a site, or decorating every
+controller action, the ``ACL`` middleware checks permissions based on a table
+of rules. Each rule has a path, the HTTP methods it applies to and a
+permission. In a Paste config file the rules are written one per line::
+
+    [filter:acl]
+    use = egg:AuthKit#acl
+    rules =
+        /admin          *          HasAuthKitRole('admin')
+        /admin/help     GET        None
+        /users/*/edit   GET,POST   And(RemoteUser(), HasAuthKitGroup('staff'))
+        /               POST       RemoteUser()
+
+A path applies to the URL it names and everything beneath it. A ``*`` segment
+matches any single segment of the URL. The methods are a comma separated list
+or ``*`` for any method. The permission is a Python expression using the
+classes from ``authkit.permissions``. ``None`` means no permission is
+required, which is useful to open up part of a protected path.
+
+When several rules match a request, the one with the longest path wins and a
+literal segment beats a ``*`` at the same depth. A rule for the request's
+method beats a ``*`` rule for the same path. Requests which match no rule are
+checked against ``default`` if one is given and otherwise pass straight
+through.
+
+The rules are compiled into a trie of path segments when the middleware is
+created so each request needs one walk down the trie to find its permission.
+The permission is then checked in exactly the same way as by
+``authkit.authorize.middleware``. Rules with the same permission expression
+share one permission object so decisions are shared by the per-request
+decision cache.
+
+Like the other authorization middleware, ``ACL`` must be wrapped by the
+``authkit.authenticate`` middleware.
+"""
+
+import logging
+
+from authkit.authorize import PermissionSetupError, middleware
+import authkit.permissions
+
+log = logging.getLogger('authkit.authorize.acl')
+
+def _split_path(path):
+    segments = []
+    for segment in path.split('/'):
+        if segment:
+            segments.append(segment)
+    return segments
+
+class _Node(object):
+    __slots__ = ('children', 'wildcard', 'rules')
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        # Method, or '*', to the application which checks the permission
+        self.rules = None
+
+def permission_namespace():
+    """
+    Returns the names available to permission expressions in the rules
+    """
+    namespace = {'__builtins__': {}, 'None': None, 'True': True,
+                 'False': False}
+    for name in dir(authkit.permissions):
+        if not name.startswith('_'):
+            namespace[name] = getattr(authkit.permissions, name)
+    return namespace
+
+def parse_rules(rules):
+    """
+    Parses the rules in the string ``rules``, one per line, into a list of
+    ``(path, methods, expression)`` tuples. Blank lines and lines starting
+    with ``#`` are ignored.
+    """
+    result = []
+    lines = rules.split('\n')
+    for i in range(len(lines)):
+        line = lines[i].strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 2)
+        if len(parts) != 3:
+            raise PermissionSetupError(
+                'Line %s of the ACL rules should be a path, the methods and '
+                'a permission, not %r'%(i+1, line)
+            )
+        result.append(tuple(parts))
+    return result
+
+class ACL(object):
+    """
+    WSGI middleware which checks the permission of the rule matching each
+    request.
+
+    ``rules`` is either a string in the format described in the module
+    documentation or a list of ``(path, methods, permission)`` tuples where
+    ``methods`` is a list of methods or ``'*'`` and ``permission`` is a
+    permission object, ``None`` or an expression string. ``default`` is the
+    permission, or expression, checked for requests which don't match a
+    rule.
+    """
+    def __init__(self, app, rules, default=None):
+        self.app = app
+        self.root = _Node()
+        self.permissions = {}
+        # Every permission the rules check, for finding them at start up
+        self.rule_permissions = []
+        if isinstance(rules, (str, unicode)):
+            rules = parse_rules(rules)
+        for path, methods, permission in rules:
+            self.add_rule(path, methods, permission)
+        self.default = self.authorizer(default)
+        log.debug("Compiled %s ACL rules", len(rules))
+
+    def permission(self, permission):
+        """
+        Returns the permission object for ``permission``, evaluating it if it
+        is an expression. The same expression always gives the same object.
+        """
+        if not isinstance(permission, (str, unicode)):
+            return permission
+        expression = permission.strip()
+        if not self.permissions.has_key(expression):
+            try:
+                self.permissions[expression] = eval(
+                    expression,
+                    permission_namespace(),
+                )
+            except Exception, e:
+                raise PermissionSetupError(
+                    'Could not create the ACL permission %r: %s'%(
+                        expression,
+                        e,
+                    )
+                )
+        return self.permissions[expression]
+
+    def authorizer(self, permission):
+        """
+        Returns the application which checks ``permission`` and then calls
+        the application the ACL wraps.
+        """
+        permission = self.permission(permission)
+        if permission is None:
+            return self.app
+        if not hasattr(permission, 'check'):
+            raise PermissionSetupError(
+                'Expected an AuthKit permission object, not %r'%permission
+            )
+        self.rule_permissions.append(permission)
+        return middleware(self.app, permission)
+
+    def add_rule(self, path, methods, permission):
+        if not path.startswith('/'):
+            raise PermissionSetupError(
+                'ACL paths should start with /, not %r'%path
+            )
+        if isinstance(methods, (str, unicode)):
+            methods = methods.split(',')
+        node = self.root
+        for segment in _split_path(path):
+            if segment == '*':
+                if node.wildcard is None:
+                    node.wildcard = _Node()
+                node = node.wildcard
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _Node()
+                node = child
+        if node.rules is None:
+            node.rules = {}
+        authorizer = self.authorizer(permission)
+        for method in methods:
+            method = method.strip().upper()
+            if node.rules.has_key(method):
+                raise PermissionSetupError(
+                    'There is more than one ACL rule for %s %s'%(method, path)
+                )
+            node.rules[method] = authorizer
+
+    def match(self, path, method):
+        """
+        Returns the application which checks the permission for a request to
+        ``path`` with ``method``, or ``None`` if no rule matches.
+        """
+        best = None
+        best_key = None
+        # Each active entry is (node, number of literal segments matched)
+        active = [(self.root, 0)]
+        depth = 0
+        segments = _split_path(path)
+        while True:
+            for node, literal in active:
+                rules = node.rules
+                if rules is not None:
+                    authorizer = rules.get(method)
+                    if authorizer is None:
+                        key = (depth, literal, 0)
+                        authorizer = rules.get('*')
+                    else:
+                        key = (depth, literal, 1)
+                    if authorizer is not None and \
+                       (best_key is None or key > best_key):
+                        best = authorizer
+                        best_key = key
+            if depth == len(segments):
+                break
+            segment = segments[depth]
+            next = []
+            for node, literal in active:
+                child = node.children.get(segment)
+                if child is not None:
+                    next.append((child, literal+1))
+                if node.wildcard is not None:
+                    next.append((node.wildcard, literal))
+            if not next:
+                break
+            active = next
+            depth += 1
+        return best
+
+    def __call__(self, environ, start_response):
+        authorizer = self.match(
+            environ.get('PATH_INFO', ''),
+            environ['REQUEST_METHOD'].upper(),
+        )
+        if authorizer is None:
+            authorizer = self.default
+        return authorizer(environ, start_response)
+
+def make_acl_middleware(app, global_conf, rules, default=None):
+    """
+    Paste Deploy filter app factory for the ``ACL`` middleware
+    """
+    return ACL(app, rules, default)
@@ -5,6 +5,8 @@ from decorator import decorator
 from authkit.authorize import PermissionSetupError
 from authkit.authorize import NotAuthenticatedError, NotAuthorizedError
 from authkit.authorize import authorize_request as authkit_authorize_request
+from authkit.authorize import authorized as authkit_authorized
+from authkit.authorize import cached_check
 
 def authorize(permission):
     """
@@ -19,7 +21,8 @@ def authorize(permission):
         if all_conf.get('setup.enable', True) is True:
             def app(environ, start_response):
                 return func(state, *args, **kwargs)
-            return permission.check(app, state.environ, state.start_response)
+            return cached_check(permission, app, state.environ, 
+                                state.start_response)
         else:
             return func(state, *args, **kwargs)
     return decorator(validate)
@@ -57,10 +60,5 @@ def authorized(state, permission):
             return Response('Access denied')
  
     """
-    try:
-        authorize_request(state, permission)
-    except (NotAuthorizedError, NotAuthenticatedError):
-        return False
-    else:
-        return True
+    return authkit_authorized(state.environ, permission)
 
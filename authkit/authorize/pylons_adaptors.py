@@ -19,6 +19,8 @@ from pylons import request
 from authkit.authorize import PermissionSetupError
 from authkit.authorize import NotAuthenticatedError, NotAuthorizedError
 from authkit.authorize import authorize_request as authkit_authorize_request
+from authkit.authorize import authorized as authkit_authorized
+from authkit.authorize import cached_check
 
 def authorize(permission):
     """
@@ -33,7 +35,8 @@ def authorize(permission):
         if all_conf.get('setup.enable', True) is True:
             def app(environ, start_response):
                 return func(self, *args, **kwargs)
-            return permission.check(app, request.environ, self.start_response)
+            return cached_check(permission, app, request.environ, 
+                                self.start_response)
         else:
             return func(self, *args, **kwargs)
     return decorator(validate)
@@ -71,10 +74,5 @@ def authorized(permission):
             return Response('Access denied')
  
     """
-    try:
-        authorize_request(permission)
-    except (NotAuthorizedError, NotAuthenticatedError):
-        return False
-    else:
-        return True
+    return authkit_authorized(request.environ, permission)
 
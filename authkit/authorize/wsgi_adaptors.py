@@ -83,6 +83,106 @@ class _FiddledWith(Exception):
 
 
 
+#
+# Permission Decision Cache
+#
+
+def cached_check(permission, app, environ, start_response):
+    """
+    Checks ``permission`` in the same way as ``permission.check()`` but 
+    remembers the decision in the ``environ`` for the rest of the request so
+    that checking the same permission object again for the same
+    ``REMOTE_USER`` doesn't repeat the work.
+
+    Only permissions with a true ``cacheable`` attribute are cached. The
+    built-in request-based permissions set it unless, like ``BetweenTimes``,
+    their decision can change during a request, and custom permissions have
+    to opt in. A decision is only 
+    remembered if the permission either raised a ``NotAuthorizedError`` or 
+    ``NotAuthenticatedError`` before calling ``app`` or passed the request on
+    to ``app``, so errors raised by the application itself are never cached.
+    """
+    if not getattr(permission, 'cacheable', False):
+        return permission.check(app, environ, start_response)
+    cache = environ.setdefault('authkit.authorize.cache', {})
+    key = (permission, environ.get('REMOTE_USER'))
+    if cache.has_key(key):
+        error = cache[key]
+        if error is not None:
+            raise error
+        return app(environ, start_response)
+    called = []
+    def checked_app(environ, start_response):
+        called.append(True)
+        return app(environ, start_response)
+    try:
+        result = permission.check(checked_app, environ, start_response)
+    except (NotAuthorizedError, NotAuthenticatedError), error:
+        if not called:
+            cache[key] = error
+        raise
+    if called:
+        cache[key] = None
+    return result
+
+#
+# Boolean Permission Checks
+#
+
+_evaluators = {}
+
+def _defined_by(cls, name):
+    for base in cls.__mro__:
+        if base.__dict__.has_key(name):
+            return base
+    return None
+
+def evaluator(permission):
+    """
+    Returns the ``evaluate()`` method of ``permission`` if it can be used to
+    decide the permission without going through ``check()``, otherwise
+    ``None``.
+
+    ``evaluate(environ)`` returns ``True`` if the request passes the 
+    permission and ``False`` if it doesn't, without constructing any of the 
+    HTTP exceptions ``check()`` would raise. It is only trusted if it is 
+    defined on the same class as ``check()`` or on a subclass of it so that a
+    custom permission which overrides ``check()`` in a subclass of one of the
+    built-in permissions is still checked the normal way. Permissions can 
+    also set an ``evaluable`` attribute to ``False`` to disable it.
+    """
+    cls = permission.__class__
+    trusted = _evaluators.get(cls)
+    if trusted is None:
+        trusted = False
+        if hasattr(cls, '__mro__'):
+            defines_evaluate = _defined_by(cls, 'evaluate')
+            defines_check = _defined_by(cls, 'check')
+            if defines_evaluate is not None and defines_check is not None:
+                trusted = issubclass(defines_evaluate, defines_check)
+        _evaluators[cls] = trusted
+    if trusted and getattr(permission, 'evaluable', True):
+        return permission.evaluate
+    return None
+
+def cached_evaluate(permission, evaluate, environ):
+    """
+    Returns the result of ``evaluate(environ)`` where ``evaluate`` is the
+    method returned by ``evaluator(permission)``, sharing the decisions
+    remembered by ``cached_check()``. Only passes are stored since a failure
+    is remembered by ``cached_check()`` as the error to raise.
+    """
+    if not getattr(permission, 'cacheable', False):
+        return evaluate(environ)
+    cache = environ.setdefault('authkit.authorize.cache', {})
+    key = (permission, environ.get('REMOTE_USER'))
+    if cache.has_key(key):
+        return cache[key] is None
+    if evaluate(environ):
+        cache[key] = None
+        return True
+    return False
+
 #
 # Authorize Objects
 #
@@ -99,7 +199,8 @@ class _Authorize(object):
         if all_conf.get('setup.enable', True) is True:
             # Could also check that status and response haven't changed here?
             try:
-                return self.permission.check(self.app, environ, start_response)
+                return cached_check(self.permission, self.app, environ, 
+                                    start_response)
             except NotAuthenticatedError:
                 if environ.has_key('REMOTE_USER'):
                     raise NonConformingPermissionError(
@@ -151,7 +252,7 @@ def authorize(permission):
             if all_conf.get('setup.enable', True) is True:
                 def app(environ, start_response):
                     return func(self, environ, start_response)
-                return permission.check(app, environ, start_response)
+                return cached_check(permission, app, environ, start_response)
             else:
                 return func(self, environ, start_response)
         return input
@@ -192,7 +293,8 @@ def authorize_request(environ, permission):
                 return _PermissionList('''Dummy response from permission check.''')
             
             if not isinstance(
-                permission.check(
+                cached_check(
+                    permission,
                     dummy_app, 
                     environ, 
                     _PermissionStartResponse
@@ -206,10 +308,27 @@ def authorize_request(environ, permission):
        return 
 
 def authorized(environ, permission):
-    try:
-        authorize_request(environ, permission)
-    except (NotAuthorizedError, NotAuthenticatedError):
-        return False
-    else:
+    """
+    Similar to ``authorize_request()`` but returns ``True`` or ``False`` 
+    rather than raising an exception if the permission check fails.
+
+    Permissions with an ``evaluate()`` method (see ``evaluator()``), which
+    includes all the built-in request-based permissions, are decided 
+    directly without raising or catching any exceptions. Other permissions
+    are checked with ``authorize_request()``.
+    """
+    evaluate = evaluator(permission)
+    if evaluate is None:
+        try:
+            authorize_request(environ, permission)
+        except (NotAuthorizedError, NotAuthenticatedError):
+            return False
+        else:
+            return True
+    all_conf = environ.get('authkit.config')
+    if all_conf is None:
+        raise Exception('Authentication middleware not present')
+    if all_conf.get('setup.enable', True) is not True:
         return True
+    return cached_evaluate(permission, evaluate, environ)
 
@@ -21,10 +21,19 @@ Permissions are described in detail in the AuthKit manual.
 """
 
 from authkit.authorize import PermissionError, NotAuthenticatedError
-from authkit.authorize import NotAuthorizedError, middleware
+from authkit.authorize import NotAuthorizedError, middleware, evaluator
+from authkit.authorize import NonConformingPermissionError, PermissionSetupError
+from authkit.authorize import cached_evaluate
 
+import atexit
 import datetime
+import itertools
 import logging
+import os
+import socket
+import threading
+import time
+import weakref
 log = logging.getLogger('authkit.permissions')
 
 # will be True for Python 2.5+
@@ -61,12 +70,33 @@ class Permission(object):
     
         The WSGI ``app`` can only be called once by the ``check()`` method.
         This means that you cannot write permisisons objects that perform
-        logical ``not`` and ``or`` operations on other permissions objects
+        logical ``not`` and ``or`` operations on response-based permissions
         since doing so might require the same app to be called multiple times.
         A permission object to perform an ``and`` operation is feasible and has
-        been impleneted as the ``And`` permission class.  
+        been impleneted as the ``And`` permission class. Request-based 
+        permissions can be decided before the app is called so they can also
+        be combined with the ``Or``, ``AnyOf`` and ``Not`` classes.
+
+    The ``cacheable`` attribute tells the authorization objects whether the 
+    decision can be remembered for the rest of a request once the permission
+    has been checked for a particular ``REMOTE_USER``. It is ``False`` here 
+    because a response-based permission can't be decided without the 
+    response.
+
+    Permissions can also implement an ``evaluate(environ)`` method which
+    returns ``True`` or ``False`` rather than raising an error. It is used by
+    ``authorized()`` to avoid the cost of creating the errors and must make 
+    the same decision as ``check()``. All the built-in request-based 
+    permissions implement it.
+
+    The ``cost`` attribute is a rough hint of how expensive the permission is
+    to check. Permissions which only look at the ``environ`` have a cost of 
+    ``1`` and those which use the ``authkit.users`` object have higher costs.
+    ``Or`` and ``AnyOf`` check the cheapest permissions first.
         
    """
+    cacheable = False
+    cost = 10
 
     def check(self, app, environ, start_response): 
         return app(environ, start_response)
@@ -74,8 +104,12 @@ class Permission(object):
 class RequestPermission(Permission):
     """
     The base class for all request-based permissions
+
+    Decisions aren't cached unless a subclass sets ``cacheable`` to ``True``.
+    Only do so if the decision depends on nothing but the permission and the
+    ``REMOTE_USER`` and ``check()`` doesn't change the ``start_response`` or
+    response it passes on.
     """
-    pass
 
 class _TestBadlyLabelledResponseBasedPermission(RequestPermission):
     def check(self, app, environ, start_response):
@@ -92,30 +126,94 @@ class UserIn(RequestPermission):
     ``users``
         A list of usernames which are valid
 
+    ``filename``
+        A file of valid usernames, one per line. Blank lines and lines 
+        starting with ``#`` are ignored. The file is checked for changes at 
+        most once every ``reload_interval`` seconds and reloaded if its 
+        modification time has changed. If it can't be read the previous 
+        list of users is kept.
+
     If there is no ``REMOTE_USER`` a ``NotAuthenticatedError`` is raised. If
     the ``REMOTE_USER`` is not in ``users`` a ``NotAuthorizedError`` is raised.
 
-    Usernames supplied to ``users`` are treated case insensitively.
+    Usernames supplied to ``users`` and the ``REMOTE_USER`` are treated case
+    insensitively. The usernames are stored lowercased in a ``frozenset`` 
+    and the ``REMOTE_USER`` is only lowercased if it isn't found as it is.
     """
 
-    def __init__(self, users):
-        if isinstance(users, list) or isinstance(users, tuple):
-            users_ = []
-            for user in users:
-                users_.append(user.lower())
-            self.users = users_
-        elif isinstance(users, str):
-            self.users = [users]
-        else:
+    cacheable = True
+    cost = 1
+    reload_interval = 5
+
+    def __init__(self, users=None, filename=None):
+        if users is None and filename is None:
+            raise PermissionSetupError('Expected users or a filename')
+        if users is None:
+            users = []
+        elif isinstance(users, (str, unicode)):
+            users = [users]
+        elif not isinstance(users, (list, tuple, set, frozenset)):
             raise PermissionSetupError('Expected users to be a list or a string, not %r'%users)
+        self.static_users = frozenset([user.lower() for user in users])
+        self.users = self.static_users
+        self.filename = filename
+        self.mtime = None
+        self.checked = 0
+        if filename is not None:
+            self.load()
+
+    def load(self):
+        """
+        Loads the usernames from ``self.filename`` if it has changed since it
+        was last loaded.
+        """
+        self.checked = time.time()
+        try:
+            mtime = os.stat(self.filename).st_mtime
+            if mtime == self.mtime:
+                return
+            fp = open(self.filename, 'r')
+            try:
+                users = []
+                for line in fp:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        users.append(line.lower())
+            finally:
+                fp.close()
+        except (IOError, OSError), e:
+            if self.mtime is None:
+                raise PermissionSetupError(
+                    'Could not load the users from %r: %s'%(self.filename, e)
+                )
+            log.error("Could not reload the users from %r, keeping the "
+                      "previous users: %s", self.filename, e)
+            return
+        # Swap in the complete set in one assignment
+        self.users = self.static_users.union(users)
+        self.mtime = mtime
+        log.debug("Loaded %s users from %r", len(self.users), self.filename)
+
+    def contains(self, username):
+        """
+        Returns ``True`` if ``username`` is one of the users
+        """
+        if self.filename is not None and \
+           time.time() - self.checked >= self.reload_interval:
+            self.load()
+        users = self.users
+        return username in users or username.lower() in users
       
     def check(self, app, environ, start_response):
         if 'REMOTE_USER' not in environ:
             raise NotAuthenticatedError('Not Authenticated')
-        if environ['REMOTE_USER'] not in self.users:
+        if not self.contains(environ['REMOTE_USER']):
             raise NotAuthorizedError('You are not one of the users allowed to access this resource.')
         return app(environ, start_response)
 
+    def evaluate(self, environ):
+        return 'REMOTE_USER' in environ and self.contains(environ['REMOTE_USER'])
+
 class Exists(RequestPermission):
     """
     Checks the specified key is present in the ``environ``.
@@ -128,7 +226,11 @@ class Exists(RequestPermission):
     ``error``
         The error to be raised if the key is missing. XXX This argument may be deprecated soon.
 
+    The decision isn't cached since the key could be added to the 
+    ``environ`` later in the request.
     """
+    cacheable = False
+    cost = 1
 
     def __init__(self, key, error=NotAuthorizedError('Not Authorized')):
         self.key = key
@@ -138,12 +240,124 @@ class Exists(RequestPermission):
         if self.key not in environ:
             raise self.error
         return app(environ, start_response)
+
+    def evaluate(self, environ):
+        return self.key in environ
         
-class And(RequestPermission):
+class _Passed(object):
+    pass
+
+def _check_request(permission, environ, start_response):
+    """
+    Checks a request-based ``permission`` without calling the application.
+    Returns ``True`` if it passed or ``False`` if it passed but changed the
+    ``start_response`` or response it was given, in which case it needs to 
+    be checked as a response-based permission.
+
+    ``permission.check()`` is called directly rather than through 
+    ``cached_check()`` so that a permission which changes the response isn't
+    remembered as passed before it has been checked against the real 
+    response. Only clean passes and failures are added to the cache.
+    """
+    key = None
+    if getattr(permission, 'cacheable', False):
+        cache = environ.setdefault('authkit.authorize.cache', {})
+        key = (permission, environ.get('REMOTE_USER'))
+        if cache.has_key(key):
+            error = cache[key]
+            if error is not None:
+                raise error
+            return True
+    passed = []
+    def app(environ, start_response_):
+        passed.append(start_response_ is start_response)
+        return _Passed
+    try:
+        result = permission.check(app, environ, start_response)
+    except NotAuthenticatedError, error:
+        if environ.has_key('REMOTE_USER'):
+            raise NonConformingPermissionError(
+                'Faulty permission: NotAuthenticatedError raised '
+                'but REMOTE_USER key is present.'
+            )
+        if key is not None and not passed:
+            cache[key] = error
+        raise
+    except NotAuthorizedError, error:
+        if key is not None and not passed:
+            cache[key] = error
+        raise
+    if result is _Passed and passed == [True]:
+        if key is not None:
+            cache[key] = None
+        return True
+    return False
+
+def _request_based(permission):
+    if isinstance(permission, And):
+        for part in permission.permissions:
+            if not _request_based(part):
+                return False
+        return True
+    return isinstance(permission, RequestPermission)
+
+def _passes(permission, environ, start_response):
+    """
+    Returns ``True`` if the request-based ``permission`` passes or ``False``
+    if it raises a ``NotAuthorizedError`` or ``NotAuthenticatedError``.
+    """
+    evaluate = evaluator(permission)
+    if evaluate is not None:
+        return cached_evaluate(permission, evaluate, environ)
+    try:
+        if _check_request(permission, environ, start_response):
+            return True
+    except (NotAuthorizedError, NotAuthenticatedError):
+        return False
+    raise PermissionSetupError(
+        'The permission %r changed the response so is not request-based'%(
+            permission
+        )
+    )
+
+class _PermissionGroup(RequestPermission):
+    """
+    Base class for permissions made up of the list of permissions in 
+    ``self.permissions``.
+    """
+    def cacheable(self):
+        for permission in self.permissions:
+            if not getattr(permission, 'cacheable', False):
+                return False
+        return True
+    cacheable = property(cacheable)
+
+    def evaluable(self):
+        for permission in self.permissions:
+            if evaluator(permission) is None:
+                return False
+        return True
+    evaluable = property(evaluable)
+
+    def cost(self):
+        cost = 0
+        for permission in self.permissions:
+            cost += getattr(permission, 'cost', Permission.cost)
+        return cost
+    cost = property(cost)
+
+class And(_PermissionGroup):
     """
     Checks all the permission objects listed as keyword arguments in turn.
     Permissions are checked from left to right. The error raised by the ``And``
     permission is the error raised by the first permission check to fail.
+
+    The request-based permissions are all checked in turn before the 
+    application is called. Each one is checked once with its own 
+    ``check()`` so a refused request gets that permission's error without
+    the permission being decided twice. Any response-based permissions are 
+    then checked in the usual way by wrapping the application in 
+    authorization middleware.
     """
 
     def __init__(self, *permissions):
@@ -154,11 +368,142 @@ class And(RequestPermission):
         self.permissions = permissions
         
     def check(self, app, environ, start_response):
+        response_based = []
+        # self.permissions is stored in reverse order
+        for i in range(len(self.permissions)-1, -1, -1):
+            permission = self.permissions[i]
+            if isinstance(permission, RequestPermission):
+                # Raises the permission's own error if it fails
+                if _check_request(permission, environ, start_response):
+                    continue
+            response_based.append(permission)
+        for i in range(len(response_based)-1, -1, -1):
+            app = middleware(app, response_based[i])
+        return app(environ, start_response)
+
+    def evaluate(self, environ):
+        # self.permissions is stored in reverse order
+        for i in range(len(self.permissions)-1, -1, -1):
+            if not self.permissions[i].evaluate(environ):
+                return False
+        return True
+
+class AnyOf(_PermissionGroup):
+    """
+    Checks that at least ``count`` of the request-based permissions in 
+    ``permissions`` pass. 
+
+    Takes the following arguments:
+
+    ``permissions``
+        A list of request-based permission objects
+
+    ``count``
+        The number of permissions which must pass, ``1`` by default
+
+    ``error``
+        The error to be raised if too few of the permissions pass
+
+    The permissions are checked in order of their ``cost`` attribute and the
+    checks stop as soon as the result is known. The application is only 
+    called once, after all the checks. If no error is specified, a
+    ``NotAuthenticatedError`` is raised if there is no ``REMOTE_USER`` and a 
+    ``NotAuthorizedError`` otherwise.
+    """
+
+    def __init__(self, permissions, count=1, error=None):
+        permissions = list(permissions)
+        if len(permissions) < count or count < 1:
+            raise PermissionSetupError(
+                'Expected at least %s permissions objects'%max(count, 1)
+            )
+        for permission in permissions:
+            if not _request_based(permission):
+                raise PermissionSetupError(
+                    'Only request-based permissions can be combined, not %r'%(
+                        permission
+                    )
+                )
+        # Sort by cost, keeping the order given for equal costs
+        costs = []
+        for i in range(len(permissions)):
+            permission = permissions[i]
+            costs.append((getattr(permission, 'cost', Permission.cost), i))
+        costs.sort()
+        self.permissions = [permissions[i] for cost, i in costs]
+        self.count = count
+        self.error = error
+
+    def _error(self, environ):
+        if self.error:
+            return self.error
+        if not environ.get('REMOTE_USER'):
+            return NotAuthenticatedError('Not Authenticated')
+        return NotAuthorizedError('Not Authorized')
+
+    def check(self, app, environ, start_response):
+        passed = 0
+        remaining = len(self.permissions)
         for permission in self.permissions:
-            app = middleware(app, permission)
-        #raise Exception(app, self.permissions)
+            remaining -= 1
+            if _passes(permission, environ, start_response):
+                passed += 1
+                if passed >= self.count:
+                    return app(environ, start_response)
+            elif passed + remaining < self.count:
+                break
+        raise self._error(environ)
+
+    def evaluate(self, environ):
+        passed = 0
+        remaining = len(self.permissions)
+        for permission in self.permissions:
+            remaining -= 1
+            if permission.evaluate(environ):
+                passed += 1
+                if passed >= self.count:
+                    return True
+            elif passed + remaining < self.count:
+                return False
+        return False
+
+class Or(AnyOf):
+    """
+    Passes if any of the request-based permissions listed as arguments pass.
+    The cheapest permissions are checked first.
+    """
+
+    def __init__(self, *permissions):
+        if len(permissions) < 2:
+            raise PermissionSetupError('Expected at least 2 permissions objects')
+        AnyOf.__init__(self, permissions)
+
+class Not(_PermissionGroup):
+    """
+    Passes if the request-based ``permission`` fails. A ``NotAuthorizedError``
+    is raised if it passes, or ``error`` if one is specified.
+    """
+
+    def __init__(self, permission, error=None):
+        if not _request_based(permission):
+            raise PermissionSetupError(
+                'Only request-based permissions can be negated, not %r'%(
+                    permission
+                )
+            )
+        self.permissions = [permission]
+        self.error = error
+
+    def check(self, app, environ, start_response):
+        if _passes(self.permissions[0], environ, start_response):
+            if self.error:
+                raise self.error
+            raise NotAuthorizedError('Not Authorized')
         return app(environ, start_response)
 
+    def evaluate(self, environ):
+        return not self.permissions[0].evaluate(environ)
+
 class RemoteUser(RequestPermission):
     """
     Checks someone is signed in by checking for the presence of the
@@ -169,6 +514,9 @@ class RemoteUser(RequestPermission):
     ``True`` in Python.
     """
 
+    cacheable = True
+    cost = 1
+
     def __init__(self, accept_empty=False):
         self.accept_empty = accept_empty
 
@@ -187,25 +535,298 @@ class RemoteUser(RequestPermission):
                 raise exc.exception # ditto
         return app(environ, start_response)
 
+    def evaluate(self, environ):
+        if 'REMOTE_USER' not in environ:
+            return False
+        return self.accept_empty != False or bool(environ['REMOTE_USER'])
+
 #
 # Permissions to work with the AuthKit user management API
 #
 
-class HasAuthKitRole(RequestPermission):
+#
+# Role Catalog
+#
+
+_catalog_versions = itertools.count(1)
+
+# The default number of seconds between refreshes of a role catalog
+catalog_interval = 300
+
+class RoleCatalog(object):
+    """
+    A snapshot of the roles and groups defined by a ``Users`` object.
+
+    Permissions validate the roles and groups they were set up with against
+    the current catalog rather than querying the ``Users`` object on every 
+    request. Each new catalog has a higher ``version`` so a permission only
+    needs to be validated again when the catalog changes.
+    """
+    def __init__(self, users):
+        self.roles = frozenset(users.list_roles())
+        self.groups = frozenset(users.list_groups())
+        self.created = time.time()
+        self.version = _catalog_versions.next()
+
+def _walk_permissions(permissions, found):
+    for permission in permissions:
+        if not found.has_key(id(permission)):
+            found[id(permission)] = permission
+            _walk_permissions(getattr(permission, 'permissions', []), found)
+
+class PermissionRegistry(object):
+    """
+    The permissions used by one AuthKit middleware stack and the 
+    ``RoleCatalog`` of the ``authkit.users`` object they are checked 
+    against.
+
+    The authenticate middleware creates one for each stack whose 
+    ``authkit.users`` object can be shared between requests and puts it in
+    the ``environ`` as ``authkit.permissions``. The catalog is only ever 
+    built by ``validate()``, which is called when the middleware is set up 
+    if ``authkit.setup.validate`` is true and by a ``RoleCatalogRefresher``
+    every ``interval`` seconds. The refresher is started the first time the
+    registry is used in each process, so pre-forked workers each get one.
+    Until there is a catalog, permissions check their names with the
+    ``Users`` object directly.
+
+    Permissions are added as they are found in the stack at start up and as 
+    they are checked, so permissions registered by decorators which are 
+    only imported later are still validated. Only weak references to them 
+    are kept.
+    """
+    def __init__(self, users, interval=0):
+        self.users = users
+        self.interval = interval
+        self.catalog = None
+        self.permissions = weakref.WeakKeyDictionary()
+        # The catalog version each permission was last validated against
+        self.versions = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+        self.refresher = None
+        self.refresher_pid = None
+
+    def add(self, permissions):
+        """
+        Adds ``permissions`` and any permissions they are made up of
+        """
+        found = {}
+        _walk_permissions(permissions, found)
+        self.lock.acquire()
+        try:
+            for permission in found.values():
+                if isinstance(permission, _AuthKitUsersPermission):
+                    self.permissions[permission] = True
+        finally:
+            self.lock.release()
+
+    def current_catalog(self):
+        """
+        Returns the current ``RoleCatalog`` or ``None`` if there isn't one 
+        yet, starting the ``RoleCatalogRefresher`` for this process if it
+        isn't running.
+        """
+        if self.interval > 0 and self.refresher_pid != os.getpid():
+            self.lock.acquire()
+            try:
+                if self.refresher_pid != os.getpid():
+                    self.refresher = RoleCatalogRefresher(self, self.interval)
+                    self.refresher.start()
+                    self.refresher_pid = os.getpid()
+            finally:
+                self.lock.release()
+        return self.catalog
+
+    def validate(self):
+        """
+        Replaces the catalog with a new one from ``self.users`` and validates
+        every permission in the registry against it. Raises a 
+        ``PermissionSetupError`` listing every role or group which doesn't 
+        exist. Returns the new catalog.
+        """
+        catalog = RoleCatalog(self.users)
+        self.catalog = catalog
+        self.lock.acquire()
+        try:
+            permissions = self.permissions.keys()
+        finally:
+            self.lock.release()
+        errors = []
+        for permission in permissions:
+            try:
+                self.validate_permission(permission, catalog)
+            except PermissionSetupError, e:
+                errors.append(str(e))
+        if errors:
+            errors.sort()
+            raise PermissionSetupError('. '.join(errors))
+        log.debug("Validated %s permissions against role catalog version %s", 
+                  len(permissions), catalog.version)
+        return catalog
+
+    def validate_permission(self, permission, catalog):
+        """
+        Validates ``permission`` against ``catalog`` unless it has already 
+        been validated against it
+        """
+        if self.versions.get(permission) == catalog.version:
+            return
+        permission.validate(catalog)
+        self.lock.acquire()
+        try:
+            self.permissions[permission] = True
+            self.versions[permission] = catalog.version
+        finally:
+            self.lock.release()
+
+def validate_permissions(users, permissions):
+    """
+    Validates the ``permissions`` against a new ``RoleCatalog`` created from
+    ``users`` and returns the catalog. Raises a ``PermissionSetupError`` 
+    listing every role or group which doesn't exist.
+    """
+    registry = PermissionRegistry(users)
+    registry.add(permissions)
+    return registry.validate()
+
+_refreshers = weakref.WeakKeyDictionary()
+
+def _stop_refreshers():
+    # Stop the threads before the interpreter starts tearing down modules
+    refreshers = _refreshers.keys()
+    for refresher in refreshers:
+        refresher.stop()
+    for refresher in refreshers:
+        if refresher.isAlive():
+            refresher.join(1)
+atexit.register(_stop_refreshers)
+
+class RoleCatalogRefresher(threading.Thread):
+    """
+    A daemon thread which calls the ``validate()`` method of the 
+    ``PermissionRegistry`` ``registry`` straight away if it has no catalog 
+    and then every ``interval`` seconds so that the role catalog is replaced
+    in the background rather than during a request. Errors are logged since
+    there is nobody to raise them to. Call ``stop()`` to end the thread.
+    """
+    def __init__(self, registry, interval):
+        threading.Thread.__init__(self, name='authkit-role-catalog')
+        self.setDaemon(True)
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+        _refreshers[self] = True
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh(self):
+        try:
+            self.registry.validate()
+        except Exception, e:
+            log.error("Could not validate the permissions: %s", e)
+
+    def run(self):
+        if self.registry.catalog is None:
+            self.refresh()
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                break
+            self.refresh()
+
+# The Users classes each permission has been validated with when there was
+# no role catalog
+_validated_users = weakref.WeakKeyDictionary()
+
+class _AuthKitUsersPermission(RequestPermission):
+    """
+    Base class for the permissions which check the roles or groups
+    configured for them actually exist.
+
+    The check is made against the ``RoleCatalog`` of the stack's 
+    ``PermissionRegistry`` and is only repeated when the catalog changes, so
+    ordinary requests don't query the ``authkit.users`` object for it at 
+    all. Without a catalog, for example when the ``authkit.users`` object 
+    is created for each request, the names are checked with the 
+    ``authkit.users`` object the first time the permission is used with 
+    each ``Users`` class.
+    """
+    cacheable = True
+
+    def validate(self, catalog):
+        """
+        Raises a ``PermissionSetupError`` if any of the names the permission
+        was set up with don't exist in the ``RoleCatalog`` ``catalog``. 
+        Subclasses with names to check override this, it does nothing here.
+        """
+        pass
+
+    def validate_users(self, users):
+        """
+        Like ``validate()`` but checks the names with the ``Users`` object
+        ``users``. It does nothing here.
+        """
+        pass
+
+    def _validate(self, environ, users):
+        registry = environ.get('authkit.permissions')
+        if registry is not None:
+            catalog = registry.current_catalog()
+            if catalog is not None:
+                registry.validate_permission(self, catalog)
+                return
+        validated = _validated_users.get(self)
+        if validated is None:
+            validated = _validated_users.setdefault(self, {})
+        # A UsersProxy reports the class of the object it stands in for
+        users_class = users.__class__
+        if not validated.has_key(users_class):
+            self.validate_users(users)
+            validated[users_class] = True
+
+class HasAuthKitRole(_AuthKitUsersPermission):
     """
     Designed to work with the user management API described in the AuthKit manual.
 
     This permission checks that the signed in user has any if the roles specified
     in ``roles``. If ``all`` is ``True``, the user must have all the roles for
     the permission check to pass.
+
+    The user's roles are looked up once with ``user_role_set()`` and compared
+    with the roles specified using set operations.
     """
+    cost = 50
 
     def __init__(self, roles, all=False, error=None):
         if isinstance(roles, str):
             roles = [roles]
         self.all = all
         self.roles = roles
+        self.role_set = frozenset([role.lower() for role in roles])
         self.error = error
+
+    def validate(self, catalog):
+        for role in self.roles:
+            if role.lower() not in catalog.roles:
+                raise PermissionSetupError("No such role %r exists"%role)
+
+    def validate_users(self, users):
+        for role in self.roles:
+            if not users.role_exists(role):
+                raise PermissionSetupError("No such role %r exists"%role)
+
+    def _user_role_set(self, environ, users, username):
+        """
+        Returns the user's roles or ``None`` if the user doesn't exist.
+        """
+        from authkit.users import AuthKitNoSuchUserError, lookup_user
+        try:
+            roles = lookup_user(users, username, 'user_role_set')
+        except AuthKitNoSuchUserError:
+            return None
+        self._validate(environ, users)
+        return roles
         
     def check(self, app, environ, start_response):
         """
@@ -222,47 +843,100 @@ class HasAuthKitRole(RequestPermission):
                 raise self.error
             raise NotAuthenticatedError('Not authenticated')
         
-        users = environ['authkit.users']
-        if not users.user_exists(environ['REMOTE_USER']):
+        roles = self._user_role_set(
+            environ,
+            environ['authkit.users'], 
+            environ['REMOTE_USER'],
+        )
+        if roles is None:
             raise NotAuthorizedError('No such user')
-        # Check the groups specified when setup actually exist
-        for role in self.roles:
-            if not users.role_exists(role):
-                raise Exception("No such role %r exists"%role)
         if self.all:
-            for role in self.roles:
-                if not users.user_has_role(environ['REMOTE_USER'], role):
-                    if self.error:
-                        raise self.error
-                    else:
+            missing = self.role_set - roles
+            if missing:
+                if self.error:
+                    raise self.error
+                for role in self.roles:
+                    if role.lower() in missing:
                         raise NotAuthorizedError(
                             "User doesn't have the role %s"%role.lower()
                         )
             return app(environ, start_response)
         else:
-            for role in self.roles:
-                if users.user_has_role(environ['REMOTE_USER'], role):
-                    return app(environ, start_response)
+            if self.role_set & roles:
+                return app(environ, start_response)
             if self.error:
                 raise self.error
             else:
                 raise NotAuthorizedError(
                     "User doesn't have any of the specified roles"
                 )
+
+    def evaluate(self, environ):
+        if not environ.get('authkit.users'):
+            raise no_authkit_users_in_environ
+        if not environ.get('REMOTE_USER'):
+            return False
+        roles = self._user_role_set(
+            environ,
+            environ['authkit.users'], 
+            environ['REMOTE_USER'],
+        )
+        if roles is None:
+            return False
+        if self.all:
+            return self.role_set.issubset(roles)
+        return len(self.role_set & roles) > 0
     
-class HasAuthKitGroup(RequestPermission):
+class HasAuthKitGroup(_AuthKitUsersPermission):
     """
     Designed to work with the user management API described in the AuthKit manual.
 
     This permission checks that the signed in user is in one of the groups specified
     in ``groups``.
+
+    The user's group is looked up once with ``user_group()`` and checked 
+    against the set of groups specified, so there is one lookup however many
+    groups there are.
     """
+    cost = 50
 
     def __init__(self, groups, error=None):
         if isinstance(groups, str):
             groups = [groups]
         self.groups = groups
+        group_set = []
+        for group in groups:
+            if group is not None:
+                group = group.lower()
+            group_set.append(group)
+        self.group_set = frozenset(group_set)
         self.error = error
+
+    def validate(self, catalog):
+        for group in self.groups:
+            if group is not None:
+                if group.lower() not in catalog.groups:
+                    raise PermissionSetupError("No such group %r exists"%group)
+
+    def validate_users(self, users):
+        for group in self.groups:
+            if group is not None:
+                if not users.group_exists(group):
+                    raise PermissionSetupError("No such group %r exists"%group)
+
+    def _user_in_groups(self, environ, users, username):
+        """
+        Returns ``True`` or ``False`` or ``None`` if the user doesn't exist.
+        """
+        from authkit.users import AuthKitNoSuchUserError, lookup_user
+        self._validate(environ, users)
+        try:
+            group = lookup_user(users, username, 'user_group')
+        except AuthKitNoSuchUserError:
+            return None
+        if group is not None:
+            group = group.lower()
+        return group in self.group_set
         
     def check(self, app, environ, start_response):
         """
@@ -277,18 +951,15 @@ class HasAuthKitGroup(RequestPermission):
             if self.error: 
                 raise self.error
             raise NotAuthenticatedError('Not authenticated')
-        users = environ['authkit.users']
-        # Check the groups specified when setup actually exist
-        for group in self.groups:
-            if group is not None:
-                if not users.group_exists(group):
-                    raise Exception("No such group %r exists"%group)
-        
-        if not users.user_exists(environ['REMOTE_USER']):
+        result = self._user_in_groups(
+            environ,
+            environ['authkit.users'], 
+            environ['REMOTE_USER'],
+        )
+        if result is None:
             raise NotAuthorizedError('No such user')
-        for group in self.groups:
-            if users.user_has_group(environ['REMOTE_USER'], group):
-                return app(environ, start_response)
+        if result:
+            return app(environ, start_response)
         if self.error:
             raise self.error
         else:
@@ -296,11 +967,24 @@ class HasAuthKitGroup(RequestPermission):
                 "User is not a member of the specified group(s) %r"%self.groups
             )
 
+    def evaluate(self, environ):
+        if not environ.get('authkit.users'):
+            raise no_authkit_users_in_environ
+        if not environ.get('REMOTE_USER'):
+            return False
+        return self._user_in_groups(
+            environ,
+            environ['authkit.users'], 
+            environ['REMOTE_USER'],
+        ) and True or False
+
 class ValidAuthKitUser(UserIn):
     """
     Checks that the signed in user is one of the users specified when setting up
     the user management API.
     """
+    cost = 20
+
     def __init__(self):
         pass
     
@@ -315,48 +999,282 @@ class ValidAuthKitUser(UserIn):
             )
         return app(environ, start_response)
 
+    def evaluate(self, environ):
+        if 'authkit.users' not in environ:
+            raise no_authkit_users_in_environ
+        username = environ.get('REMOTE_USER')
+        if not username:
+            return False
+        return environ['authkit.users'].user_exists(username) and True or False
+
+def _pack_address(address):
+    """
+    Returns the packed bytes of the IPv4 or IPv6 ``address`` or ``None`` if
+    it isn't a valid address. IPv4-mapped IPv6 addresses are returned as 
+    IPv4 addresses.
+    """
+    address = address.strip()
+    if ':' in address:
+        if not hasattr(socket, 'inet_pton'):
+            return None
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, address)
+        except (socket.error, ValueError):
+            return None
+        if packed[:12] == '\0'*10 + '\xff'*2:
+            return packed[12:]
+        return packed
+    if address.count('.') != 3:
+        return None
+    try:
+        return socket.inet_aton(address)
+    except socket.error:
+        return None
+
+class AddressSet(object):
+    """
+    A set of IPv4 and IPv6 hosts and CIDR networks such as ``10.0.0.0/8`` or
+    ``2001:db8::/32`` which can be tested with the ``in`` operator.
+
+    Networks are stored in a trie with one level per byte of the address so
+    a lookup takes at most 4 steps for IPv4 and 16 for IPv6 however many 
+    networks there are. Prefixes which don't end on a byte boundary are 
+    expanded into each of the byte values they cover. Hosts which aren't IP
+    addresses are matched as exact strings, as they always have been.
+    """
+    def __init__(self, hosts=()):
+        self.exact = {}
+        # One trie per address length, 4 for IPv4 and 16 for IPv6
+        self.tries = {4: {}, 16: {}}
+        self.networks = 0
+        for host in hosts:
+            self.add(host)
+
+    def add(self, host):
+        self.exact[host] = True
+        if '/' in host:
+            address, prefixlen = host.split('/', 1)
+        else:
+            address, prefixlen = host, None
+        packed = _pack_address(address)
+        if packed is None:
+            if prefixlen is not None:
+                raise PermissionSetupError('Invalid network %r'%host)
+            return
+        if prefixlen is None:
+            prefixlen = len(packed) * 8
+        else:
+            try:
+                prefixlen = int(prefixlen)
+            except ValueError:
+                prefixlen = -1
+            if prefixlen < 0 or prefixlen > len(packed) * 8:
+                raise PermissionSetupError('Invalid network %r'%host)
+        self._insert(self.tries[len(packed)], packed, prefixlen)
+        self.networks += 1
+
+    def _insert(self, node, packed, prefixlen):
+        if prefixlen == 0:
+            # Stands for every address of this length
+            node[None] = True
+            return
+        full, rem = divmod(prefixlen, 8)
+        if rem:
+            mask = (0xff << (8 - rem)) & 0xff
+            first = ord(packed[full]) & mask
+            last_keys = range(first, first + (1 << (8 - rem)))
+            path = packed[:full]
+        else:
+            last_keys = [ord(packed[full-1])]
+            path = packed[:full-1]
+        for char in path:
+            child = node.get(ord(char))
+            if child is True:
+                # Already covered by a shorter prefix
+                return
+            if child is None:
+                child = node[ord(char)] = {}
+            node = child
+        for key in last_keys:
+            node[key] = True
+
+    def __contains__(self, address):
+        if self.exact.has_key(address):
+            return True
+        if not self.networks or address is None:
+            return False
+        packed = _pack_address(address)
+        if packed is None:
+            return False
+        node = self.tries[len(packed)]
+        if node.has_key(None):
+            return True
+        for char in packed:
+            node = node.get(ord(char))
+            if node is None:
+                return False
+            if node is True:
+                return True
+        return False
+
 class FromIP(RequestPermission):
     """
     Checks that the remote host specified in the environment ``key`` is one 
     of the hosts specified in ``hosts``.
+
+    ``hosts`` can contain IPv4 or IPv6 addresses or CIDR networks such as
+    ``192.168.0.0/16``. See ``AddressSet`` for how they are matched.
+
+    If the application is behind proxies which add the client's address to
+    the ``X-Forwarded-For`` header, pass their addresses or networks as 
+    ``trusted_proxies``. When the request comes from a trusted proxy the 
+    addresses in the header are read from right to left and the first one 
+    which isn't a trusted proxy is checked instead. The header is ignored 
+    for requests which don't come from a trusted proxy since anyone can set
+    it.
     """
-    def __init__(self, hosts, key='REMOTE_ADDR'):
+    cacheable = True
+    cost = 1
+
+    def __init__(self, hosts, key='REMOTE_ADDR', trusted_proxies=None):
         self.hosts = hosts
         if not isinstance(self.hosts, (list, tuple)):
             self.hosts = [hosts]
         self.key = key
-        
-    def check(self, app, environ, start_response):
+        self.addresses = AddressSet(self.hosts)
+        self.trusted_proxies = None
+        if trusted_proxies:
+            if not isinstance(trusted_proxies, (list, tuple)):
+                trusted_proxies = [trusted_proxies]
+            self.trusted_proxies = AddressSet(trusted_proxies)
+
+    def address(self, environ):
+        """
+        Returns the address of the client which made the request
+        """
         if self.key not in environ:
             raise Exception(
                 "No such key %r in environ so cannot check the host"%self.key
             )
-        if not environ.get(self.key) in self.hosts:
-            raise NotAuthorizedError('Host %r not allowed'%environ.get(self.key))
+        address = environ[self.key]
+        if self.trusted_proxies is None or \
+           address not in self.trusted_proxies:
+            return address
+        forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+        if not forwarded:
+            return address
+        hops = forwarded.split(',')
+        for i in range(len(hops)-1, -1, -1):
+            address = hops[i].strip()
+            if address not in self.trusted_proxies:
+                return address
+        # Every hop is a trusted proxy so the first one is the client
+        return address
+        
+    def check(self, app, environ, start_response):
+        address = self.address(environ)
+        if not address in self.addresses:
+            raise NotAuthorizedError('Host %r not allowed'%address)
         return app(environ, start_response)
 
+    def evaluate(self, environ):
+        return self.address(environ) in self.addresses
+
+_day_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def _seconds(t):
+    """Returns the ``datetime.time`` ``t`` as seconds since midnight"""
+    seconds = t.hour*3600 + t.minute*60 + t.second
+    if t.microsecond:
+        return seconds + t.microsecond/1000000.0
+    return seconds
+
 class BetweenTimes(RequestPermission):
     """
     Only grants access if the request is made on or after ``start`` and 
     before ``end``. Times should be specified as datetime.time objects.
+
+    Takes the following optional arguments:
+
+    ``tzinfo``
+        A ``datetime.tzinfo`` object for the timezone the times are in. By
+        default they are in the server's local time.
+
+    ``days``
+        A list of the days of the week access is granted on, either as 
+        numbers with Monday as ``0`` or as names such as ``'mon'`` or 
+        ``'Friday'``. A window which crosses midnight belongs to the day it
+        starts on. By default access is granted every day.
+
+    The times are stored as seconds since midnight and each decision is 
+    remembered until the next time it could change, so most checks are a 
+    single comparison. The decision isn't cached per request since it 
+    depends on when it is checked.
     """
-    def __init__(self, start, end):
+    cacheable = False
+    cost = 2
+    # The longest a decision is remembered for, so that changes to the UTC
+    # offset such as daylight saving are noticed
+    recheck_interval = 900
+
+    def __init__(self, start, end, tzinfo=None, days=None):
         self.start = start
         self.end = end
+        self.tzinfo = tzinfo
+        self.start_seconds = _seconds(start)
+        self.end_seconds = _seconds(end)
+        if days is None:
+            self.days = 0x7f
+        else:
+            self.days = 0
+            for day in days:
+                if isinstance(day, (str, unicode)):
+                    name = day[:3].lower()
+                    if name not in _day_names:
+                        raise PermissionSetupError('Unknown day %r'%day)
+                    day = _day_names.index(name)
+                if day not in range(7):
+                    raise PermissionSetupError('Unknown day %r'%day)
+                self.days |= 1 << day
+        # (time.time() the decision is valid until, decision)
+        self.decision = (0, False)
 
     def check(self, app, environ, start_response):
-        today = datetime.datetime.now()
-        now = datetime.time(today.hour, today.minute, today.second, today.microsecond)
-        error = NotAuthorizedError("Not authorized at this time of day")
-        if self.end > self.start:
-            if now >= self.start and now < self.end:
-                return app(environ, start_response)
-            else:
-                raise error
+        if self.evaluate(environ):
+            return app(environ, start_response)
+        raise NotAuthorizedError("Not authorized at this time of day")
+
+    def evaluate(self, environ):
+        timestamp = time.time()
+        until, result = self.decision
+        if timestamp < until:
+            return result
+        result, remaining = self.decide(
+            datetime.datetime.fromtimestamp(timestamp, self.tzinfo)
+        )
+        self.decision = (timestamp + remaining, result)
+        return result
+
+    def decide(self, now):
+        """
+        Returns whether access is granted at the ``datetime.datetime`` 
+        ``now`` and how many seconds the decision is valid for.
+        """
+        seconds = _seconds(now.time())
+        start, end = self.start_seconds, self.end_seconds
+        weekday = now.weekday()
+        if end > start:
+            result = seconds >= start and seconds < end and \
+               self.days & (1 << weekday)
+        elif seconds >= start:
+            result = self.days & (1 << weekday)
+        elif seconds < end:
+            # The window started yesterday
+            result = self.days & (1 << ((weekday - 1) % 7))
         else:
-            if now < datetime.time(23, 59, 59, 999999) and now >= self.start:
-                return app(environ, start_response)
-            elif now >= datetime.time(0) and now < self.end:
-                return app(environ, start_response)
-            else:
-                raise error
+            result = False
+        remaining = self.recheck_interval - seconds % self.recheck_interval
+        for boundary in [start, end]:
+            if boundary > seconds and boundary - seconds < remaining:
+                remaining = boundary - seconds
+        return bool(result), remaining
@@ -57,9 +57,20 @@ If you are using the authentication middleware with users, the ``Users`` object
 will be available in your code as ``environ[authkit.users]``.  
 """
 
+import atexit
+import math
+import os
 import os.path
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+import threading
+import weakref
 import md5 as _md5
-from authkit.authenticate import AuthKitConfigError
+from authkit.authenticate import AuthKitConfigError, AddUsersObjectToEnviron
+from paste.util.import_string import eval_import
 import logging
 
 log = logging.getLogger('authkit.users')
@@ -92,6 +103,27 @@ class AuthKitNotSupportedError(Exception):
 
 class AuthKitError(Exception):
     pass
+
+def lookup_user(users, username, method, *args):
+    """
+    Calls the ``users`` object's method named ``method`` with ``username`` and
+    ``args`` and returns the result. 
+    
+    The API says a missing user raises ``AuthKitNoSuchUserError`` but custom
+    ``Users`` objects often raise something else. If any other exception is
+    raised ``user_exists()`` is asked and, if the user doesn't exist, an
+    ``AuthKitNoSuchUserError`` is raised instead. Otherwise the original
+    exception is re-raised.
+    """
+    try:
+        return getattr(users, method)(username, *args)
+    except AuthKitNoSuchUserError:
+        raise
+    except Exception:
+        exc_info = sys.exc_info()
+        if not users.user_exists(username):
+            raise AuthKitNoSuchUserError("No such user %r"%username)
+        raise exc_info[0], exc_info[1], exc_info[2]
     
 #
 # Users classes
@@ -289,6 +321,16 @@ class Users(object):
             )
         )
         
+    def user_role_set(self, username):
+        """
+        Returns a ``frozenset`` of the lowercase role names for the given username. Raises an 
+        exception if the username doesn't exist.
+
+        This implementation is built on ``user_roles()``. Drivers can override it if they 
+        have a faster way of looking up the roles.
+        """
+        return frozenset([role.lower() for role in self.user_roles(username)])
+        
     def user_group(self, username):
         """
         Returns the group associated with the user or ``None`` if no group is associated.
@@ -342,6 +384,185 @@ class Users(object):
             )
         )
 
+    # Bulk Methods
+    bulk_chunk_size = 500
+
+    def _username_chunks(self, usernames):
+        """
+        Returns the unique lowercase ``usernames`` in lists of at most 
+        ``bulk_chunk_size``, for drivers which look them up with ``IN`` 
+        queries
+        """
+        unique = {}
+        for username in usernames:
+            unique[username.lower()] = None
+        unique = unique.keys()
+        unique.sort()
+        return [
+            unique[i:i+self.bulk_chunk_size] 
+            for i in range(0, len(unique), self.bulk_chunk_size)
+        ]
+
+    def users_bulk(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the dictionary returned by ``user()`` 
+        for each user in ``usernames`` which exists. Users which don't exist are left out.
+
+        This implementation calls ``user()`` for each user; drivers should override it with a 
+        query for all of them.
+        """
+        result = {}
+        for username in usernames:
+            if self.user_exists(username):
+                result[username.lower()] = self.user(username)
+        return result
+
+    def users_with_role(self, role):
+        """
+        Returns a list of the lowercase usernames of the users with the role specified ordered 
+        alphabetically. Raises an ``AuthKitNoSuchRoleError`` if the role doesn't exist.
+        """
+        if not self.role_exists(role):
+            raise AuthKitNoSuchRoleError("No such role %r"%role.lower())
+        return [
+            username for username in self.list_users() 
+            if self.user_has_role(username, role)
+        ]
+
+    def users_in_group(self, group):
+        """
+        Returns a list of the lowercase usernames of the users in the group specified ordered 
+        alphabetically. Raises an ``AuthKitNoSuchGroupError`` if the group doesn't exist.
+        """
+        if not self.group_exists(group):
+            raise AuthKitNoSuchGroupError("No such group %r"%group.lower())
+        return [
+            username for username in self.list_users() 
+            if self.user_has_group(username, group)
+        ]
+
+    def roles_for_users(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the list returned by ``user_roles()``
+        for each user in ``usernames`` which exists. Users which don't exist are left out.
+        """
+        result = {}
+        for username in usernames:
+            if self.user_exists(username):
+                result[username.lower()] = self.user_roles(username)
+        return result
+
+    # Bulk Write Methods
+    def _validate_new_users(self, records, user_exists, role_exists, group_exists):
+        """
+        Checks the ``records`` passed to ``bulk_create_users()`` using the functions given 
+        to test whether a lowercase name already exists. Returns a list of 
+        ``(username, password, group, roles)`` tuples with lowercase names for the records 
+        which can be created and the list of failures.
+        """
+        valid = []
+        failures = []
+        seen = {}
+        for record in records:
+            username = record.get('username') or ''
+            group = record.get('group')
+            if group is not None:
+                group = group.lower()
+            roles = [role.lower() for role in record.get('roles') or []]
+            if not username or ' ' in username:
+                error = AuthKitError("Usernames cannot be empty or contain space characters")
+            elif seen.has_key(username.lower()) or user_exists(username.lower()):
+                error = AuthKitError("User %r already exists"%username)
+            elif not record.get('password'):
+                error = AuthKitError("No password for user %r"%username)
+            elif group is not None and not group_exists(group):
+                error = AuthKitNoSuchGroupError("There is no such group %r"%group)
+            else:
+                error = None
+                for role in roles:
+                    if not role_exists(role):
+                        error = AuthKitNoSuchRoleError("No such role %r"%role)
+                        break
+            if error is None:
+                seen[username.lower()] = None
+                roles = dict.fromkeys(roles).keys()
+                roles.sort()
+                valid.append((username.lower(), record['password'], group, roles))
+            else:
+                failures.append((record, error))
+        return valid, failures
+
+    def _validate_role_pairs(self, pairs, user_roles, role_exists):
+        """
+        Checks the ``(username, role)`` pairs passed to ``bulk_assign_roles()``. 
+        ``user_roles(username)`` should return the current roles of a lowercase username, or
+        ``None`` if the user doesn't exist. Returns a list of lowercase pairs which can be 
+        assigned and the list of failures.
+        """
+        valid = []
+        failures = []
+        seen = {}
+        for pair in pairs:
+            username, role = pair[0].lower(), pair[1].lower()
+            current = user_roles(username)
+            if current is None:
+                error = AuthKitNoSuchUserError("No such user %r"%username)
+            elif not role_exists(role):
+                error = AuthKitNoSuchRoleError("No such role %r"%role)
+            elif role in current or seen.has_key((username, role)):
+                error = AuthKitError("User %r already has the role %r"%(username, role))
+            else:
+                error = None
+            if error is None:
+                seen[(username, role)] = None
+                valid.append((username, role))
+            else:
+                failures.append((pair, error))
+        return valid, failures
+
+    def bulk_create_users(self, records):
+        """
+        Creates a user for each dictionary in ``records``, which have the keys ``username``, 
+        ``password`` and optionally ``group`` and ``roles`` in the format returned by 
+        ``user()``. The group and roles must already exist.
+
+        Records which can't be created are skipped and the others are created. Returns a 
+        list of ``(record, exception)`` pairs for the records which were skipped.
+
+        This implementation calls ``user_create()`` and ``user_add_role()`` for each user;
+        drivers should override it to check all the records first and then write them in
+        one transaction.
+        """
+        valid, failures = self._validate_new_users(
+            records, 
+            self.user_exists, 
+            self.role_exists, 
+            self.group_exists,
+        )
+        for username, password, group, roles in valid:
+            self.user_create(username, password, group)
+            for role in roles:
+                self.user_add_role(username, role)
+        return failures
+
+    def bulk_assign_roles(self, pairs):
+        """
+        Gives each user the role in each ``(username, role)`` pair in ``pairs``. The roles 
+        must already exist.
+
+        Pairs which can't be assigned, including roles the user already has, are skipped 
+        and the others are assigned. Returns a list of ``(pair, exception)`` pairs for the
+        pairs which were skipped.
+        """
+        def user_roles(username):
+            if not self.user_exists(username):
+                return None
+            return self.user_role_set(username)
+        valid, failures = self._validate_role_pairs(pairs, user_roles, self.role_exists)
+        for username, role in valid:
+            self.user_add_role(username, role)
+        return failures
+
     def user_set_username(self, username, new_username):
         """
         Sets the user's username to the lowercase of new_username. 
@@ -395,6 +616,281 @@ class Users(object):
             )
         )
         
+class UsersIndex(object):
+    """
+    Frozen lookup tables built from the ``usernames``, ``passwords``, 
+    ``roles`` and ``groups`` data described in ``UsersReadOnly``.
+
+    As well as the original data, the index has:
+
+    ``user_set``, ``role_set``, ``group_set``
+        ``frozenset`` objects of the lowercase names for existence checks
+
+    ``user_list``, ``role_list``, ``group_list``
+        Sorted tuples of the same names for the ``list_*()`` methods
+
+    ``user_role_sets``
+        A dictionary of usernames to a ``frozenset`` of their roles
+
+    ``role_users``, ``group_users``
+        Dictionaries of each role or group to a sorted tuple of the usernames 
+        which have it
+
+    The index is never changed once it has been built so it can be replaced
+    as a whole while other threads are using the previous one.
+
+    ``UsersReadOnly`` uses the index through ``find()``, which returns a row 
+    for a lowercase username or ``None``, and the ``*_of(row)`` methods, so
+    other indexes such as ``UsersTable`` can store the data differently. 
+    Here a row is just the username.
+    """
+    def __init__(self, usernames, passwords, roles, groups):
+        self.usernames = usernames
+        self.passwords = passwords
+        self.roles = roles
+        self.groups = groups
+        user_list = list(usernames)
+        user_list.sort()
+        self.user_list = tuple(user_list)
+        self.user_set = frozenset(user_list)
+        self.user_role_sets = {}
+        role_users = {}
+        group_users = {}
+        for username in user_list:
+            user_roles = frozenset([role.lower() for role in roles[username] if role])
+            self.user_role_sets[username] = user_roles
+            for role in user_roles:
+                role_users.setdefault(role, []).append(username)
+            group = groups[username]
+            if group:
+                group_users.setdefault(group, []).append(username)
+        self.role_users = {}
+        for role, users in role_users.items():
+            self.role_users[role] = tuple(users)
+        self.group_users = {}
+        for group, users in group_users.items():
+            self.group_users[group] = tuple(users)
+        role_list = self.role_users.keys()
+        role_list.sort()
+        self.role_list = tuple(role_list)
+        self.role_set = frozenset(role_list)
+        group_list = self.group_users.keys()
+        group_list.sort()
+        self.group_list = tuple(group_list)
+        self.group_set = frozenset(group_list)
+
+    def find(self, username):
+        if username in self.user_set:
+            return username
+        return None
+
+    def username_of(self, row):
+        return row
+
+    def password_of(self, row):
+        return self.passwords[row]
+
+    def group_of(self, row):
+        return self.groups[row]
+
+    def roles_of(self, row):
+        return self.roles[row]
+
+    def role_set_of(self, row):
+        return self.user_role_sets[row]
+
+    def users_with_role(self, role):
+        return self.role_users.get(role, ())
+
+    def users_in_group(self, group):
+        return self.group_users.get(group, ())
+
+def _typecode(largest):
+    # The smallest unsigned array type which can hold largest
+    for typecode in 'BHI':
+        if largest < 2**(8*array(typecode).itemsize):
+            return typecode
+    return 'L'
+
+class UsersTable(object):
+    """
+    A compact alternative to ``UsersIndex`` for very large, read only sets of
+    users.
+
+    ``records`` is an iterable of ``(username, password, group, roles)`` 
+    tuples sorted by username with lowercase names and no repeated usernames,
+    such as those produced by ``parse_table()``. A row is the position of a 
+    user in the sorted ``user_list`` and is found with a binary search.
+
+    Rather than dictionaries and a list of roles for each user, the table 
+    keeps parallel arrays indexed by row. Role and group names are stored 
+    once and referred to by their position in the sorted ``role_list`` and 
+    ``group_list``:
+
+    ``passwords``
+        A list of passwords
+
+    ``group_ids``
+        An ``array`` of one more than the position of each user's group in 
+        ``group_list``, or ``0`` for no group
+
+    ``role_offsets``, ``role_ids``
+        The positions in ``role_list`` of the roles of the user in row ``n`` 
+        are ``role_ids[role_offsets[n]:role_offsets[n+1]]``
+
+    ``role_row_offsets``, ``role_rows``
+        The rows of the users with the role at position ``i`` in 
+        ``role_list`` are ``role_rows[role_row_offsets[i]:role_row_offsets[i+1]]``
+
+    ``group_row_offsets``, ``group_rows``
+        The same for the users in each group in ``group_list``
+
+    The arrays use the smallest integer type which holds their values.
+    """
+    def __init__(self, records):
+        user_list = []
+        passwords = []
+        groups = []
+        roles = []
+        role_counts = array('L')
+        for username, password, group, role_list in records:
+            user_list.append(username)
+            passwords.append(password)
+            groups.append(group)
+            roles.extend(role_list)
+            role_counts.append(len(role_list))
+        self.user_list = tuple(user_list)
+        del user_list
+        self.passwords = passwords
+
+        group_list = list(frozenset(groups))
+        if None in group_list:
+            group_list.remove(None)
+        group_list.sort()
+        self.group_list = tuple(group_list)
+        self.group_set = frozenset(group_list)
+        group_ids = {None: 0}
+        for i in range(len(group_list)):
+            group_ids[group_list[i]] = i+1
+        self.group_ids = array(
+            _typecode(len(group_list)), 
+            [group_ids[group] for group in groups],
+        )
+        del groups
+
+        role_list = list(frozenset(roles))
+        role_list.sort()
+        self.role_list = tuple(role_list)
+        self.role_set = frozenset(role_list)
+        role_ids = {}
+        for i in range(len(role_list)):
+            role_ids[role_list[i]] = i
+        # The roles of each user are already sorted so their ids are too
+        self.role_ids = array(
+            _typecode(len(role_list)), 
+            [role_ids[role] for role in roles],
+        )
+        del roles
+        self.role_offsets = array(_typecode(len(self.role_ids)), [0])
+        offset = 0
+        for count in role_counts:
+            offset += count
+            self.role_offsets.append(offset)
+        del role_counts
+
+        # The users with each role and in each group, so that those lookups
+        # don't have to scan every row
+        self.role_row_offsets, self.role_rows = self._invert(
+            self._role_pairs, 
+            len(role_list),
+        )
+        self.group_row_offsets, self.group_rows = self._invert(
+            self._group_pairs, 
+            len(group_list),
+        )
+
+    def _role_pairs(self):
+        role_ids = self.role_ids
+        role_offsets = self.role_offsets
+        for row in xrange(len(self.user_list)):
+            for n in xrange(role_offsets[row], role_offsets[row+1]):
+                yield role_ids[n], row
+
+    def _group_pairs(self):
+        group_ids = self.group_ids
+        for row in xrange(len(self.user_list)):
+            if group_ids[row]:
+                yield group_ids[row]-1, row
+
+    def _invert(self, pairs, count):
+        # Returns the offsets and rows arrays for the (id, row) pairs 
+        # generated by pairs(), which is called twice. The rows for each id
+        # stay in order.
+        counts = [0] * count
+        total = 0
+        for id, row in pairs():
+            counts[id] += 1
+            total += 1
+        offsets = array(_typecode(total), [0])
+        for n in counts:
+            offsets.append(offsets[-1] + n)
+        positions = offsets.tolist()
+        rows = array(_typecode(len(self.user_list)), [0]) * total
+        for id, row in pairs():
+            rows[positions[id]] = row
+            positions[id] += 1
+        return offsets, rows
+
+    def find(self, username):
+        row = bisect_left(self.user_list, username)
+        if row < len(self.user_list) and self.user_list[row] == username:
+            return row
+        return None
+
+    def username_of(self, row):
+        return self.user_list[row]
+
+    def password_of(self, row):
+        return self.passwords[row]
+
+    def group_of(self, row):
+        group_id = self.group_ids[row]
+        if group_id:
+            return self.group_list[group_id-1]
+        return None
+
+    def roles_of(self, row):
+        role_list = self.role_list
+        return [
+            role_list[role_id] for role_id in 
+            self.role_ids[self.role_offsets[row]:self.role_offsets[row+1]]
+        ]
+
+    def role_set_of(self, row):
+        return frozenset(self.roles_of(row))
+
+    def users_with_role(self, role):
+        role_id = bisect_left(self.role_list, role)
+        if role_id == len(self.role_list) or self.role_list[role_id] != role:
+            return []
+        user_list = self.user_list
+        return [
+            user_list[row] for row in self.role_rows[
+                self.role_row_offsets[role_id]:self.role_row_offsets[role_id+1]
+            ]
+        ]
+
+    def users_in_group(self, group):
+        group_id = bisect_left(self.group_list, group)
+        if group_id == len(self.group_list) or self.group_list[group_id] != group:
+            return []
+        user_list = self.user_list
+        return [
+            user_list[row] for row in self.group_rows[
+                self.group_row_offsets[group_id]:self.group_row_offsets[group_id+1]
+            ]
+        ]
+
 class UsersReadOnly(Users):
     """
     Like the ``Users`` class except that user information is read only. All the information
@@ -405,58 +901,77 @@ class UsersReadOnly(Users):
     ``passwords``, ``groups`` should be a dictionary where the keys are lowercase usernames
     and the values are the corresponding lowercase group name or password.
     ``roles`` is similar to ``passwords`` and ``groups`` except values are lists of lowercase role names.
+
+    The lookups are made against a ``UsersIndex`` of these attributes stored as ``self.index``. 
+    It is built the first time it is needed if ``__init__()`` doesn't set it. Subclasses which 
+    change the attributes afterwards should call ``build_index()`` again.
     """
+    index = None
+
+    def build_index(self):
+        """
+        Builds the ``UsersIndex`` from the ``usernames``, ``passwords``, ``roles`` and 
+        ``groups`` attributes
+        """
+        self.index = UsersIndex(self.usernames, self.passwords, self.roles, self.groups)
+        return self.index
+
+    def get_index(self):
+        index = self.index
+        if index is None:
+            index = self.build_index()
+        return index
+
+    def _user(self, username):
+        """
+        Returns the index and the user's row in it, raising an exception if the user 
+        doesn't exist
+        """
+        index = self.get_index()
+        username = username.lower()
+        row = index.find(username)
+        if row is None:
+            raise AuthKitNoSuchUserError("No user named %r"%username)
+        return index, row
 
     # Existence Methods
     def user_exists(self, username):
         """
         Returns ``True`` if a user exists with the given username, ``False`` otherwise. Usernames are case insensitive.
         """
-        return username.lower() in self.list_users()
+        return self.get_index().find(username.lower()) is not None
         
     def role_exists(self, role):
         """
         Returns ``True`` if the role exists, ``False`` otherwise. Roles are case insensitive.
         """
-        return role.lower() in self.list_roles()
+        return role.lower() in self.get_index().role_set
         
     def group_exists(self, group):
         """
         Returns ``True`` if the group exists, ``False`` otherwise. Groups are case insensitive.
         """
-        return group.lower() in self.list_groups()
+        return group.lower() in self.get_index().group_set
         
     # List Methods
     def list_roles(self):
         """
         Returns a lowercase list of all role names ordered alphabetically
         """
-        roles = []
-        for k,v in self.roles.items():
-            for role in v:
-                role_ = role.lower()
-                if role_ and role_ not in roles:
-                    roles.append(role_)
-        roles.sort()
-        return roles
+        return list(self.get_index().role_list)
         
     def list_users(self):
         """
         Returns a lowecase list of all usernames ordered alphabetically
         """
         # Return a copy in case someone starts modifying it.
-        return [u for u in self.usernames]
+        return list(self.get_index().user_list)
 
     def list_groups(self):
         """
         Returns a lowercase list of all groups ordered alphabetically
         """
-        groups = []
-        for k,v in self.groups.items():
-            if v and v not in groups:
-                groups.append(v)
-        groups.sort()
-        return groups
+        return list(self.get_index().group_list)
 
     # User Methods
     def user(self, username):
@@ -475,58 +990,55 @@ class UsersReadOnly(Users):
         The role names are ordered alphabetically
         Raises an exception if the user doesn't exist.
         """    
-        username = username.lower()
-        if not username in self.usernames:
-            raise AuthKitNoSuchUserError("No user named %r"%username)
-        else:
-            return {
-                'username': username,
-                'group':    self.user_group(username),
-                'password': self.user_password(username),
-                'roles':    self.user_roles(username),
-            }
+        index, row = self._user(username)
+        return _user_dict(index, row)
         
     def user_roles(self, username):
         """
         Returns a list of all the role names for the given username ordered alphabetically. Raises an exception if
         the username doesn't exist.
         """
-        username = username.lower()
-        if not username in self.usernames:
-            raise AuthKitNoSuchUserError("No user named %r"%username)
-        return self.roles[username]
+        index, row = self._user(username)
+        return index.roles_of(row)
+
+    def user_role_set(self, username):
+        """
+        Returns a ``frozenset`` of the lowercase role names for the given username. Raises an 
+        exception if the username doesn't exist.
+        """
+        index, row = self._user(username)
+        return index.role_set_of(row)
         
     def user_group(self, username):
         """
         Returns the group associated with the user or ``None`` if no group is associated.
         Raises an exception is the user doesn't exist.
         """
-        username = username.lower()
-        if not username in self.usernames:
-            raise AuthKitNoSuchUserError("No user named %r"%username)
-        return self.groups[username]
+        index, row = self._user(username)
+        return index.group_of(row)
 
     def user_password(self, username):
         """
         Returns the password associated with the user or ``None`` if no password exists.
         Raises an exception is the user doesn't exist.
         """
-        username = username.lower()
-        if not username in self.usernames:
-            raise AuthKitNoSuchUserError("No user named %r"%username)
-        return self.passwords[username]
+        index, row = self._user(username)
+        return index.password_of(row)
         
     def user_has_role(self, username, role):
         """
         Returns ``True`` if the user has the role specified, ``False`` otherwise. Raises an exception if the user doesn't exist.
         """
-        return role.lower() in self.user_roles(username)
+        return role.lower() in self.user_role_set(username)
         
     def user_has_group(self, username, group):
         """
-        Returns ``True`` if the user has the group specified, ``False`` otherwise. Raises an exception if the user doesn't exist.
+        Returns ``True`` if the user has the group specified, ``False`` otherwise. The value for ``group`` can be ``None`` to test that the user doesn't belong to a group. Raises an exception if the user doesn't exist.
         """
-        return group.lower() == self.user_group(username.lower())
+        user_group = self.user_group(username.lower())
+        if group is None:
+            return user_group is None
+        return group.lower() == user_group
 
     def user_has_password(self, username, password):
         """
@@ -535,73 +1047,186 @@ class UsersReadOnly(Users):
         Raises an exception if the user doesn't exist.
         """
         return self.encrypt(password) == self.user_password(username.lower())
+
+    # Bulk Methods
+    def users_bulk(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the dictionary returned by ``user()`` 
+        for each user in ``usernames`` which exists. Users which don't exist are left out.
+        """
+        index = self.get_index()
+        result = {}
+        for username in usernames:
+            username = username.lower()
+            row = index.find(username)
+            if row is not None:
+                result[username] = _user_dict(index, row)
+        return result
+
+    def users_with_role(self, role):
+        """
+        Returns a list of the lowercase usernames of the users with the role specified ordered 
+        alphabetically. Raises an ``AuthKitNoSuchRoleError`` if the role doesn't exist.
+        """
+        index = self.get_index()
+        role = role.lower()
+        if role not in index.role_set:
+            raise AuthKitNoSuchRoleError("No such role %r"%role)
+        return list(index.users_with_role(role))
+
+    def users_in_group(self, group):
+        """
+        Returns a list of the lowercase usernames of the users in the group specified ordered 
+        alphabetically. Raises an ``AuthKitNoSuchGroupError`` if the group doesn't exist.
+        """
+        index = self.get_index()
+        group = group.lower()
+        if group not in index.group_set:
+            raise AuthKitNoSuchGroupError("No such group %r"%group)
+        return list(index.users_in_group(group))
+
+    def roles_for_users(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the list returned by ``user_roles()``
+        for each user in ``usernames`` which exists. Users which don't exist are left out.
+        """
+        index = self.get_index()
+        result = {}
+        for username in usernames:
+            username = username.lower()
+            row = index.find(username)
+            if row is not None:
+                result[username] = index.roles_of(row)
+        return result
+
+def _user_dict(index, row):
+    # The dictionary returned by user() for a row of an index
+    return {
+        'username': index.username_of(row),
+        'group':    index.group_of(row),
+        'password': index.password_of(row),
+        'roles':    index.roles_of(row),
+    }
         
-def parse(data):
-    """
-    Parses the user data
-    """
-    passwords = {}
-    roles = {}
-    groups = {}
-    counter = 1
-    for line in data.split('\n'):
+def _intern(name):
+    # Roles and groups are shared by many users so keep one copy of each
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
+def _parse_records(lines):
+    # Yields (lineno, username, password, group, roles) for each user in
+    # lines, checking everything except that usernames are unique
+    lineno = 0
+    for line in lines:
+        lineno += 1
         line = line.strip()
         if not line:
             continue
-        role_list = []
+        # Fields are separated by single spaces, extra spaces are ignored
         parts = line.split(' ')
-        if len(parts) > 1:
-            for role in parts[1:]:
-                if role:
-                    role_list.append(role.strip().lower())
-        role_list.sort()
-        group = None
-        parts = parts[0].split(':')
-        if len(parts) > 1:
-            password = parts[1]
-            if not password:
-                'Password for %s is empty'%(
-                    username,
-                )
-            username = parts[0].lower()
-            if not username:
-                'Username on line %s is empty'%(
-                    counter,
-                )
-        if len(parts) == 3:
-            group = parts[2].lower()
-        if len(parts) <= 1 or len(parts) > 3:
+        fields = parts[0].split(':')
+        if len(fields) < 2 or len(fields) > 3:
             raise AuthKitConfigError(
                 'Syntax error on line %s of authenticate list'%(
-                    counter,
+                    lineno,
                 )
             )
-        if passwords.has_key(username):
+        username = fields[0].lower()
+        if not username:
             raise AuthKitConfigError(
-                'Username %r defined twice in authenticate list %r'%(
+                'Username on line %s of authenticate list is empty'%(
+                    lineno,
+                )
+            )
+        password = fields[1]
+        if not password:
+            raise AuthKitConfigError(
+                'Password for %r on line %s of authenticate list is empty'%(
                     username,
-                    passwords
+                    lineno,
                 )
             )
-        else:
-            passwords[username] = password
-        if role_list:
-            roles[username] = role_list
-        if group:
-            groups[username] = group
-        counter += 1
+        group = None
+        if len(fields) == 3 and fields[2]:
+            group = _intern(fields[2].lower())
+        role_list = [
+            _intern(role.strip().lower()) for role in parts[1:] if role
+        ]
+        role_list.sort()
+        yield lineno, username, password, group, role_list
+
+def _duplicate_error(username, lineno):
+    return AuthKitConfigError(
+        'Username %r on line %s is already defined in authenticate '
+        'list'%(
+            username,
+            lineno,
+        )
+    )
+
+def parse_lines(lines):
+    """
+    Parses user data from ``lines``, which can be any iterable of lines 
+    including an open file, in a single pass.
+
+    Returns ``(usernames, passwords, roles, groups)`` as described in 
+    ``UsersReadOnly``. Raises an ``AuthKitConfigError`` giving the line number 
+    if a line is badly formatted, has an empty username or password or 
+    repeats a username.
+    """
+    passwords = {}
+    roles = {}
+    groups = {}
+    for lineno, username, password, group, role_list in _parse_records(lines):
+        if passwords.has_key(username):
+            raise _duplicate_error(username, lineno)
+        passwords[username] = password
+        groups[username] = group
+        roles[username] = role_list
     usernames = passwords.keys()
     usernames.sort()
-    for username in usernames:
-        if not passwords.has_key(username):
-            raise AuthKitError('No password specified for user %r'%username)
-        if not roles.has_key(username):
-            roles[username] = []
-        if not groups.has_key(username):
-            groups[username] = None
-    assert len(usernames) == len(passwords) == len(roles) == len(groups)
     return usernames, passwords, roles, groups
 
+def parse_table(lines):
+    """
+    Parses user data from ``lines`` in the same way as ``parse_lines()`` but 
+    returns a ``UsersTable``.
+    """
+    # Collect the fields in columns rather than a tuple and a list of roles 
+    # per user, which for large files leaves memory fragmented afterwards
+    usernames = []
+    linenos = array('L')
+    passwords = []
+    groups = []
+    roles = []
+    role_offsets = array('L', [0])
+    for lineno, username, password, group, role_list in _parse_records(lines):
+        usernames.append(username)
+        linenos.append(lineno)
+        passwords.append(password)
+        groups.append(group)
+        roles.extend(role_list)
+        role_offsets.append(len(roles))
+    order = range(len(usernames))
+    # The sort is stable so a repeated username is reported on its second 
+    # line
+    order.sort(key=usernames.__getitem__)
+    for n in range(1, len(order)):
+        if usernames[order[n]] == usernames[order[n-1]]:
+            raise _duplicate_error(usernames[order[n]], linenos[order[n]])
+    return UsersTable(
+        (usernames[i], passwords[i], groups[i], 
+         roles[role_offsets[i]:role_offsets[i+1]])
+        for i in order
+    )
+
+def parse(data):
+    """
+    Parses the user data in the string ``data``. See ``parse_lines()``.
+    """
+    return parse_lines(data.split('\n'))
+
 class UsersFromString(UsersReadOnly):
     """
     A ``Users`` class which cbtains user information from a string with lines
@@ -612,6 +1237,7 @@ class UsersFromString(UsersReadOnly):
     stripped.  """ 
     def __init__(self, data, encrypt=None):
         self.usernames, self.passwords, self.roles, self.groups = parse(data)
+        self.build_index()
         if encrypt is None:
             def encrypt(password):
                 return password
@@ -628,15 +1254,874 @@ class UsersFromFile(UsersReadOnly):
             def encrypt(password):
                 return password
         self.encrypt = encrypt
-        string = None
-        fp = None
+        self.filename = filename
+        self.usernames, self.passwords, self.roles, self.groups = self.parse_file()
+        self.build_index()
+
+    def parse_file(self):
+        """
+        Parses ``self.filename`` returning the same data as ``parse()``
+        """
+        if not os.path.isfile(self.filename):
+            raise AuthKitError('File does not exist %r'%self.filename)
+        fp = open(self.filename, 'r')
+        try:
+            return parse_lines(fp)
+        finally:
+            fp.close()
+
+class CompactUsersFromString(UsersReadOnly):
+    """
+    Like ``UsersFromString`` but the users are stored in a ``UsersTable``, 
+    which uses much less memory for very large numbers of users at the cost
+    of slightly slower lookups. There are no ``usernames``, ``passwords``, 
+    ``roles`` or ``groups`` attributes; use the ``Users`` API instead.
+    """
+    def __init__(self, data, encrypt=None):
+        if encrypt is None:
+            def encrypt(password):
+                return password
+        self.encrypt = encrypt
+        self.index = parse_table(data.split('\n'))
+
+    def build_index(self):
+        return self.index
+
+class CompactUsersFromFile(UsersFromFile):
+    """
+    Like ``UsersFromFile`` but the users are stored in a ``UsersTable``. See
+    ``CompactUsersFromString``.
+    """
+    def __init__(self, filename, encrypt=None):
+        if encrypt is None:
+            def encrypt(password):
+                return password
+        self.encrypt = encrypt
+        self.filename = filename
+        self.index = self.parse_file()
+
+    def build_index(self):
+        return self.index
+
+    def parse_file(self):
+        """
+        Parses ``self.filename`` returning a ``UsersTable``
+        """
+        if not os.path.isfile(self.filename):
+            raise AuthKitError('File does not exist %r'%self.filename)
+        fp = open(self.filename, 'r')
+        try:
+            return parse_table(fp)
+        finally:
+            fp.close()
+
+def _watch(ref, interval, stopped):
+    while True:
+        stopped.wait(interval)
+        users = ref()
+        if users is None or stopped.isSet():
+            break
+        users.check()
+        del users
+
+class ReloadingUsersFromFile(UsersFromFile):
+    """
+    Like ``UsersFromFile`` except that the file is reloaded when it changes.
+
+    A daemon thread checks the file's modification time and size every 
+    ``reload_interval`` seconds (5 by default) and, if either has changed, 
+    parses the file and builds a new ``UsersIndex``. The new index replaces
+    the old one in a single assignment so requests see either the old users
+    or the new ones, never a mixture, and never wait for the file to be 
+    parsed. If the new file can't be read or parsed the error is logged and
+    the previous users are kept.
+
+    The thread is started when the users are first looked up in each 
+    process rather than when the object is created, so an object created 
+    before a server forks its workers still has a thread in every worker.
+
+    If ``reload_interval`` is ``0`` no thread is started and ``check()`` or 
+    ``reload()`` must be called to pick up changes. ``stop()`` ends the 
+    thread, which is available as the ``thread`` attribute once started. 
+    The ``usernames``, ``passwords``, ``roles`` and ``groups`` attributes 
+    are read from the current index.
+    """
+    reload_interval = 5
+
+    def __init__(self, filename, encrypt=None, reload_interval=None):
+        if encrypt is None:
+            def encrypt(password):
+                return password
+        self.encrypt = encrypt
+        self.filename = filename
+        if reload_interval is not None:
+            self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.signature = self.file_signature()
+        self.index = UsersIndex(*self.parse_file())
+        self.stopped = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+
+    def start(self):
+        """
+        Starts the thread which watches the file unless it is already running
+        in this process
+        """
+        self.lock.acquire()
         try:
-            if not os.path.exists(filename) and os.path.isfile(filename):
-                raise AuthKitError('File does not exist %r'%filename)
-            fp = open(filename, 'r')
-            string = fp.read()
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            self.thread = threading.Thread(
+                target=_watch, 
+                name='authkit-users-%s'%os.path.basename(self.filename),
+                args=(weakref.ref(self), self.reload_interval, self.stopped),
+            )
+            self.thread.setDaemon(True)
+            self.thread.start()
         finally:
-            if fp:
-                fp.close()
-        self.usernames, self.passwords, self.roles, self.groups = parse(string)
+            self.lock.release()
+
+    def usernames(self):
+        return self.get_index().usernames
+    usernames = property(usernames)
+
+    def passwords(self):
+        return self.get_index().passwords
+    passwords = property(passwords)
+
+    def roles(self):
+        return self.get_index().roles
+    roles = property(roles)
 
+    def groups(self):
+        return self.get_index().groups
+    groups = property(groups)
+
+    def build_index(self):
+        return self.index
+
+    def get_index(self):
+        if self.reload_interval > 0 and self.thread_pid != os.getpid():
+            self.start()
+        return self.index
+
+    def file_signature(self):
+        """
+        Returns the modification time and size of the file or ``None`` if it 
+        can't be read
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def check(self):
+        """
+        Reloads the file if it has changed. Returns ``True`` if new users 
+        were loaded.
+        """
+        if self.file_signature() == self.signature:
+            return False
+        return self.reload()
+
+    def reload(self):
+        """
+        Parses the file and swaps in the new users. Returns ``False`` and 
+        keeps the previous users if the file can't be read or parsed.
+        """
+        self.lock.acquire()
+        try:
+            signature = self.file_signature()
+            try:
+                index = UsersIndex(*self.parse_file())
+            except Exception, e:
+                # Don't try again until the file changes
+                self.signature = signature
+                log.error("Could not reload the users from %r, keeping the "
+                          "previous users: %s", self.filename, e)
+                return False
+            self.index = index
+            self.signature = signature
+        finally:
+            self.lock.release()
+        log.info("Reloaded %s users from %r", len(index.user_list), self.filename)
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+#
+# Caching
+#
+
+_missing = object()
+
+class UsersCache(object):
+    """
+    A thread safe least recently used cache of at most ``size`` entries, 
+    each of which expires ``ttl`` seconds after it was stored.
+
+    Entries are kept in a dictionary and a circular doubly linked list, 
+    most recently used first, so lookups, stores and evictions are all 
+    constant time. ``stats()`` returns the number of hits, misses, 
+    evictions, expired entries and invalidations along with the current 
+    size.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        # Each link is [previous, next, key, value, expires]
+        self.root = root = []
+        root[:] = [root, root, None, None, None]
+        self.links = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    def get(self, key, default=_missing):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            if link[4] <= time.time():
+                self._remove(link)
+                self.expired += 1
+                self.misses += 1
+                return default
+            # Move the link to the front
+            link[0][1] = link[1]
+            link[1][0] = link[0]
+            root = self.root
+            link[0] = root
+            link[1] = root[1]
+            root[1][0] = link
+            root[1] = link
+            self.hits += 1
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, ttl):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                self._remove(link)
+            elif len(self.links) >= self.size:
+                # Evict the least recently used entry from the back
+                self._remove(self.root[0])
+                self.evictions += 1
+            root = self.root
+            link = [root, root[1], key, value, time.time() + ttl]
+            root[1][0] = link
+            root[1] = link
+            self.links[key] = link
+        finally:
+            self.lock.release()
+
+    def _remove(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        del self.links[link[2]]
+
+    def invalidate(self, *keys):
+        self.lock.acquire()
+        try:
+            for key in keys:
+                link = self.links.get(key)
+                if link is not None:
+                    self._remove(link)
+                    self.invalidations += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.invalidations += len(self.links)
+            self.links.clear()
+            self.root[:] = [self.root, self.root, None, None, None]
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+            'invalidations': self.invalidations,
+            'size': len(self.links),
+        }
+
+# The cached methods which take a username
+_user_methods = dict.fromkeys([
+    'user_exists',
+    'user', 
+    'user_roles', 
+    'user_role_set', 
+    'user_group', 
+    'user_password',
+])
+
+# Stands in for the result of a lookup which found no such user
+_no_such_user = object()
+
+class UsernameFilter(object):
+    """
+    A Bloom filter of lowercase usernames.
+
+    ``name in filter`` is always ``True`` for a username which has been 
+    added and is ``False`` for most which haven't, so a ``False`` answer 
+    means the user definitely doesn't exist. ``error_rate`` is the 
+    proportion of other usernames for which it should be ``True`` once
+    ``capacity`` usernames have been added. ``capacity`` defaults to the
+    number of ``usernames`` plus some room for users created later.
+
+    Usernames can't be removed so the filter should be rebuilt now and then.
+    """
+    def __init__(self, usernames=(), error_rate=0.01, capacity=None):
+        usernames = list(usernames)
+        if capacity is None:
+            capacity = len(usernames) + len(usernames)//10 + 1000
+        # The optimal number of bits and hash functions for the error rate
+        self.bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2)**2
+        ))
+        self.hashes = max(1, int(round(
+            float(self.bits) / capacity * math.log(2)
+        )))
+        self.array = array('B', [0]) * ((self.bits + 7) // 8)
+        self.count = 0
+        for username in usernames:
+            self.add(username)
+
+    def positions(self, username):
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        # Double hashing with the two halves of an MD5 digest
+        first, second = struct.unpack(
+            '<QQ', 
+            _md5.new(username.lower()).digest(),
+        )
+        return [
+            (first + i*second) % self.bits for i in range(self.hashes)
+        ]
+
+    def add(self, username):
+        array = self.array
+        for position in self.positions(username):
+            array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, username):
+        array = self.array
+        for position in self.positions(username):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def error_rate(self):
+        """
+        Returns the estimated false positive rate for the usernames added
+        """
+        return (
+            1 - math.exp(-float(self.hashes) * self.count / self.bits)
+        ) ** self.hashes
+
+class _CacheState(object):
+    # The cache and username filter shared by CachedUsers objects
+    def __init__(self, cache, method_ttls, factory, filter_interval, 
+                 filter_error_rate, users=None):
+        self.cache = cache
+        self.method_ttls = method_ttls
+        self.factory = factory
+        self.users = users
+        self.filter_interval = filter_interval
+        self.filter_error_rate = filter_error_rate
+        self.filter = None
+        self.filter_built = 0
+        self.filter_ready = threading.Event()
+        self.filter_lock = threading.Lock()
+        self.filter_pid = None
+        self.filter_stopped = threading.Event()
+        self.filter_rejections = 0
+        self.filter_false_positives = 0
+
+    def build_filter(self):
+        """
+        Replaces the filter with one built from the wrapped object's 
+        ``list_users()``, keeping the previous one if that fails
+        """
+        users = self.users
+        if users is None:
+            users = self.factory(None)
+        try:
+            self.filter = UsernameFilter(
+                users.list_users(), 
+                self.filter_error_rate,
+            )
+        except Exception, e:
+            log.error("Could not build the username filter, keeping the "
+                      "previous one: %s", e)
+        self.filter_built = time.time()
+        self.filter_ready.set()
+
+    def start_filter(self):
+        """
+        Starts the thread which builds the filter, once in each process
+        """
+        self.filter_lock.acquire()
+        try:
+            if self.filter_pid == os.getpid():
+                return
+            self.filter_pid = os.getpid()
+            thread = threading.Thread(
+                target=_refresh_filter, 
+                name='authkit-username-filter',
+                args=(weakref.ref(self), self.filter_interval, 
+                      self.filter_stopped),
+            )
+            thread.setDaemon(True)
+            thread.start()
+        finally:
+            self.filter_lock.release()
+
+def _refresh_filter(ref, interval, stopped):
+    while not stopped.isSet():
+        state = ref()
+        if state is None:
+            break
+        state.build_filter()
+        del state
+        stopped.wait(interval)
+
+_filter_states = weakref.WeakKeyDictionary()
+
+def _stop_filters():
+    # Stop the threads before the interpreter starts tearing down modules
+    for state in _filter_states.keys():
+        state.filter_stopped.set()
+atexit.register(_stop_filters)
+
+class CachedUsers(Users):
+    """
+    Wraps any ``Users`` object and caches the results of its read methods 
+    so that repeated checks, such as the ``user_exists()`` and 
+    ``user_roles()`` calls made on every request by the permissions, don't 
+    each become a database query.
+
+    ``users`` is the object to wrap. ``ttl`` is either the number of seconds
+    to keep every result for or a dictionary of method names to seconds, 
+    which overrides the defaults in ``ttls``. A method with a ``ttl`` of 
+    ``0`` isn't cached. At most ``size`` results are kept, the least 
+    recently used being dropped first. Failed lookups such as a missing 
+    user, and ``user_exists()`` returning ``False``, are not cached.
+    ``user()`` and ``user_password()`` are only cached if they are given a
+    ``ttl`` and ``user_has_password()`` always asks the wrapped object, so
+    password hashes aren't kept in the cache by default.
+
+    Changes made through the ``CachedUsers`` object invalidate the results
+    they affect. Changes made any other way are only seen once the results 
+    expire, or after ``clear()`` is called. ``stats()`` returns the cache
+    statistics.
+
+    ``CachedUsers`` can also be used as the ``user.type`` in a config file.
+    The first line of ``user.data`` is then the type of the users object to 
+    wrap, optionally followed by ``ttl=`` and ``size=`` options, and the 
+    remaining lines are that object's own data::
+
+        authkit.form.authenticate.user.type = authkit.users:CachedUsers
+        authkit.form.authenticate.user.data = authkit.users.postgresql_driver:UsersDriver ttl=30
+            myapp.model:get_conn
+            myapp.model:release_conn
+
+    Objects with the same ``user.data`` share one cache. Wrapped 
+    ``api_version = 0.4`` drivers are created according to their 
+    ``instance_scope``, and then only when a result isn't in the cache.
+
+    If ``filter_interval`` is given (``filter=`` in the config) a 
+    ``UsernameFilter`` of all the users is built from ``list_users()`` by a
+    daemon thread, started on first use in each process, and rebuilt every
+    ``filter_interval`` seconds. Until the first filter is ready every
+    username is passed to the wrapped object. Usernames which
+    aren't in it are rejected without calling the wrapped object, so 
+    requests with made up usernames neither reach the database nor push real
+    users out of the cache. Users created through the ``CachedUsers`` 
+    object are added to the filter straight away but users created any 
+    other way aren't recognised until the filter is rebuilt. 
+    ``filter_error_rate`` (``error_rate=``) is the target false positive 
+    rate and ``stats()`` reports the estimated and observed rates.
+    """
+    api_version = 0.4
+    instance_scope = 'request'
+
+    size = 10000
+    ttls = {
+        'user_exists': 60,
+        'role_exists': 300,
+        'group_exists': 300,
+        'list_users': 60,
+        'list_roles': 300,
+        'list_groups': 300,
+        'user_roles': 60,
+        'user_role_set': 60,
+        'user_group': 60,
+    }
+
+    filter_error_rate = 0.01
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, users=None, ttl=None, size=None, filter_interval=None,
+                 filter_error_rate=None, environ=None, data=None, 
+                 encrypt=None):
+        self.environ = environ
+        if users is not None:
+            self._users = users
+            self.encrypt = users.encrypt
+            self.state = self._make_state(
+                ttl, 
+                size, 
+                filter_interval, 
+                filter_error_rate,
+                users=users,
+            )
+        else:
+            self._users = None
+            self.state = self._configure(data, encrypt)
+            if encrypt is None:
+                def encrypt(password):
+                    return password
+            self.encrypt = encrypt
+        self.cache = self.state.cache
+        self.method_ttls = self.state.method_ttls
+
+    def _make_state(self, ttl, size, filter_interval, filter_error_rate, 
+                    factory=None, users=None):
+        method_ttls = self.ttls.copy()
+        if isinstance(ttl, dict):
+            method_ttls.update(ttl)
+        elif ttl is not None:
+            for name in method_ttls.keys():
+                method_ttls[name] = ttl
+        state = _CacheState(
+            UsersCache(size or self.size), 
+            method_ttls, 
+            factory, 
+            filter_interval,
+            filter_error_rate or self.filter_error_rate,
+            users,
+        )
+        if filter_interval:
+            _filter_states[state] = True
+        return state
+
+    def _configure(self, data, encrypt):
+        if not data:
+            raise AuthKitConfigError(
+                'No users type to cache was given in the user data'
+            )
+        self._shared_lock.acquire()
+        try:
+            if not self._shared.has_key((data, encrypt)):
+                lines = data.strip().split('\n')
+                options = lines[0].split()
+                users_type = eval_import(options[0])
+                values = {}
+                for option in options[1:]:
+                    try:
+                        name, value = option.split('=')
+                        if name in ['ttl', 'filter', 'error_rate']:
+                            values[name] = float(value)
+                        elif name == 'size':
+                            values[name] = int(value)
+                        else:
+                            raise ValueError(name)
+                    except ValueError:
+                        raise AuthKitConfigError(
+                            'Unknown CachedUsers option %r'%option
+                        )
+                users_data = '\n'.join(lines[1:]).strip() or None
+                if getattr(users_type, 'api_version', None) == 0.4:
+                    factory = AddUsersObjectToEnviron(
+                        None, 
+                        'authkit.users', 
+                        users_type, 
+                        encrypt=encrypt,
+                        data=users_data,
+                    ).get_users
+                else:
+                    users = users_type(users_data, encrypt)
+                    def factory(environ):
+                        return users
+                self._shared[(data, encrypt)] = self._make_state(
+                    values.get('ttl'), 
+                    values.get('size'), 
+                    values.get('filter'),
+                    values.get('error_rate'),
+                    factory,
+                )
+            return self._shared[(data, encrypt)]
+        finally:
+            self._shared_lock.release()
+
+    def users(self):
+        """
+        The wrapped users object, created the first time it is needed
+        """
+        if self._users is None:
+            self._users = self.state.factory(self.environ)
+        return self._users
+    users = property(users)
+
+    def get_filter(self):
+        """
+        Returns the ``UsernameFilter`` of the wrapped object's users or 
+        ``None`` if there isn't one or it isn't ready yet. The first call in
+        a process starts the thread which builds it so requests never wait 
+        for ``list_users()``.
+        """
+        state = self.state
+        if not state.filter_interval:
+            return None
+        if state.filter_pid != os.getpid():
+            state.start_filter()
+        return state.filter
+
+    def _filter_add(self, *usernames):
+        filter = self.state.filter
+        if filter is not None:
+            for username in usernames:
+                filter.add(username)
+
+    def _cached(self, name, *args):
+        ttl = self.method_ttls.get(name)
+        if not ttl:
+            return getattr(self.users, name)(*args)
+        key = (name,) + tuple([arg.lower() for arg in args])
+        value = self.cache.get(key)
+        if value is _missing:
+            filter = None
+            if _user_methods.has_key(name):
+                filter = self.get_filter()
+            # Usernames the filter has never seen are rejected without 
+            # asking the wrapped object or filling the cache with them
+            if filter is not None and key[1] not in filter:
+                self.state.filter_rejections += 1
+                if name == 'user_exists':
+                    return False
+                raise AuthKitNoSuchUserError("No such user %r"%key[1])
+            try:
+                value = getattr(self.users, name)(*args)
+            except AuthKitNoSuchUserError:
+                value = _no_such_user
+            if filter is not None and (value is _no_such_user or 
+                                       name == 'user_exists' and not value):
+                # The filter let through a username which doesn't exist
+                self.state.filter_false_positives += 1
+            if value is _no_such_user:
+                raise AuthKitNoSuchUserError("No such user %r"%key[1])
+            if name == 'user_exists' and not value:
+                # Not cached so users created elsewhere are seen straight away
+                return value
+            self.cache.set(key, value, ttl)
+        if isinstance(value, list):
+            # Callers are free to change the lists they are given
+            value = value[:]
+        elif isinstance(value, dict):
+            value = value.copy()
+            value['roles'] = value['roles'][:]
+        return value
+
+    def invalidate_user(self, *usernames):
+        """
+        Removes the cached results for the users named, and the list of users
+        """
+        keys = [('list_users',)]
+        for username in usernames:
+            for name in _user_methods:
+                keys.append((name, username.lower()))
+        self.cache.invalidate(*keys)
+
+    def clear(self):
+        """
+        Removes all the cached results
+        """
+        self.cache.clear()
+
+    def stats(self):
+        """
+        Returns the ``UsersCache`` statistics. If there is a username filter
+        they also include its size, the number of usernames it rejected, 
+        the number of usernames it let through which didn't exist, its
+        estimated false positive rate and the rate observed so far. The 
+        filter counts aren't locked so they are approximate.
+        """
+        stats = self.cache.stats()
+        state = self.state
+        if state.filter is not None:
+            checked = state.filter_rejections + state.filter_false_positives
+            observed = 0.0
+            if checked:
+                observed = float(state.filter_false_positives) / checked
+            stats.update({
+                'filter_users': state.filter.count,
+                'filter_rejections': state.filter_rejections,
+                'filter_false_positives': state.filter_false_positives,
+                'filter_estimated_error_rate': state.filter.error_rate(),
+                'filter_observed_error_rate': observed,
+            })
+        return stats
+
+    # Create Methods
+    def user_create(self, username, password, group=None):
+        self.users.user_create(username, password, group)
+        self.invalidate_user(username)
+        self._filter_add(username)
+
+    def role_create(self, role):
+        self.users.role_create(role)
+        self.cache.invalidate(('role_exists', role.lower()), ('list_roles',))
+
+    def group_create(self, group):
+        self.users.group_create(group)
+        self.cache.invalidate(('group_exists', group.lower()), ('list_groups',))
+
+    # Delete Methods
+    def user_delete(self, username):
+        self.users.user_delete(username)
+        self.invalidate_user(username)
+
+    def role_delete(self, role):
+        self.users.role_delete(role)
+        self.cache.invalidate(('role_exists', role.lower()), ('list_roles',))
+
+    def group_delete(self, group):
+        self.users.group_delete(group)
+        self.cache.invalidate(('group_exists', group.lower()), ('list_groups',))
+
+    def role_delete_cascade(self, role):
+        # Any user might have had the role
+        self.users.role_delete_cascade(role)
+        self.clear()
+
+    def group_delete_cascade(self, group):
+        self.users.group_delete_cascade(group)
+        self.clear()
+
+    # Existence Methods
+    def user_exists(self, username):
+        return self._cached('user_exists', username)
+
+    def role_exists(self, role):
+        return self._cached('role_exists', role)
+
+    def group_exists(self, group):
+        return self._cached('group_exists', group)
+
+    # List Methods
+    def list_roles(self):
+        return self._cached('list_roles')
+
+    def list_users(self):
+        return self._cached('list_users')
+
+    def list_groups(self):
+        return self._cached('list_groups')
+
+    # User Methods
+    def user(self, username):
+        return self._cached('user', username)
+
+    def user_roles(self, username):
+        return self._cached('user_roles', username)
+
+    def user_role_set(self, username):
+        return self._cached('user_role_set', username)
+
+    def user_group(self, username):
+        return self._cached('user_group', username)
+
+    def user_password(self, username):
+        return self._cached('user_password', username)
+
+    def user_has_role(self, username, role):
+        return role.lower() in self.user_role_set(username)
+
+    def user_has_group(self, username, group):
+        # Drivers differ in whether an unknown group raises an exception
+        if group is not None and not self.group_exists(group):
+            return self.users.user_has_group(username, group)
+        user_group = self.user_group(username)
+        if group is None:
+            return user_group is None
+        return group.lower() == user_group
+
+    def user_has_password(self, username, password):
+        return self.users.user_has_password(username, password)
+
+    # Bulk Methods
+    def users_bulk(self, usernames):
+        return self.users.users_bulk(usernames)
+
+    def users_with_role(self, role):
+        return self.users.users_with_role(role)
+
+    def users_in_group(self, group):
+        return self.users.users_in_group(group)
+
+    def roles_for_users(self, usernames):
+        return self.users.roles_for_users(usernames)
+
+    def bulk_create_users(self, records):
+        records = list(records)
+        failures = self.users.bulk_create_users(records)
+        usernames = [r['username'] for r in records if r.get('username')]
+        self.invalidate_user(*usernames)
+        self._filter_add(*usernames)
+        return failures
+
+    def bulk_assign_roles(self, pairs):
+        pairs = list(pairs)
+        failures = self.users.bulk_assign_roles(pairs)
+        self.invalidate_user(*[pair[0] for pair in pairs])
+        return failures
+
+    # Update Methods
+    def user_set_username(self, username, new_username):
+        self.users.user_set_username(username, new_username)
+        self.invalidate_user(username, new_username)
+        self._filter_add(new_username)
+
+    def user_set_password(self, username, new_password):
+        self.users.user_set_password(username, new_password)
+        self.invalidate_user(username)
+
+    def user_set_group(self, username, group, add_if_necessary=False):
+        self.users.user_set_group(username, group, add_if_necessary)
+        self.invalidate_user(username)
+        if add_if_necessary:
+            self.cache.invalidate(('group_exists', group.lower()), ('list_groups',))
+
+    def user_add_role(self, username, role, add_if_necessary=False):
+        self.users.user_add_role(username, role, add_if_necessary)
+        self.invalidate_user(username)
+        if add_if_necessary:
+            self.cache.invalidate(('role_exists', role.lower()), ('list_roles',))
+
+    def user_remove_role(self, username, role):
+        self.users.user_remove_role(username, role)
+        self.invalidate_user(username)
+
+    def user_remove_group(self, username):
+        self.users.user_remove_group(username)
+        self.invalidate_user(username)
@@ -0,0 +1,305 @@
+"""A precompiled binary format for large, read only user files
+
+Parsing a big ``UsersFromFile`` text file slows down the start of every
+worker process. Instead the file can be compiled once into a binary file::
+
+    authkit-compile-users users.txt users.db
+
+and loaded with ``UsersFromMmap``, which maps the file into memory and reads
+only the parts needed for each lookup. Because the file is mapped read only,
+pre-forked workers share one copy of it in the operating system's page cache.
+Set it up in the config file like this::
+
+    authkit.form.authenticate.user.type = authkit.users.binary:UsersFromMmap
+    authkit.form.authenticate.user.data = %(here)s/users.db
+
+The file is laid out as follows, with every number an unsigned 32 bit little
+endian integer:
+
+``header``
+    ``MAGIC`` followed by the number of users, roles, groups and hash buckets
+    and the offsets of the ``users``, ``role_ids``, ``buckets`` and
+    ``strings`` sections
+
+``role names``, ``group names``
+    The offset within ``strings`` and the length of each role and each group
+    name, sorted by name
+
+``users``
+    One fixed size record per user, sorted by username, holding the offset
+    and length of the username and of the password, one more than the
+    user's group number (``0`` for no group) and the position and number of
+    the user's role numbers in ``role_ids``
+
+``role_ids``
+    The role numbers of every user, each user's in order
+
+``buckets``
+    An open addressing hash table of usernames. Each bucket holds one more
+    than the user's record number, or ``0`` if it is empty. The bucket for a
+    username is its ``zlib.crc32()`` modulo the number of buckets, which is a
+    power of two, moving on to the next bucket while the bucket is in use by
+    a different username.
+
+``strings``
+    All the usernames, passwords, roles and group names
+"""
+
+from array import array
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from authkit.users import AuthKitError, UsersReadOnly, parse_table
+
+MAGIC = 'AKUSERS1'
+HEADER = '<8s8I'
+HEADER_SIZE = struct.calcsize(HEADER)
+NAME = '<2I'
+NAME_SIZE = struct.calcsize(NAME)
+USER = '<7I'
+USER_SIZE = struct.calcsize(USER)
+NUMBER = '<I'
+NUMBER_SIZE = struct.calcsize(NUMBER)
+
+def _hash(username):
+    return zlib.crc32(username) & 0xffffffff
+
+def _numbers(values):
+    # Little endian unsigned 32 bit integers
+    numbers = array('I', values)
+    if sys.byteorder == 'big':
+        numbers.byteswap()
+    return numbers.tostring()
+
+def compile_table(table):
+    """
+    Returns the binary form of the ``UsersTable`` ``table`` as a string
+    """
+    strings = []
+    size = 0
+    names = []
+    for name in table.role_list + table.group_list:
+        names.append(struct.pack(NAME, size, len(name)))
+        strings.append(name)
+        size += len(name)
+
+    users = []
+    buckets_count = 1
+    while buckets_count < 2*len(table.user_list):
+        buckets_count *= 2
+    buckets = array('I', [0]) * buckets_count
+    for row in range(len(table.user_list)):
+        username = table.user_list[row]
+        password = table.passwords[row]
+        role_start = table.role_offsets[row]
+        users.append(struct.pack(
+            USER,
+            size,
+            len(username),
+            size + len(username),
+            len(password),
+            table.group_ids[row],
+            role_start,
+            table.role_offsets[row+1] - role_start,
+        ))
+        strings.append(username)
+        strings.append(password)
+        size += len(username) + len(password)
+        bucket = _hash(username) % buckets_count
+        while buckets[bucket]:
+            bucket = (bucket + 1) % buckets_count
+        buckets[bucket] = row + 1
+
+    users_offset = HEADER_SIZE + len(names) * NAME_SIZE
+    role_ids_offset = users_offset + len(users) * USER_SIZE
+    buckets_offset = role_ids_offset + len(table.role_ids) * NUMBER_SIZE
+    strings_offset = buckets_offset + buckets_count * NUMBER_SIZE
+    return ''.join([
+        struct.pack(
+            HEADER,
+            MAGIC,
+            len(table.user_list),
+            len(table.role_list),
+            len(table.group_list),
+            buckets_count,
+            users_offset,
+            role_ids_offset,
+            buckets_offset,
+            strings_offset,
+        ),
+        ''.join(names),
+        ''.join(users),
+        _numbers(table.role_ids),
+        _numbers(buckets),
+        ''.join(strings),
+    ])
+
+def compile_users(source, destination):
+    """
+    Compiles the ``UsersFromFile`` format file ``source`` into the binary
+    file ``destination``. The file is written under a temporary name and
+    then renamed so processes never map a partly written file.
+    """
+    fp = open(source, 'r')
+    try:
+        table = parse_table(fp)
+    finally:
+        fp.close()
+    temporary = '%s.%s.tmp'%(destination, os.getpid())
+    fp = open(temporary, 'wb')
+    try:
+        fp.write(compile_table(table))
+    finally:
+        fp.close()
+    os.rename(temporary, destination)
+    return len(table.user_list)
+
+class MmapTable(object):
+    """
+    Reads the binary format from ``data``, which is usually an ``mmap``, and
+    implements the same interface as ``authkit.users.UsersTable`` for
+    ``UsersReadOnly``. A row is the number of a user's record.
+
+    Role and group names are few so they are read when the table is created.
+    Users are only read as they are looked up.
+    """
+    def __init__(self, data):
+        self.data = data
+        if len(data) < HEADER_SIZE:
+            raise AuthKitError('The binary users data is truncated')
+        header = struct.unpack(HEADER, data[:HEADER_SIZE])
+        if header[0] != MAGIC:
+            raise AuthKitError('The data is not in the AuthKit binary users format')
+        (self.users_count, roles_count, groups_count, self.buckets_count,
+         self.users_offset, self.role_ids_offset, self.buckets_offset,
+         self.strings_offset) = header[1:]
+        names = []
+        offset = HEADER_SIZE
+        for i in range(roles_count + groups_count):
+            names.append(self.string(
+                *struct.unpack(NAME, data[offset:offset+NAME_SIZE])
+            ))
+            offset += NAME_SIZE
+        self.role_list = tuple(names[:roles_count])
+        self.role_set = frozenset(self.role_list)
+        self.group_list = tuple(names[roles_count:])
+        self.group_set = frozenset(self.group_list)
+
+    def string(self, offset, length):
+        offset += self.strings_offset
+        return self.data[offset:offset+length]
+
+    def record(self, row):
+        offset = self.users_offset + row*USER_SIZE
+        return struct.unpack(USER, self.data[offset:offset+USER_SIZE])
+
+    def user_list(self):
+        return tuple([self.username_of(row) for row in range(self.users_count)])
+    user_list = property(user_list)
+
+    def find(self, username):
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+        data = self.data
+        bucket = _hash(username) % self.buckets_count
+        while True:
+            offset = self.buckets_offset + bucket*NUMBER_SIZE
+            row = struct.unpack(NUMBER, data[offset:offset+NUMBER_SIZE])[0]
+            if not row:
+                return None
+            if self.username_of(row-1) == username:
+                return row-1
+            bucket = (bucket + 1) % self.buckets_count
+
+    def username_of(self, row):
+        return self.string(*self.record(row)[0:2])
+
+    def password_of(self, row):
+        return self.string(*self.record(row)[2:4])
+
+    def group_of(self, row):
+        group_id = self.record(row)[4]
+        if group_id:
+            return self.group_list[group_id-1]
+        return None
+
+    def roles_of(self, row):
+        role_start, role_count = self.record(row)[5:7]
+        if not role_count:
+            return []
+        offset = self.role_ids_offset + role_start*NUMBER_SIZE
+        role_ids = struct.unpack(
+            '<%sI'%role_count,
+            self.data[offset:offset+role_count*NUMBER_SIZE],
+        )
+        return [self.role_list[role_id] for role_id in role_ids]
+
+    def role_set_of(self, row):
+        return frozenset(self.roles_of(row))
+
+    # These read every user so are only for occasional bulk queries
+
+    def users_with_role(self, role):
+        return [
+            self.username_of(row) for row in range(self.users_count)
+            if role in self.roles_of(row)
+        ]
+
+    def users_in_group(self, group):
+        return [
+            self.username_of(row) for row in range(self.users_count)
+            if self.group_of(row) == group
+        ]
+
+class UsersFromMmap(UsersReadOnly):
+    """
+    A read only ``Users`` class for a file compiled by ``compile_users()``.
+    The file is mapped into memory rather than read so opening it is quick
+    however many users it holds. Recompiling the file replaces it, so
+    existing ``UsersFromMmap`` objects keep using the users they opened
+    with.
+    """
+    def __init__(self, filename, encrypt=None):
+        if encrypt is None:
+            def encrypt(password):
+                return password
+        self.encrypt = encrypt
+        self.filename = filename
+        if not os.path.isfile(filename):
+            raise AuthKitError('File does not exist %r'%filename)
+        fp = open(filename, 'rb')
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            if size:
+                data = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                data = ''
+        finally:
+            fp.close()
+        self.index = MmapTable(data)
+
+    def build_index(self):
+        return self.index
+
+def main(args=None):
+    """
+    The ``authkit-compile-users`` command
+    """
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) != 2:
+        print >> sys.stderr, 'usage: authkit-compile-users SOURCE DESTINATION'
+        return 2
+    try:
+        count = compile_users(args[0], args[1])
+    except Exception, e:
+        print >> sys.stderr, 'authkit-compile-users: %s'%e
+        return 1
+    print 'Compiled %s users into %s'%(count, args[1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,8 +16,13 @@ def authkit_release_conn(conn):
 class UsersDriver(Users):
     """
     Raw SQL Version
+
+    Connections are obtained from the ``get_conn()`` function for each call 
+    rather than from the ``environ`` so one instance is shared by all the 
+    requests in a process.
     """
     api_version = 0.4
+    instance_scope = 'process'
 
     def __init__(self, environ, data, encrypt=None):
         if encrypt is None:
@@ -354,29 +359,34 @@ class UsersDriver(Users):
 
         Role names are ordered alphabetically
         Raises an exception if the user doesn't exist.
+
+        The user, their group and their roles are fetched together in one
+        query with a row for each role.
         """
-        if not self.user_exists(username.lower()):
-            raise AuthKitNoSuchUserError("No such user %r"%username.lower())
         conn = self.get_conn()
         cursor = conn.cursor()
         cursor.execute(
             """
-            SELECT username, name, password FROM users 
-            LEFT OUTER JOIN groups on users.group_uid=groups.uid
+            SELECT users.username, groups.name, users.password, roles.name 
+            FROM users
+            LEFT OUTER JOIN groups ON users.group_uid = groups.uid
+            LEFT OUTER JOIN users_roles ON users.uid = users_roles.user_uid
+            LEFT OUTER JOIN roles ON users_roles.role_uid = roles.uid
             WHERE users.username=%s
-            ORDER BY username
+            ORDER BY roles.name
             """,
             (username.lower(),)
         )
-        rows = cursor.fetchall()[0]
+        rows = cursor.fetchall()
         cursor.close()
         self.release_conn(conn)
-        
+        if not rows:
+            raise AuthKitNoSuchUserError("No such user %r"%username.lower())
         return {
-            'username': rows[0],
-            'group':    rows[1],
-            'password': rows[2],
-            'roles':    self.user_roles(username)
+            'username': rows[0][0],
+            'group':    rows[0][1],
+            'password': rows[0][2],
+            'roles':    [row[3] for row in rows if row[3] is not None],
         }
 
     def user_roles(self, username):
@@ -403,6 +413,32 @@ class UsersDriver(Users):
         self.release_conn(conn)
         return [x[0] for x in rows]
         
+    def user_role_set(self, username):
+        """
+        Returns a ``frozenset`` of the lowercase role names for the given 
+        username. Raises an exception if the username doesn't exist.
+
+        The user and their roles are fetched together in one query with a row
+        for each role.
+        """
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT users.uid, roles.name FROM users
+            LEFT OUTER JOIN users_roles ON users.uid = users_roles.user_uid
+            LEFT OUTER JOIN roles ON users_roles.role_uid = roles.uid
+            WHERE users.username=%s
+            """,
+            (username.lower(),)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        self.release_conn(conn)
+        if not rows:
+            raise AuthKitNoSuchUserError("No such user %r"%username.lower())
+        return frozenset([row[1].lower() for row in rows if row[1] is not None])
+
     def user_group(self, username):
         """
         Returns the group associated with the user or ``None`` if no group is
@@ -532,6 +568,247 @@ class UsersDriver(Users):
         self.release_conn(conn)
         return rows[0][0] == self.encrypt(password)
 
+    # Bulk Methods
+    def users_bulk(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the dictionary 
+        returned by ``user()`` for each user in ``usernames`` which exists. 
+        Users which don't exist are left out. Uses one query for each 
+        ``bulk_chunk_size`` users.
+        """
+        result = {}
+        chunks = self._username_chunks(usernames)
+        if not chunks:
+            return result
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        for chunk in chunks:
+            cursor.execute(
+                """
+                SELECT users.username, groups.name, users.password, roles.name 
+                FROM users
+                LEFT OUTER JOIN groups ON users.group_uid = groups.uid
+                LEFT OUTER JOIN users_roles ON users.uid = users_roles.user_uid
+                LEFT OUTER JOIN roles ON users_roles.role_uid = roles.uid
+                WHERE users.username IN %s
+                ORDER BY users.username, roles.name
+                """,
+                (tuple(chunk),)
+            )
+            for username, group, password, role in cursor.fetchall():
+                if not result.has_key(username):
+                    result[username] = {
+                        'username': username,
+                        'group':    group,
+                        'password': password,
+                        'roles':    [],
+                    }
+                if role is not None:
+                    result[username]['roles'].append(role)
+        cursor.close()
+        self.release_conn(conn)
+        return result
+
+    def users_with_role(self, role):
+        """
+        Returns a list of the lowercase usernames of the users with the role
+        specified ordered alphabetically. Raises an 
+        ``AuthKitNoSuchRoleError`` if the role doesn't exist.
+        """
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        # The role is always returned so a missing role can be told apart 
+        # from a role no one has
+        cursor.execute(
+            """
+            SELECT users.username FROM roles
+            LEFT OUTER JOIN users_roles ON roles.uid = users_roles.role_uid
+            LEFT OUTER JOIN users ON users_roles.user_uid = users.uid
+            WHERE roles.name = %s
+            ORDER BY users.username
+            """,
+            (role.lower(),)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        self.release_conn(conn)
+        if not rows:
+            raise AuthKitNoSuchRoleError("No such role %r"%role.lower())
+        return [row[0] for row in rows if row[0] is not None]
+
+    def users_in_group(self, group):
+        """
+        Returns a list of the lowercase usernames of the users in the group
+        specified ordered alphabetically. Raises an 
+        ``AuthKitNoSuchGroupError`` if the group doesn't exist.
+        """
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT users.username FROM groups
+            LEFT OUTER JOIN users ON groups.uid = users.group_uid
+            WHERE groups.name = %s
+            ORDER BY users.username
+            """,
+            (group.lower(),)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        self.release_conn(conn)
+        if not rows:
+            raise AuthKitNoSuchGroupError("No such group %r"%group.lower())
+        return [row[0] for row in rows if row[0] is not None]
+
+    def roles_for_users(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the list returned 
+        by ``user_roles()`` for each user in ``usernames`` which exists. 
+        Users which don't exist are left out. Uses one query for each 
+        ``bulk_chunk_size`` users.
+        """
+        result = {}
+        chunks = self._username_chunks(usernames)
+        if not chunks:
+            return result
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        for chunk in chunks:
+            cursor.execute(
+                """
+                SELECT users.username, roles.name FROM users
+                LEFT OUTER JOIN users_roles ON users.uid = users_roles.user_uid
+                LEFT OUTER JOIN roles ON users_roles.role_uid = roles.uid
+                WHERE users.username IN %s
+                ORDER BY users.username, roles.name
+                """,
+                (tuple(chunk),)
+            )
+            for username, role in cursor.fetchall():
+                roles = result.setdefault(username, [])
+                if role is not None:
+                    roles.append(role)
+        cursor.close()
+        self.release_conn(conn)
+        return result
+
+    # Bulk Write Methods
+    def _names(self, cursor, table):
+        cursor.execute("SELECT name, uid FROM %s"%table)
+        return dict(cursor.fetchall())
+
+    def bulk_create_users(self, records):
+        """
+        Creates a user for each dictionary in ``records``, which have the 
+        keys ``username``, ``password`` and optionally ``group`` and 
+        ``roles``. The group and roles must already exist.
+
+        All the records are checked against the existing users, roles and 
+        groups first, loaded with one query each, and the valid ones are 
+        inserted with ``executemany()`` in one transaction. Returns a list of
+        ``(record, exception)`` pairs for the records which were skipped.
+        """
+        records = list(records)
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        try:
+            try:
+                roles = self._names(cursor, 'roles')
+                groups = self._names(cursor, 'groups')
+                existing = {}
+                for chunk in self._username_chunks(
+                    [r['username'] for r in records if r.get('username')]
+                ):
+                    cursor.execute(
+                        """
+                        SELECT username FROM users WHERE username IN %s
+                        """,
+                        (tuple(chunk),)
+                    )
+                    for row in cursor.fetchall():
+                        existing[row[0]] = None
+                valid, failures = self._validate_new_users(
+                    records, 
+                    existing.has_key, 
+                    roles.has_key, 
+                    groups.has_key,
+                )
+                if valid:
+                    cursor.executemany(
+                        """
+                        INSERT INTO users (username, password, group_uid) 
+                        VALUES (%s, %s, %s)
+                        """,
+                        [
+                            (username, self.encrypt(password), groups.get(group))
+                            for username, password, group, roles_ in valid
+                        ]
+                    )
+                    user_roles = []
+                    for username, password, group, roles_ in valid:
+                        for role in roles_:
+                            user_roles.append((roles[role], username))
+                    if user_roles:
+                        cursor.executemany(
+                            """
+                            INSERT INTO users_roles (user_uid, role_uid) 
+                            SELECT uid, %s FROM users WHERE username=%s
+                            """,
+                            user_roles
+                        )
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        finally:
+            cursor.close()
+            self.release_conn(conn)
+        return failures
+
+    def bulk_assign_roles(self, pairs):
+        """
+        Gives each user the role in each ``(username, role)`` pair in 
+        ``pairs``. The roles must already exist.
+
+        The pairs are checked against the roles and the users' current 
+        roles, loaded with one query for the roles and one for each 
+        ``bulk_chunk_size`` users, and the valid ones are inserted with 
+        ``executemany()`` in one transaction. Returns a list of 
+        ``(pair, exception)`` pairs for the pairs which were skipped.
+        """
+        pairs = list(pairs)
+        current = {}
+        for username, roles_ in self.roles_for_users(
+            [pair[0] for pair in pairs]
+        ).items():
+            current[username] = dict.fromkeys(roles_)
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        try:
+            try:
+                roles = self._names(cursor, 'roles')
+                valid, failures = self._validate_role_pairs(
+                    pairs, 
+                    current.get, 
+                    roles.has_key,
+                )
+                if valid:
+                    cursor.executemany(
+                        """
+                        INSERT INTO users_roles (user_uid, role_uid) 
+                        SELECT uid, %s FROM users WHERE username=%s
+                        """,
+                        [(roles[role], username) for username, role in valid]
+                    )
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        finally:
+            cursor.close()
+            self.release_conn(conn)
+        return failures
+
     def user_set_username(self, username, new_username):
         """
         Sets the user's username to the lowercase of new_username. 
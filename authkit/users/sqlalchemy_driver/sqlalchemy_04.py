@@ -182,12 +182,12 @@ class UsersFromDatabase(Users):
         """
         Remove the user with the specified username 
         """
-        user = self.meta.Session.query(self.model.User).filter_by(username=username.lower()).first()
+        user = self.model.Session.query(self.model.User).filter_by(username=username.lower()).first()
         if user is None:
             raise AuthKitNoSuchUserError("There is no such user %r"%username)
         else:
-            self.meta.Session.delete(user)
-            self.meta.Session.flush()
+            self.model.Session.delete(user)
+            self.model.Session.flush()
 
     def role_delete(self, role):
         """
@@ -195,24 +195,24 @@ class UsersFromDatabase(Users):
         To delete the role and remove it from all existing users use 
         ``role_delete_cascade()``
         """
-        role = self.meta.Session.query(self.model.Role).filter_by(name=role.lower()).first()
+        role = self.model.Session.query(self.model.Role).filter_by(name=role.lower()).first()
         if role is None:
             raise AuthKitNoRoleUserError("There is no such role %r"%role)
         else:
-            self.meta.Session.delete(role)
-            self.meta.Session.flush()
+            self.model.Session.delete(role)
+            self.model.Session.flush()
             
     def group_delete(self, group):
         """
         Remove the group specified. Rasies an exception if the group is still in use. 
         To delete the group and remove it from all existing users use ``group_delete_cascade()``
         """
-        group = self.meta.Session.query(self.model.Group).filter_by(name=group.lower()).first()
+        group = self.model.Session.query(self.model.Group).filter_by(name=group.lower()).first()
         if group is None:
             raise AuthKitNoGroupUserError("There is no such group %r"%group)
         else:
-            self.meta.Session.delete(group)
-            self.meta.Session.flush()
+            self.model.Session.delete(group)
+            self.model.Session.flush()
 
     # Existence Methods
     def user_exists(self, username):
@@ -260,7 +260,7 @@ class UsersFromDatabase(Users):
         """
         Returns a lowecase list of all usernames ordered alphabetically
         """
-        return [r.name for r in self.model.Session.query(
+        return [r.username for r in self.model.Session.query(
             self.model.User).order_by(self.model.User.username)]
     
     def list_groups(self):
@@ -285,12 +285,15 @@ class UsersFromDatabase(Users):
             }
 
         The role names are ordered alphabetically
-        Raises an exception if the user doesn't exist.
+        Raises an exception if the user doesn't exist. The user's group and
+        roles are loaded in the same query as the user.
         """    
-        if not self.user_exists(username.lower()):
+        user = self.model.Session.query(self.model.User).options(
+            eagerload('group'), 
+            eagerload('roles'),
+        ).filter_by(username=username.lower()).first()
+        if user is None:
             raise AuthKitNoSuchUserError("No such user %r"%username.lower())
-        user = self.model.Session.query(self.model.User).filter_by(
-            username=username.lower()).one()
         roles = [r.name for r in user.roles]
         roles.sort()
         return {
@@ -313,6 +316,20 @@ class UsersFromDatabase(Users):
         roles.sort()
         return roles
     
+    def user_role_set(self, username):
+        """
+        Returns a ``frozenset`` of the lowercase role names for the given 
+        username. Raises an exception if the username doesn't exist.
+
+        The user and their roles are loaded in the same query.
+        """
+        user = self.model.Session.query(self.model.User).options(
+            eagerload('roles'),
+        ).filter_by(username=username.lower()).first()
+        if user is None:
+            raise AuthKitNoSuchUserError("No such user %r"%username.lower())
+        return frozenset([r.name.lower() for r in user.roles])
+
     def user_group(self, username):
         """
         Returns the group associated with the user or ``None`` if no group is
@@ -383,6 +400,165 @@ class UsersFromDatabase(Users):
             return True
         return False
     
+    # Bulk Methods
+    def users_bulk(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the dictionary 
+        returned by ``user()`` for each user in ``usernames`` which exists. 
+        Users which don't exist are left out. The users, their groups and 
+        roles are loaded with one query for each ``bulk_chunk_size`` users.
+        """
+        result = {}
+        for chunk in self._username_chunks(usernames):
+            users = self.model.Session.query(self.model.User).options(
+                eagerload('group'), 
+                eagerload('roles'),
+            ).filter(self.model.User.username.in_(chunk)).all()
+            for user in users:
+                roles = [r.name for r in user.roles]
+                roles.sort()
+                result[user.username] = {
+                    'username': user.username,
+                    'group':    user.group and user.group.name or None,
+                    'password': user.password,
+                    'roles':    roles
+                }
+        return result
+
+    def users_with_role(self, role):
+        """
+        Returns a list of the lowercase usernames of the users with the role
+        specified ordered alphabetically. Raises an 
+        ``AuthKitNoSuchRoleError`` if the role doesn't exist.
+        """
+        role_ = self.model.Session.query(self.model.Role).options(
+            eagerload('users'),
+        ).filter_by(name=role.lower()).first()
+        if role_ is None:
+            raise AuthKitNoSuchRoleError("No such role %r"%role.lower())
+        usernames = [u.username for u in role_.users]
+        usernames.sort()
+        return usernames
+
+    def users_in_group(self, group):
+        """
+        Returns a list of the lowercase usernames of the users in the group
+        specified ordered alphabetically. Raises an 
+        ``AuthKitNoSuchGroupError`` if the group doesn't exist.
+        """
+        group_ = self.model.Session.query(self.model.Group).options(
+            eagerload('users'),
+        ).filter_by(name=group.lower()).first()
+        if group_ is None:
+            raise AuthKitNoSuchGroupError("No such group %r"%group.lower())
+        usernames = [u.username for u in group_.users]
+        usernames.sort()
+        return usernames
+
+    def roles_for_users(self, usernames):
+        """
+        Returns a dictionary of the lowercase username to the list returned 
+        by ``user_roles()`` for each user in ``usernames`` which exists. 
+        Users which don't exist are left out. The users and their roles are
+        loaded with one query for each ``bulk_chunk_size`` users.
+        """
+        result = {}
+        for chunk in self._username_chunks(usernames):
+            users = self.model.Session.query(self.model.User).options(
+                eagerload('roles'),
+            ).filter(self.model.User.username.in_(chunk)).all()
+            for user in users:
+                roles = [r.name for r in user.roles]
+                roles.sort()
+                result[user.username] = roles
+        return result
+
+    # Bulk Write Methods
+    def bulk_create_users(self, records):
+        """
+        Creates a user for each dictionary in ``records``, which have the 
+        keys ``username``, ``password`` and optionally ``group`` and 
+        ``roles``. The group and roles must already exist.
+
+        All the records are checked against the existing users, roles and 
+        groups first, loaded with one query each, and the valid ones are 
+        written in a single flush. Returns a list of ``(record, exception)``
+        pairs for the records which were skipped.
+        """
+        records = list(records)
+        roles = {}
+        for role in self.model.Session.query(self.model.Role).all():
+            roles[role.name] = role
+        groups = {}
+        for group in self.model.Session.query(self.model.Group).all():
+            groups[group.name] = group
+        existing = {}
+        for chunk in self._username_chunks(
+            [r['username'] for r in records if r.get('username')]
+        ):
+            for user in self.model.Session.query(self.model.User).filter(
+                self.model.User.username.in_(chunk)
+            ).all():
+                existing[user.username] = None
+        valid, failures = self._validate_new_users(
+            records, 
+            existing.has_key, 
+            roles.has_key, 
+            groups.has_key,
+        )
+        for username, password, group, role_names in valid:
+            if group is None:
+                new_user = self.model.User(
+                    username=username, 
+                    password=self.encrypt(password)
+                )
+            else:
+                new_user = self.model.User(
+                    username=username, 
+                    password=self.encrypt(password), 
+                    group_uid=groups[group].uid
+                )
+            for role in role_names:
+                new_user.roles.append(roles[role])
+            self.model.Session.save(new_user)
+        self.model.Session.flush()
+        return failures
+
+    def bulk_assign_roles(self, pairs):
+        """
+        Gives each user the role in each ``(username, role)`` pair in 
+        ``pairs``. The roles must already exist.
+
+        The pairs are checked against the roles and the users' current 
+        roles, loaded with one query for the roles and one for each 
+        ``bulk_chunk_size`` users, and the valid ones are written in a 
+        single flush. Returns a list of ``(pair, exception)`` pairs for the
+        pairs which were skipped.
+        """
+        pairs = list(pairs)
+        roles = {}
+        for role in self.model.Session.query(self.model.Role).all():
+            roles[role.name] = role
+        users = {}
+        current = {}
+        for chunk in self._username_chunks([pair[0] for pair in pairs]):
+            for user in self.model.Session.query(self.model.User).options(
+                eagerload('roles'),
+            ).filter(self.model.User.username.in_(chunk)).all():
+                users[user.username] = user
+                current[user.username] = dict.fromkeys(
+                    [r.name for r in user.roles]
+                )
+        valid, failures = self._validate_role_pairs(
+            pairs, 
+            current.get, 
+            roles.has_key,
+        )
+        for username, role in valid:
+            users[username].roles.append(roles[role])
+        self.model.Session.flush()
+        return failures
+
     def user_set_username(self, username, new_username):
         """
         Sets the user's username to the lowercase of new_username. 
@@ -74,5 +74,11 @@ setup(
 
         [paste.paster_create_template]
         authenticate_plugin=authkit.template:AuthenticatePlugin
+
+        [paste.filter_app_factory]
+        acl=authkit.authorize.acl:make_acl_middleware
+
+        [console_scripts]
+        authkit-compile-users=authkit.users.binary:main
     """,
 )
@@ -0,0 +1,434 @@
+"""
+Rough benchmarks for the per-request overhead of the AuthKit middleware.
+
+These aren't run as part of the test suite. Run them directly from the
+root of the distribution like this::
+
+    python test/benchmark.py
+
+Each benchmark prints the average time per request in microseconds so that
+the figures for different configurations can be compared.
+"""
+
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from authkit.authenticate import AddDictToEnviron, AddUsersObjectToEnviron, \
+    middleware
+from authkit.authenticate.multi import MultiHandler, status_checker, \
+    collapse_multi_handlers, make_status_checker
+from authkit.authenticate.redirect import HandleRedirect
+
+NUMBER = 10000
+
+def ok_app(environ, start_response):
+    start_response('200 OK', [('Content-type', 'text/plain')])
+    return ['OK']
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+def environ():
+    return {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': '/',
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0),
+    }
+
+def time_func(func, number=NUMBER):
+    """Returns the average time in microseconds for one call to ``func``"""
+    return timeit.Timer(func).timeit(number=number) / number * 1000000
+
+def time_app(app, number=NUMBER):
+    """Returns the average time in microseconds for one request to ``app``"""
+    def request():
+        app(environ(), start_response)
+    return time_func(request, number)
+
+def report(name, results, unit='us'):
+    print name
+    for label, value in results:
+        print '    %-30s %8.2f %s' % (label, value, unit)
+
+#
+# Benchmarks
+#
+
+def count_multi_handlers(app):
+    """Returns the number of ``MultiHandler`` layers in the stack ``app``"""
+    count = 0
+    while app is not None:
+        if isinstance(app, MultiHandler):
+            count += 1
+        app = getattr(app, 'app', getattr(app, 'application', None))
+    return count
+
+def bench_multi_handler_depth(depths=(1, 2, 4, 8)):
+    """
+    Stack depth of nested ``MultiHandler`` layers against the overhead of a
+    request which isn't intercepted, with and without collapsing them.
+    """
+    results = []
+    for depth in depths:
+        for collapse in [False, True]:
+            app = ok_app
+            for i in range(depth):
+                # Handlers with the same method name can't be merged
+                name = 'redirect%s' % i
+                app = MultiHandler(app)
+                app.add_method(name, HandleRedirect,
+                               redirect_to='http://localhost/signin')
+                app.add_checker(name, status_checker)
+                if collapse:
+                    app = collapse_multi_handlers(app)
+            if collapse:
+                assert count_multi_handlers(app) == 1, \
+                    'The depth %s stack was not collapsed' % depth
+            else:
+                assert count_multi_handlers(app) == depth
+            app = AddDictToEnviron(app, {'authkit.intercept': ['401']})
+            results.append((
+                'depth %s %s' % (depth, collapse and 'collapsed' or 'nested'),
+                time_app(app),
+            ))
+    report('MultiHandler stack depth', results)
+
+def bench_status_checker():
+    """
+    ``status_checker()`` reading ``authkit.intercept`` from the environ 
+    against the checker compiled when the middleware is built.
+    """
+    env = {'authkit.intercept': ['401', '403']}
+    compiled = make_status_checker(['401', '403'])
+    results = []
+    for status in ['200 OK', '401 Unauthorized']:
+        for label, checker in [
+            ('environ', status_checker), 
+            ('compiled', compiled),
+        ]:
+            def request():
+                checker(env, status, [])
+            results.append((
+                '%s %s' % (status[:3], label), 
+                time_func(request, NUMBER*10),
+            ))
+    report('Status checker', results)
+
+def valid(environ, username, password):
+    return username == password
+
+def bench_pipeline():
+    """
+    The chain of middleware built by ``authkit.authenticate.middleware()`` 
+    against the same configuration with ``authkit.setup.pipeline`` enabled.
+    """
+    configs = [
+        ('basic', dict(
+            setup_method='basic', 
+            basic_authenticate_user_data='test:test',
+        )),
+        ('digest, basic', dict(
+            setup_method='digest, basic', 
+            basic_authenticate_user_data='test:test', 
+            digest_authenticate_user_data='test:test',
+        )),
+        ('form, cookie', dict(
+            setup_method='form, cookie', 
+            cookie_secret='secret',
+            form_authenticate_user_data='test:test',
+            setup_fakeuser='test',
+        )),
+    ]
+    results = []
+    for name, config in configs:
+        for pipeline in ['false', 'true']:
+            app = middleware(ok_app, setup_pipeline=pipeline, **config)
+            results.append((
+                '%s %s' % (name, pipeline == 'true' and 'pipeline' or 'chain'),
+                time_app(app),
+            ))
+    report('Middleware chain against compiled pipeline', results)
+
+def users_app(environ, start_response):
+    environ['authkit.users'].encrypt
+    return ok_app(environ, start_response)
+
+def bench_users_instance_scope():
+    """
+    The cost of creating the ``api_version = 0.4`` PostgreSQL driver, which
+    evaluates its configuration strings in ``__init__()``, on every request
+    against sharing one instance, and against requests which never use it.
+    """
+    from authkit.users.postgresql_driver import UsersDriver
+    class RequestUsersDriver(UsersDriver):
+        instance_scope = 'request'
+    class ThreadUsersDriver(UsersDriver):
+        instance_scope = 'thread'
+    data = 'authkit.users:md5\nauthkit.users:md5'
+    results = []
+    for driver in [RequestUsersDriver, ThreadUsersDriver, UsersDriver]:
+        for app, label in [(users_app, 'used'), (ok_app, 'unused')]:
+            app = AddUsersObjectToEnviron(app, 'authkit.users', driver, 
+                                          data=data)
+            results.append((
+                '%s %s' % (driver.instance_scope, label), 
+                time_app(app),
+            ))
+    report('Users object per request', results)
+
+def bench_authorized():
+    """
+    ``authorized()`` deciding a permission with ``evaluate()`` against 
+    raising and catching the HTTP exceptions through ``check()``.
+    """
+    from authkit.authorize import authorized
+    from authkit.permissions import RemoteUser
+    class CheckedRemoteUser(RemoteUser):
+        evaluable = False
+        cacheable = False
+    class EvaluatedRemoteUser(RemoteUser):
+        cacheable = False
+    results = []
+    for username in [None, 'james']:
+        env = {'authkit.config': {'setup.enable': True}}
+        if username:
+            env['REMOTE_USER'] = username
+        for label, permission in [
+            ('check', CheckedRemoteUser()), 
+            ('evaluate', EvaluatedRemoteUser()),
+        ]:
+            def request():
+                authorized(env, permission)
+            results.append((
+                '%s %s' % (username and 'pass' or 'fail', label),
+                time_func(request),
+            ))
+    report('authorized()', results)
+
+def bench_from_ip(sizes=(10, 1000, 10000)):
+    """
+    Checking an address against a list of hosts, as ``FromIP`` used to, 
+    against the ``AddressSet`` trie of networks it uses now.
+    """
+    from authkit.permissions import AddressSet
+    results = []
+    for size in sizes:
+        hosts = ['10.%s.%s.%s' % (i // 65536, i // 256 % 256, i % 256) 
+                 for i in range(size)]
+        networks = ['10.%s.%s.0/24' % (i // 256, i % 256) 
+                    for i in range(size)]
+        for label, container in [
+            ('list', hosts),
+            ('trie', AddressSet(networks)),
+        ]:
+            def request():
+                '192.168.0.1' in container
+            results.append((
+                '%s %s' % (size, label),
+                time_func(request, NUMBER),
+            ))
+    report('FromIP host lookup (miss)', results)
+
+def bench_users_lookup(sizes=(100, 10000)):
+    """
+    The existence checks of ``UsersFromString``, which ``valid_password()``
+    and the role permissions make on every request, as the number of users
+    grows.
+    """
+    from authkit.users import UsersFromString, CompactUsersFromString
+    results = []
+    for size in sizes:
+        data = '\n'.join([
+            'user%s:password:group%s role%s' % (i, i % 10, i % 100) 
+            for i in range(size)
+        ])
+        for name, users in [
+            ('index', UsersFromString(data)), 
+            ('table', CompactUsersFromString(data)),
+        ]:
+            for label, func in [
+                ('user_exists', lambda: users.user_exists('user%s' % (size-1))),
+                ('role_exists', lambda: users.role_exists('role99')),
+                ('user_has_role', lambda: users.user_has_role('user1', 'role1')),
+            ]:
+                results.append((
+                    '%s %s %s' % (size, name, label), 
+                    time_func(func, 1000),
+                ))
+    report('UsersFromString and CompactUsersFromString lookups', results)
+
+def bench_parse_users(sizes=(1000, 10000, 100000)):
+    """
+    Parsing a users file as the number of users grows, reported per user.
+    """
+    import tempfile
+    from authkit.users import UsersFromFile
+    results = []
+    for size in sizes:
+        fd, filename = tempfile.mkstemp()
+        fp = os.fdopen(fd, 'w')
+        for i in range(size):
+            fp.write('user%s:password%s:group%s role%s role%s\n' % (
+                i, i, i % 10, i % 100, i % 7))
+        fp.close()
+        try:
+            def parse():
+                UsersFromFile(filename)
+            number = max(1, 100000 // size)
+            results.append((
+                '%s users' % size, 
+                time_func(parse, number) / size,
+            ))
+        finally:
+            os.remove(filename)
+    report('Users file parse and index time per user', results)
+
+def bench_users_startup(sizes=(10000, 100000, 1000000)):
+    """
+    The time to load a users file with ``UsersFromFile`` against mapping the
+    compiled file with ``UsersFromMmap``, and the cost of a lookup in each.
+    """
+    import tempfile
+    from authkit.users import UsersFromFile
+    from authkit.users.binary import UsersFromMmap, compile_users
+    loads = []
+    lookups = []
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            source = os.path.join(directory, 'users.txt')
+            destination = os.path.join(directory, 'users.db')
+            fp = open(source, 'w')
+            for i in range(size):
+                fp.write('user%s:password%s:group%s role%s role%s\n' % (
+                    i, i, i % 10, i % 100, i % 7))
+            fp.close()
+            compile_users(source, destination)
+            for label, cls, filename in [
+                ('text', UsersFromFile, source), 
+                ('mmap', UsersFromMmap, destination),
+            ]:
+                number = max(1, 100000 // size)
+                loads.append((
+                    '%s %s' % (size, label), 
+                    time_func(lambda: cls(filename), number) / 1000,
+                ))
+                users = cls(filename)
+                def lookup():
+                    users.user_has_role('user%s' % (size-1), 'role1')
+                lookups.append(('%s %s' % (size, label), time_func(lookup)))
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    report('Users file load', loads, 'ms')
+    report('Users file lookup', lookups)
+
+def bench_cached_users():
+    """
+    The per-request permission checks made against the SQLAlchemy driver 
+    directly and through ``CachedUsers``, and the checks for unknown 
+    usernames with and without a ``UsernameFilter``.
+    """
+    from sqlalchemymanager import SQLAlchemyManager
+    from authkit.users import CachedUsers
+    from authkit.users.sqlalchemy_04_driver import UsersFromDatabase, \
+        setup_model
+    manager = SQLAlchemyManager(None, {'sqlalchemy.url': 'sqlite://'}, 
+                                [setup_model])
+    manager.create_all()
+    connection = manager.engine.connect()
+    session = manager.session_maker(bind=connection)
+    environ = {
+        'sqlalchemy.session': session, 
+        'sqlalchemy.model': manager.model,
+    }
+    database = UsersFromDatabase(environ)
+    database.role_create('admin')
+    database.user_create('james', 'password')
+    database.user_add_role('james', 'admin')
+    session.flush()
+    results = []
+    for label, users in [
+        ('database', database), 
+        ('cached', CachedUsers(database)),
+    ]:
+        def request():
+            users.user_exists('james')
+            users.user_has_role('james', 'admin')
+        results.append((label, time_func(request, 1000)))
+    report('user_exists() and user_has_role()', results)
+    # Every request uses a different unknown username, as in a credential
+    # stuffing attack, so the cache never helps
+    results = []
+    for label, users in [
+        ('database', database), 
+        ('cached', CachedUsers(database)),
+        ('filtered', CachedUsers(database, filter_interval=300)),
+    ]:
+        names = iter(xrange(100000000))
+        def request():
+            users.user_exists('unknown%s' % names.next())
+        results.append((label, time_func(request, 1000)))
+    session.close()
+    connection.close()
+    report('user_exists() for unknown usernames', results)
+
+def resident_memory():
+    """Returns the resident memory of this process in megabytes (Linux only)"""
+    fp = open('/proc/self/statm')
+    try:
+        pages = int(fp.read().split()[1])
+    finally:
+        fp.close()
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+
+def bench_users_memory(sizes=(10000, 100000, 1000000)):
+    """
+    The memory used by ``UsersFromString`` against ``CompactUsersFromString``
+    as the number of users grows. Each measurement is made in a child 
+    process so that memory freed by one doesn't hide the cost of the next.
+    """
+    if not os.path.exists('/proc/self/statm'):
+        print 'Users memory: needs /proc/self/statm'
+        return
+    from authkit.users import UsersFromString, CompactUsersFromString
+    results = []
+    for size in sizes:
+        data = '\n'.join([
+            'user%s:password%s:group%s role%s role%s' % (
+                i, i, i % 10, i % 100, i % 7) 
+            for i in range(size)
+        ])
+        for label, cls in [
+            ('index', UsersFromString), 
+            ('table', CompactUsersFromString),
+        ]:
+            read, write = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(read)
+                before = resident_memory()
+                users = cls(data)
+                os.write(write, str(resident_memory() - before))
+                os._exit(0)
+            os.close(write)
+            used = float(os.read(read, 100))
+            os.close(read)
+            os.waitpid(pid, 0)
+            results.append(('%s %s' % (size, label), used))
+    report('Users memory', results, 'MB')
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for name, func in sorted(globals().items()):
+        if name.startswith('bench_') and (not names or name[6:] in names):
+            func()
@@ -152,6 +152,121 @@ def test_redirect_fail():
     assertEqual(res.header('Location'),'http://3aims.com')
     assertEqual(res.full_status, '302 Found')
 
+def check_bulk_reads(plugin):
+    from authkit.users import Users, AuthKitNoSuchRoleError, \
+        AuthKitNoSuchGroupError
+    usernames = ['James', 'BEN', 'nobody', 'ian', 'james']
+    assertEqual(plugin.users_bulk([]), {})
+    assertEqual(plugin.roles_for_users([]), {})
+    users = {}
+    roles = {}
+    for username in ['james', 'ben', 'ian']:
+        users[username] = plugin.user(username)
+        roles[username] = plugin.user_roles(username)
+    assertAllEqual(
+        plugin.users_bulk(usernames), 
+        Users.users_bulk(plugin, usernames), 
+        users,
+    )
+    assertAllEqual(
+        plugin.roles_for_users(usernames), 
+        Users.roles_for_users(plugin, usernames), 
+        roles,
+    )
+    for role in plugin.list_roles():
+        assertAllEqual(
+            plugin.users_with_role(role.upper()),
+            Users.users_with_role(plugin, role.upper()),
+            [username for username in plugin.list_users() 
+             if plugin.user_has_role(username, role)],
+        )
+    for group in plugin.list_groups():
+        assertAllEqual(
+            plugin.users_in_group(group.upper()),
+            Users.users_in_group(plugin, group.upper()),
+            [username for username in plugin.list_users() 
+             if plugin.user_has_group(username, group)],
+        )
+    for func, error in [
+        ('users_with_role', AuthKitNoSuchRoleError),
+        ('users_in_group', AuthKitNoSuchGroupError),
+    ]:
+        try:
+            getattr(plugin, func)('nothing')
+        except error:
+            pass
+        else:
+            raise AssertionError("Expected %s from %s"%(error, func))
+
+def check_bulk_writes(d, base=True):
+    from authkit.users import AuthKitError, AuthKitNoSuchUserError, \
+        AuthKitNoSuchGroupError, AuthKitNoSuchRoleError
+    assertEqual(d.users_with_role('WIKI'), ['james', 'simon'])
+    assertEqual(d.users_bulk(['James', 'nobody']), {'james': d.user('james')})
+    records = [
+        {'username': 'Alice', 'password': 'a', 'group': 'Pylons', 
+         'roles': ['Wiki', 'editor']},
+        {'username': 'bob', 'password': 'b'},
+        {'username': 'james', 'password': 'x'},
+        {'username': 'alice', 'password': 'y'},
+        {'username': 'carol', 'password': 'c', 'group': 'nogroup'},
+        {'username': 'dave', 'password': 'd', 'roles': ['norole']},
+        {'username': 'e ve', 'password': 'e'},
+        {'username': 'frank', 'password': ''},
+    ]
+    failures = d.bulk_create_users(records)
+    assertEqual(
+        [(record['username'], e.__class__) for record, e in failures],
+        [
+            ('james', AuthKitError),
+            ('alice', AuthKitError),
+            ('carol', AuthKitNoSuchGroupError),
+            ('dave', AuthKitNoSuchRoleError),
+            ('e ve', AuthKitError),
+            ('frank', AuthKitError),
+        ]
+    )
+    assertEqual(d.user('alice'), {
+        'username': 'alice', 
+        'group': 'pylons', 
+        'password': 'a', 
+        'roles': ['editor', 'wiki'],
+    })
+    assertEqual(d.user_roles('bob'), [])
+    assertEqual(d.user_exists('carol'), False)
+    failures = d.bulk_assign_roles([
+        ('bob', 'admin'), 
+        ('Alice', 'ADMIN'), 
+        ('alice', 'wiki'), 
+        ('nobody', 'admin'), 
+        ('bob', 'norole'), 
+        ('bob', 'admin'),
+    ])
+    assertEqual(
+        [(pair, e.__class__) for pair, e in failures],
+        [
+            (('alice', 'wiki'), AuthKitError),
+            (('nobody', 'admin'), AuthKitNoSuchUserError),
+            (('bob', 'norole'), AuthKitNoSuchRoleError),
+            (('bob', 'admin'), AuthKitError),
+        ]
+    )
+    assertEqual(d.user_roles('bob'), ['admin'])
+    assertEqual(d.user_roles('alice'), ['admin', 'editor', 'wiki'])
+    if not base:
+        return
+    # The base class implementation uses the one-user methods
+    from authkit.users import Users
+    failures = Users.bulk_create_users(d, [
+        {'username': 'gina', 'password': 'g', 'roles': ['wiki']},
+        {'username': 'Gina', 'password': 'g'},
+    ])
+    assertEqual([record['username'] for record, e in failures], ['Gina'])
+    assertEqual(d.user_roles('gina'), ['wiki'])
+    failures = Users.bulk_assign_roles(d, [('gina', 'admin'), ('gina', 'wiki')])
+    assertEqual([pair for pair, e in failures], [('gina', 'wiki')])
+    assertEqual(d.user_roles('gina'), ['admin', 'wiki'])
+
 def test_users_api_database():
     try: 
         from authkit.users.sqlalchemy_04_driver import UsersFromDatabase, setup_model
@@ -399,11 +514,19 @@ def test_users_api_database():
             }
         )
         
+        # Bulk Methods
+        for plugin in [s,f,d]:
+            check_bulk_reads(plugin)
+        assertEqual(s.users_with_role('admin'), ['ben', 'james'])
+        assertEqual(d.users_with_role('wiki'), ['james', 'simon'])
+        assertEqual(d.users_in_group('pylons'), ['ben', 'james'])
+
         # Test all user methods raise:
         for plugin in [s,f,d]:
             for func in [
                 'user',
                 'user_roles',
+                'user_role_set',
                 'user_group',
                 'user_password',
             ]:
@@ -432,6 +555,12 @@ def test_users_api_database():
             d.user_roles('James'),
             ['admin','wiki']
         )
+        assertAllEqual(
+            s.user_role_set('James'), 
+            f.user_role_set('James'),
+            d.user_role_set('James'),
+            frozenset(['admin','wiki'])
+        )
         assertAllEqual(
             s.user_group('James'), 
             f.user_group('James'),
@@ -444,6 +573,8 @@ def test_users_api_database():
             d.user_password('James'),
             'passWOrd1'
         )
+
+        check_bulk_writes(d)
         
         session.flush()
         session.commit()
@@ -453,6 +584,55 @@ def test_users_api_database():
 
         
 
+def test_users_sqlalchemy_04_driver():
+    import warnings
+    from sqlalchemy import create_engine, MetaData
+    from sqlalchemy.orm import scoped_session, sessionmaker
+    warnings.filterwarnings('ignore', category=DeprecationWarning)
+    try:
+        from authkit.users.sqlalchemy_driver.sqlalchemy_04 import \
+            UsersFromDatabase
+    finally:
+        warnings.resetwarnings()
+    class Model(object):
+        pass
+    model = Model()
+    engine = create_engine('sqlite://')
+    model.meta = MetaData(bind=engine)
+    model.ctx = None
+    model.Session = scoped_session(sessionmaker(autoflush=True, bind=engine))
+    d = UsersFromDatabase(model)
+    model.meta.create_all()
+    try:
+        for role in ['wiki', 'admin', 'editor']:
+            d.role_create(role)
+        d.group_create('pylons')
+        d.group_create('django')
+        # Several of the one-user methods rely on SQLAlchemy 0.4 behaviour 
+        # so the users are added directly
+        roles = dict([(r.name, r) for r in model.Session.query(model.Role)])
+        groups = dict([(g.name, g) for g in model.Session.query(model.Group)])
+        for username, group, role_names in [
+            ('james', 'pylons', ['admin', 'wiki']),
+            ('ben', 'pylons', []),
+            ('simon', None, ['wiki']),
+            ('ian', None, []),
+        ]:
+            user = model.User(username, password='password')
+            user.group = groups.get(group)
+            user.roles = [roles[name] for name in role_names]
+            model.Session.add(user)
+        model.Session.flush()
+        check_bulk_reads(d)
+        assertEqual(d.users_in_group('pylons'), ['ben', 'james'])
+        # The base class bulk writes use user_add_role(), which needs 
+        # SQLAlchemy 0.4
+        check_bulk_writes(d, base=False)
+        d.user_delete('ian')
+        assertEqual(d.user_exists('ian'), False)
+    finally:
+        model.Session.remove()
+
 def test_users_model_api_database():
     sys.path.insert(0, os.getcwd()+'/examples/user/database-model')
     try: 
@@ -740,6 +920,1503 @@ def test_users_model_api_database():
         d.user_password('James'),
         'passWOrd1'
     )
+
+    check_bulk_writes(d)
         
         
         
+
+def test_collapse_multi_handlers():
+    from authkit.authenticate.multi import MultiHandler, status_checker, \
+        collapse_multi_handlers
+    from authkit.authenticate.redirect import HandleRedirect
+    from authkit.authenticate import AddDictToEnviron
+
+    def deny_app(environ, start_response):
+        start_response('401 Unauth', [('Content-type', 'text/plain')])
+        return ['Not Authed']
+
+    class Forbid(object):
+        def __init__(self, app):
+            self.app = app
+        def __call__(self, environ, start_response):
+            start_response('403 Forbidden', [('Content-type', 'text/plain')])
+            return ['Forbidden']
+
+    class PassThrough(object):
+        def __init__(self, app):
+            self.app = app
+        def __call__(self, environ, start_response):
+            return self.app(environ, start_response)
+
+    def build(collapse, outer_factory=HandleRedirect, **kwargs):
+        app = MultiHandler(deny_app)
+        app.add_method('forbid', Forbid)
+        app.add_checker('forbid', status_checker)
+        inner = app
+        app = MultiHandler(app)
+        app.add_method('outer', outer_factory, **kwargs)
+        app.add_checker('outer', status_checker)
+        if collapse:
+            app = collapse_multi_handlers(app)
+            assert app is inner
+            assertEqual(len(app.merged), 1)
+            # Checkers can still be added for the merged bindings
+            app.add_checker('outer', lambda environ, status, headers: False)
+            assertEqual(len(app.merged[0][1]), 2)
+        return AddDictToEnviron(app, {'authkit.intercept':['401', '403']})
+
+    for collapse in [False, True]:
+        # The outer redirect still sees the 403 from the inner binding
+        res = TestApp(
+            build(collapse, redirect_to='http://x.org')
+        ).get('/', status=302)
+        assertEqual(res.header('Location'), 'http://x.org')
+        # An outer binding which calls the application it wraps gets the
+        # response after the inner handler has checked it
+        res = TestApp(build(collapse, PassThrough)).get('/', status=403)
+        assertEqual(res.body, 'Forbidden')
+
+    # Handlers separated only by user setters are merged too, the outer 
+    # method's challenge still replacing the inner one's
+    app = middleware(
+        sample_app,
+        setup_method='basic, digest',
+        basic_authenticate_user_data='test:test', 
+        digest_authenticate_user_data='test:test',
+    )
+    multi_handlers = []
+    ref = app
+    while ref is not None:
+        if isinstance(ref, MultiHandler):
+            multi_handlers.append(ref)
+        ref = getattr(ref, 'app', getattr(ref, 'application', None))
+    assertEqual(len(multi_handlers), 1)
+    assertEqual(len(multi_handlers[0].merged), 1)
+    res = TestApp(app).get('/private', status=401)
+    assert res.header('WWW-Authenticate').startswith('Digest')
+    res = TestApp(app).get('/private', status=200, headers={
+        'Authorization': 'Basic %s'%'test:test'.encode('base64').strip()
+    })
+
+    # Adjacent handlers built by the middleware share one layer
+    app = middleware(
+        sample_app,
+        setup_method='form, redirect, cookie',
+        redirect_url='http://3aims.com',
+        cookie_secret='secret',
+        form_authenticate_user_data="username2:password2",
+    )
+    multi_handlers = []
+    ref = app
+    while ref is not None:
+        if isinstance(ref, MultiHandler):
+            multi_handlers.append(ref)
+        ref = getattr(ref, 'app', getattr(ref, 'application', None))
+    assertEqual(len(multi_handlers), 1)
+    res = TestApp(app).get('/private', status=200)
+    assert 'Please Sign In' in res
+
+def test_compiled_status_checker():
+    from authkit.authenticate.multi import MultiHandler, status_checker, \
+        make_status_checker
+    from authkit.authenticate.multi import compile_status_checkers
+    intercept = ['401', ' 403']
+    checker = make_status_checker(intercept)
+    for status in ['200 OK', '401 Unauthorized', '403 Forbidden', '200 OK']:
+        assertEqual(
+            checker({'authkit.intercept':intercept}, status, []),
+            status_checker({'authkit.intercept':['401', '403']}, status, []),
+        )
+    # A request can still change the statuses intercepted
+    override = {'authkit.intercept':['403']}
+    assertEqual(checker(override, '401 Unauthorized', []), False)
+    assertEqual(checker(override, '403 Forbidden', []), True)
+    # The user's application is left alone
+    def deny_app(environ, start_response):
+        start_response('401 Unauth', [('Content-type', 'text/plain')])
+        return ['Not Authed']
+    user_app = MultiHandler(deny_app)
+    user_app.add_method('deny', lambda app: deny_app)
+    user_app.add_checker('deny', status_checker)
+    compile_status_checkers(user_app, intercept, until=user_app)
+    assert user_app.checker[0][0] is status_checker
+    app = middleware(
+        sample_app,
+        setup_method='basic',
+        basic_authenticate_function=lambda environ, u, p: u == p,
+        setup_intercept='401, 403',
+    )
+    while not isinstance(app, MultiHandler):
+        app = getattr(app, 'app', getattr(app, 'application', None))
+    for checker, binding in app.checker:
+        assert checker is not status_checker
+        assertEqual(checker.intercept, frozenset(['401', '403']))
+
+def test_pipeline():
+    from authkit.authenticate import Pipeline
+    from authkit.authenticate.multi import MultiHandler
+    def valid(environ, username, password):
+        return username == password
+    configs = [
+        dict(setup_method='basic', basic_authenticate_function=valid),
+        dict(
+            setup_method='digest, basic', 
+            basic_authenticate_user_data='test:test', 
+            digest_authenticate_user_data='test:test',
+        ),
+        dict(
+            setup_method='form, cookie', 
+            cookie_secret='secret',
+            form_authenticate_user_data='test:test',
+            setup_fakeuser='someone',
+        ),
+        dict(setup_method='forward', forward_signinpath='/signin'),
+    ]
+    for config in configs:
+        apps = []
+        for pipeline in ['false', 'true']:
+            app = middleware(sample_app, setup_pipeline=pipeline, **config)
+            pipelines = []
+            ref = app
+            while ref is not None:
+                if isinstance(ref, Pipeline):
+                    pipelines.append(ref)
+                ref = getattr(ref, 'app', getattr(ref, 'application', None))
+            assertEqual(bool(pipelines), pipeline == 'true')
+            apps.append(TestApp(app))
+        for path in ['/', '/private']:
+            res_chain, res_pipeline = [
+                app.get(path, status='*', 
+                        extra_environ={'HTTP_AUTHORIZATION':
+                                       'Basic dGVzdDp0ZXN0'}) 
+                for app in apps
+            ]
+            assertEqual(res_chain.full_status, res_pipeline.full_status)
+            assertEqual(res_chain.header('content-type'), 
+                        res_pipeline.header('content-type'))
+
+class CountingUsers(object):
+    api_version = 0.4
+    created = []
+    def __init__(self, environ, data=None, encrypt=None):
+        self.environ = environ
+        self.created.append(environ)
+    def user_exists(self, username):
+        return username == 'test'
+    def user_has_password(self, username, password):
+        return password == 'test'
+
+class ProcessCountingUsers(CountingUsers):
+    instance_scope = 'process'
+    created = []
+
+def test_users_instance_scope():
+    from authkit.authenticate import UsersProxy, AddUsersObjectToEnviron
+    seen = []
+    def app(environ, start_response):
+        seen.append(environ['authkit.users'])
+        if environ['PATH_INFO'] == '/private':
+            assertEqual(environ['authkit.users'].user_exists('test'), True)
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return ['OK']
+    for users_class, first, expected, stats in [
+        (CountingUsers, 0, 3, {'requests': 4, 'used': 3, 'unused': 1}), 
+        (ProcessCountingUsers, 0, 1, {'requests': 4, 'used': 3, 'unused': 1}),
+    ]:
+        users_app = AddUsersObjectToEnviron(app, 'authkit.users', users_class)
+        test_app = TestApp(users_app)
+        # Objects aren't created by requests which don't use them
+        test_app.get('/')
+        assertEqual(len(users_class.created), first)
+        for i in range(3):
+            test_app.get('/private')
+        assertEqual(len(users_class.created), expected)
+        assertEqual(users_app.stats(), stats)
+    # The proxies pass for the users class without creating the object
+    assertEqual(seen[0]._users, None)
+    assert isinstance(seen[0], CountingUsers)
+    assert isinstance(seen[4], ProcessCountingUsers)
+    assertEqual(seen[0]._users, None)
+    # Objects created for each request get the request's environ
+    for users in seen[1:4]:
+        assert isinstance(users, UsersProxy)
+        assert users.users.environ is users.environ
+    assertEqual(len(set([id(users.users) for users in seen[1:4]])), 3)
+    for users in seen[4:]:
+        assert isinstance(users, UsersProxy)
+        assert users.environ is not None
+    for users in seen[5:]:
+        assert users.users is seen[5].users
+        assert users.users.environ is None
+
+def test_permission_cache():
+    from authkit.authorize import authorized
+    from authkit.permissions import RequestPermission, RemoteUser, And, \
+       BetweenTimes, NotAuthenticatedError
+    import datetime
+    class CountingPermission(RequestPermission):
+        cacheable = True
+        def __init__(self):
+            self.checks = []
+        def check(self, app, environ, start_response):
+            self.checks.append(environ.get('REMOTE_USER'))
+            if not environ.get('REMOTE_USER'):
+                raise NotAuthenticatedError('Not Authenticated')
+            return app(environ, start_response)
+    # Custom permissions have to opt in to the cache
+    assertEqual(RequestPermission().cacheable, False)
+    assertEqual(RemoteUser().cacheable, True)
+    permission = CountingPermission()
+    environ = {'authkit.config': {'setup.enable': True}}
+    for i in range(3):
+        assertEqual(authorized(environ, permission), False)
+    environ['REMOTE_USER'] = 'james'
+    for i in range(3):
+        assertEqual(authorized(environ, permission), True)
+    assertEqual(permission.checks, [None, 'james'])
+    # A permission whose decision can change during a request isn't cached
+    start = datetime.time(0, 0)
+    end = datetime.time(23, 59, 59, 999999)
+    class UncachedPermission(CountingPermission):
+        cacheable = False
+    uncached = UncachedPermission()
+    between = And(CountingPermission(), BetweenTimes(start, end))
+    assertEqual(permission.cacheable, True)
+    assertEqual(between.cacheable, False)
+    assertEqual(And(RemoteUser(), CountingPermission()).cacheable, True)
+    for i in range(3):
+        assertEqual(authorized(environ, between), True)
+        assertEqual(authorized(environ, uncached), True)
+    assertEqual(len(uncached.checks), 3)
+    # The request-based part of the And is still only checked once
+    assertEqual(len(between.permissions[-1].checks), 1)
+
+def test_permission_evaluate():
+    from authkit.authorize import authorized, authorize_request, evaluator
+    from authkit.authorize import NotAuthorizedError, NotAuthenticatedError
+    from authkit.permissions import UserIn, Exists, And, RemoteUser, \
+       HasAuthKitRole, HasAuthKitGroup, ValidAuthKitUser, FromIP
+    from authkit.users import UsersFromString
+    users = UsersFromString('''
+        james:password1:pylons admin
+        ben:password2 editor
+        simon:password3:django
+    ''')
+    permissions = [
+        UserIn(['james', 'ben']),
+        Exists('authkit.test'),
+        RemoteUser(),
+        RemoteUser(accept_empty=True),
+        HasAuthKitRole(['admin', 'editor']),
+        HasAuthKitRole(['admin', 'editor'], all=True),
+        HasAuthKitGroup(['pylons', 'django']),
+        HasAuthKitGroup('pylons'),
+        ValidAuthKitUser(),
+        FromIP('127.0.0.1'),
+        And(RemoteUser(), HasAuthKitRole('admin'), FromIP(['127.0.0.1'])),
+    ]
+    environs = []
+    for username in [None, '', 'james', 'ben', 'simon', 'nobody']:
+        for ip in ['127.0.0.1', '10.0.0.1']:
+            environ = {
+                'authkit.config': {'setup.enable': True},
+                'authkit.users': users,
+                'REMOTE_ADDR': ip,
+            }
+            if username is not None:
+                environ['REMOTE_USER'] = username
+            if ip == '127.0.0.1':
+                environ['authkit.test'] = True
+            environs.append(environ)
+    for permission in permissions:
+        assert evaluator(permission) is not None
+        for environ in environs:
+            try:
+                authorize_request(dict(environ), permission)
+            except (NotAuthorizedError, NotAuthenticatedError):
+                expected = False
+            else:
+                expected = True
+            assertEqual(authorized(dict(environ), permission), expected)
+    # Subclasses which change check() without evaluate() aren't trusted
+    class OnlyJames(RemoteUser):
+        def check(self, app, environ, start_response):
+            if environ.get('REMOTE_USER') != 'james':
+                raise NotAuthorizedError('Not James')
+            return app(environ, start_response)
+    assertEqual(evaluator(OnlyJames()), None)
+    assertEqual(evaluator(And(RemoteUser(), OnlyJames())), None)
+    environ = environs[6]
+    assertEqual(environ['REMOTE_USER'], 'ben')
+    assertEqual(authorized(environ, OnlyJames()), False)
+    assertEqual(authorized(environ, And(RemoteUser(), OnlyJames())), False)
+
+def test_and_permission():
+    from authkit.authorize import NotAuthorizedError, NotAuthenticatedError
+    from authkit.permissions import Permission, And, RemoteUser, UserIn, \
+       Exists, PermissionSetupError
+    calls = []
+    def app(environ, start_response):
+        calls.append('app')
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return ['OK']
+    class ResponsePermission(Permission):
+        def __init__(self, name):
+            self.name = name
+        def check(self, app, environ, start_response):
+            calls.append(self.name)
+            return app(environ, start_response)
+    def start_response(status, headers, exc_info=None):
+        pass
+    environ = {'authkit.config': {'setup.enable': True}, 'REMOTE_USER': 'james'}
+    permission = And(
+        ResponsePermission('first'), 
+        RemoteUser(), 
+        UserIn(['james']), 
+        ResponsePermission('second'),
+    )
+    assertEqual(permission.check(app, dict(environ), start_response), ['OK'])
+    assertEqual(calls, ['first', 'second', 'app'])
+    # The error is the one raised by the first request-based permission to fail
+    for env, error in [
+        ({}, NotAuthenticatedError), 
+        ({'REMOTE_USER': 'ben'}, NotAuthorizedError),
+    ]:
+        env['authkit.config'] = {'setup.enable': True}
+        calls = []
+        try:
+            permission.check(app, env, start_response)
+        except error:
+            pass
+        else:
+            raise AssertionError('Expected %s'%error.__name__)
+        assertEqual(calls, [])
+    # A refused request decides the failing permission once and gets its
+    # own error
+    class CountingUserIn(UserIn):
+        decisions = 0
+        def check(self, app, environ, start_response):
+            self.decisions += 1
+            return UserIn.check(self, app, environ, start_response)
+        def evaluate(self, environ):
+            self.decisions += 1
+            return UserIn.evaluate(self, environ)
+    counting = CountingUserIn(['james'])
+    env = {'authkit.config': {'setup.enable': True}, 'REMOTE_USER': 'ben'}
+    try:
+        And(RemoteUser(), counting).check(app, env, start_response)
+    except NotAuthorizedError, e:
+        assert 'not one of the users allowed' in str(e), str(e)
+    else:
+        raise AssertionError('Expected NotAuthorizedError')
+    assertEqual(counting.decisions, 1)
+    try:
+        And(RemoteUser())
+    except PermissionSetupError:
+        pass
+    else:
+        raise AssertionError('Expected PermissionSetupError')
+    # A request permission which wraps start_response is still checked 
+    # against the real response, whether or not it is cacheable
+    from authkit.authorize import middleware
+    from authkit.permissions import RequestPermission
+    class AddHeader(RequestPermission):
+        def check(self, app, environ, start_response):
+            def header_start_response(status, headers, exc_info=None):
+                return start_response(
+                    status, 
+                    headers + [('X-Perm', 'yes')], 
+                    exc_info,
+                )
+            return app(environ, header_start_response)
+    class CacheableAddHeader(AddHeader):
+        cacheable = True
+    for add_header in [AddHeader(), CacheableAddHeader()]:
+        for permission in [add_header, And(RemoteUser(), add_header)]:
+            responses = []
+            def start_response(status, headers, exc_info=None):
+                responses.append(headers)
+            calls = []
+            assertEqual(
+                middleware(app, permission)(dict(environ), start_response), 
+                ['OK'],
+            )
+            assertEqual(calls, ['app'])
+            assertEqual(responses, [
+                [('Content-type', 'text/plain'), ('X-Perm', 'yes')]
+            ])
+
+def test_combined_permissions():
+    from authkit.authorize import authorized, authorize_request, evaluator
+    from authkit.authorize import NotAuthorizedError, NotAuthenticatedError
+    from authkit.permissions import Permission, RequestPermission, And, Or, \
+       AnyOf, Not, RemoteUser, UserIn, FromIP, HasAuthKitRole, \
+       PermissionSetupError
+    from authkit.users import UsersFromString
+    users = UsersFromString('''
+        james:password1 admin
+        ben:password2 editor
+    ''')
+    checked = []
+    class Recorded(RequestPermission):
+        def __init__(self, name, result, cost=10):
+            self.name = name
+            self.result = result
+            self.cost = cost
+        def check(self, app, environ, start_response):
+            checked.append(self.name)
+            if not self.result:
+                raise NotAuthorizedError('Not Authorized')
+            return app(environ, start_response)
+    def environ(username=None, ip='127.0.0.1'):
+        environ = {
+            'authkit.config': {'setup.enable': True},
+            'authkit.users': users,
+            'REMOTE_ADDR': ip,
+        }
+        if username is not None:
+            environ['REMOTE_USER'] = username
+        return environ
+    # Cheapest first and short-circuiting
+    permission = Or(
+        Recorded('expensive', True, 100), 
+        Recorded('cheap', True, 1), 
+        Recorded('middle', False, 5),
+    )
+    assertEqual(evaluator(permission), None)
+    assertEqual(authorized(environ('james'), permission), True)
+    assertEqual(checked, ['cheap'])
+    checked = []
+    permission = AnyOf(
+        [Recorded('a', True, 3), Recorded('b', False, 2), 
+         Recorded('c', False, 1)], 
+        count=2,
+    )
+    assertEqual(authorized(environ('james'), permission), False)
+    assertEqual(checked, ['c', 'b'])
+    # Built-in permissions are evaluated directly
+    admin_or_local = Or(HasAuthKitRole('admin'), FromIP('127.0.0.1'))
+    assertEqual([p.__class__ for p in admin_or_local.permissions], 
+                [FromIP, HasAuthKitRole])
+    assertEqual(admin_or_local.cost, 51)
+    not_ben = And(RemoteUser(), Not(UserIn(['ben'])))
+    two_of = AnyOf(
+        [RemoteUser(), FromIP('127.0.0.1'), HasAuthKitRole('editor')],
+        count=2,
+    )
+    for permission, results in [
+        (admin_or_local, [True, True, True, False, True]),
+        (not_ben, [False, True, False, False, True]),
+        (two_of, [False, True, True, True, False]),
+    ]:
+        assert evaluator(permission) is not None
+        for env, expected in zip([
+            environ(), environ('james'), environ('ben'), 
+            environ('ben', '10.0.0.1'), environ('james', '10.0.0.1'),
+        ], results):
+            assertEqual(authorized(dict(env), permission), expected)
+            try:
+                authorize_request(dict(env), permission)
+            except (NotAuthorizedError, NotAuthenticatedError):
+                assertEqual(expected, False)
+            else:
+                assertEqual(expected, True)
+    try:
+        authorize_request(environ(ip='10.0.0.1'), admin_or_local)
+    except NotAuthenticatedError:
+        pass
+    else:
+        raise AssertionError('Expected NotAuthenticatedError')
+    try:
+        authorize_request(environ('ben', '10.0.0.1'), admin_or_local)
+    except NotAuthorizedError:
+        pass
+    else:
+        raise AssertionError('Expected NotAuthorizedError')
+    # Only request-based permissions can be combined
+    for args in [
+        (Or, (RemoteUser(), Permission())),
+        (Not, (And(RemoteUser(), Permission()),)),
+        (AnyOf, ([RemoteUser()], 2)),
+        (Or, (RemoteUser(),)),
+    ]:
+        try:
+            args[0](*args[1])
+        except PermissionSetupError:
+            pass
+        else:
+            raise AssertionError('Expected PermissionSetupError for %r'%(args,))
+
+def test_role_and_group_lookups():
+    from authkit.authorize import authorized
+    from authkit.permissions import HasAuthKitRole, HasAuthKitGroup, \
+       PermissionRegistry
+    from authkit.users import UsersFromString
+    calls = []
+    class CountingUsersFromString(UsersFromString):
+        def __getattribute__(self, name):
+            if name in ['user_exists', 'role_exists', 'group_exists', 
+                        'list_roles', 'list_groups', 'user_role_set', 'user_has_role', 'user_group', 
+                        'user_has_group']:
+                calls.append(name)
+            return UsersFromString.__getattribute__(self, name)
+    users = CountingUsersFromString('''
+        james:password1:pylons admin wiki
+        ben:password2:django editor
+    ''')
+    registry = PermissionRegistry(users)
+    registry.validate()
+    def environ(username, registry=registry):
+        return {
+            'authkit.config': {'setup.enable': True},
+            'authkit.users': users,
+            'authkit.permissions': registry,
+            'REMOTE_USER': username,
+        }
+    any_role = HasAuthKitRole(['Admin', 'editor', 'wiki'])
+    all_roles = HasAuthKitRole(['admin', 'WIKI'], all=True)
+    group = HasAuthKitGroup(['Pylons', None])
+    for username, expected in [
+        ('james', [True, True, True]), 
+        ('ben', [True, False, False]), 
+        ('nobody', [False, False, False]),
+        ('james', [True, True, True]), 
+    ]:
+        calls[:] = []
+        assertEqual(
+            [
+                authorized(environ(username), any_role), 
+                authorized(environ(username), all_roles), 
+                authorized(environ(username), group),
+            ],
+            expected,
+        )
+        # The roles and groups are validated against the catalog so there
+        # is one lookup each, which also tells if the user exists
+        assertEqual(calls, [
+            'user_role_set',
+            'user_role_set', 
+            'user_group',
+        ])
+    # Without a catalog the names are checked with the users object, once
+    # for each users class
+    calls[:] = []
+    assertEqual(authorized(environ('james', None), all_roles), True)
+    assertEqual(calls, ['user_role_set', 'role_exists', 'role_exists'])
+    calls[:] = []
+    assertEqual(authorized(environ('james', None), all_roles), True)
+    assertEqual(calls, ['user_role_set'])
+    # Missing roles and groups are still reported
+    for permission in [HasAuthKitRole(['admin', 'nosuchrole']), 
+                       HasAuthKitGroup('nosuchgroup')]:
+        for registry_ in [registry, None]:
+            try:
+                authorized(environ('james', registry_), permission)
+            except Exception, e:
+                assert 'No such' in str(e)
+            else:
+                raise AssertionError('Expected the missing name to be reported')
+
+def test_digest_password_lookup():
+    from authkit.authenticate import digest_password
+    from authkit.authenticate import digest
+    from authkit.users import UsersFromString
+    calls = []
+    class CountingUsersFromString(UsersFromString):
+        def __getattribute__(self, name):
+            if name in ['user_exists', 'user', 'user_password']:
+                calls.append(name)
+            return UsersFromString.__getattribute__(self, name)
+    environ = {
+        'authkit.users': CountingUsersFromString('james:password1:pylons admin'),
+    }
+    assertEqual(
+        digest_password(environ, 'realm', 'James'),
+        digest.digest_password('realm', 'James', 'password1'),
+    )
+    # The password is found with one lookup which also tells if the user 
+    # exists
+    assertEqual(calls, ['user'])
+    calls[:] = []
+    assertEqual(digest_password(environ, 'realm', 'nobody'), None)
+    assertEqual(calls, ['user'])
+
+def test_lookup_user_fallback():
+    from authkit.authorize import authorized, authorize_request
+    from authkit.authorize import NotAuthorizedError
+    from authkit.authenticate import digest_password
+    from authkit.permissions import HasAuthKitRole, HasAuthKitGroup
+    from authkit.users import UsersFromString, AuthKitError
+    class StrictUsers(UsersFromString):
+        # A custom driver which doesn't raise AuthKitNoSuchUserError
+        broken = False
+        def _check(self, username):
+            if self.broken:
+                raise AuthKitError('Backend unavailable')
+            if not self.user_exists(username):
+                raise AuthKitError('Unknown user %r'%username)
+        def user(self, username):
+            self._check(username)
+            return UsersFromString.user(self, username)
+        def user_role_set(self, username):
+            self._check(username)
+            return UsersFromString.user_role_set(self, username)
+        def user_group(self, username):
+            self._check(username)
+            return UsersFromString.user_group(self, username)
+    users = StrictUsers('james:password1:pylons admin')
+    environ = {
+        'authkit.config': {'setup.enable': True},
+        'authkit.users': users,
+        'REMOTE_USER': 'nobody',
+    }
+    # Unknown users are treated as missing rather than as errors
+    for permission in [HasAuthKitRole('admin'), HasAuthKitGroup('pylons')]:
+        assertEqual(authorized(environ, permission), False)
+        try:
+            authorize_request(dict(environ), permission)
+        except NotAuthorizedError:
+            pass
+        else:
+            raise AssertionError('Expected a NotAuthorizedError')
+    assertEqual(digest_password(environ, 'realm', 'nobody'), None)
+    environ['REMOTE_USER'] = 'james'
+    assertEqual(authorized(environ, HasAuthKitRole('admin')), True)
+    # Other failures for users that exist are still raised
+    users.broken = True
+    for check in [
+        lambda: authorized(environ, HasAuthKitRole('admin')),
+        lambda: authorized(environ, HasAuthKitGroup('pylons')),
+        lambda: digest_password(environ, 'realm', 'james'),
+    ]:
+        try:
+            check()
+        except AuthKitError, e:
+            assertEqual(str(e), 'Backend unavailable')
+        else:
+            raise AssertionError('Expected the AuthKitError to be raised')
+
+def test_validate_permissions():
+    import time
+    from authkit.authenticate import middleware as authenticate_middleware
+    from authkit.authorize import middleware as authorize_middleware
+    from authkit.permissions import HasAuthKitRole, HasAuthKitGroup, Or, \
+       RemoteUser, PermissionSetupError, PermissionRegistry, \
+       validate_permissions
+    from authkit.users import UsersFromString
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return ['OK']
+    bad_role = HasAuthKitRole(['admin', 'nosuchrole'])
+    bad_group = Or(RemoteUser(), HasAuthKitGroup('nosuchgroup'))
+    good = HasAuthKitRole('admin')
+    users = UsersFromString('james:password1:pylons admin')
+    try:
+        validate_permissions(users, [bad_role, bad_group, good])
+    except PermissionSetupError, e:
+        assertEqual(
+            str(e), 
+            "No such group 'nosuchgroup' exists. No such role 'nosuchrole' "
+            "exists"
+        )
+    else:
+        raise AssertionError('Expected a PermissionSetupError')
+    catalog = validate_permissions(users, [good])
+    assertEqual(catalog.roles, frozenset(['admin']))
+    assertEqual(catalog.groups, frozenset(['pylons']))
+    # The authenticate middleware validates the permissions in its own 
+    # stack when it is set up
+    config = dict(
+        setup_method='basic', 
+        basic_realm='Test Realm', 
+        basic_authenticate_user_data='james:password1:pylons admin',
+        setup_validate='true',
+    )
+    try:
+        authenticate_middleware(authorize_middleware(app, bad_role), **config)
+    except PermissionSetupError:
+        pass
+    else:
+        raise AssertionError('Expected a PermissionSetupError')
+    # Each stack has its own registry so a permission for another stack's 
+    # users isn't validated against these ones
+    editor = HasAuthKitRole('editor')
+    editor_app = authenticate_middleware(
+        authorize_middleware(app, editor), 
+        setup_method='basic', 
+        basic_authenticate_user_data='ben:password2:django editor',
+        setup_validate='true',
+    )
+    registries = []
+    def registry_app(environ, start_response):
+        registries.append(environ['authkit.permissions'])
+        return app(environ, start_response)
+    test_app = TestApp(authenticate_middleware(
+        authorize_middleware(registry_app, good), 
+        **config
+    ))
+    test_app.get('/', extra_environ={'REMOTE_USER': 'james'})
+    registry = registries[0]
+    assertEqual(registry.permissions.keys(), [good])
+    assert editor not in registry.permissions
+    TestApp(editor_app).get('/', extra_environ={'REMOTE_USER': 'ben'})
+    # Requests never build the catalog themselves
+    calls = []
+    class CountingUsers(UsersFromString):
+        def list_roles(self):
+            calls.append('list_roles')
+            return UsersFromString.list_roles(self)
+    registry = PermissionRegistry(CountingUsers('james:password1:pylons admin'))
+    environ = {
+        'authkit.config': {'setup.enable': True},
+        'authkit.users': registry.users,
+        'authkit.permissions': registry,
+        'REMOTE_USER': 'james',
+    }
+    from authkit.authorize import authorized
+    for i in range(3):
+        assertEqual(authorized(dict(environ), good), True)
+    assertEqual(calls, [])
+    assertEqual(registry.catalog, None)
+    # The catalog is built and replaced in the background by a refresher 
+    # started on first use in each process
+    registry.interval = 0.01
+    registry.current_catalog()
+    refresher = registry.refresher
+    time.sleep(0.1)
+    refresher.stop()
+    refresher.join()
+    assert len(calls) > 1
+    assertEqual(authorized(dict(environ), good), True)
+    assertEqual(registry.versions[good], registry.catalog.version)
+    # Only weak references to the permissions are kept
+    import gc
+    temporary = HasAuthKitRole('admin')
+    registry.add([temporary])
+    assertEqual(len(registry.permissions), 2)
+    del temporary
+    gc.collect()
+    assertEqual(registry.permissions.keys(), [good])
+
+def test_from_ip():
+    from authkit.authorize import authorized
+    from authkit.permissions import FromIP, AddressSet, PermissionSetupError
+    addresses = AddressSet([
+        '127.0.0.1', 
+        'localhost',
+        '10.0.0.0/8', 
+        '192.168.4.0/22', 
+        '172.16.0.0/12', 
+        '2001:db8::/32',
+        '2001:db8::/48',
+        'fe80::1',
+    ])
+    for address, expected in [
+        ('127.0.0.1', True),
+        ('127.0.0.2', False),
+        ('localhost', True),
+        ('10.255.1.2', True),
+        ('11.0.0.1', False),
+        ('192.168.3.255', False),
+        ('192.168.4.0', True),
+        ('192.168.7.255', True),
+        ('192.168.8.0', False),
+        ('172.31.255.255', True),
+        ('172.32.0.0', False),
+        ('::ffff:10.1.2.3', True),
+        ('2001:db8:ffff::1', True),
+        ('2001:db9::1', False),
+        ('FE80:0:0::1', True),
+        ('fe80::2', False),
+        ('not an address', False),
+        ('', False),
+    ]:
+        assertEqual((address, address in addresses), (address, expected))
+    assertEqual('1.2.3.4' in AddressSet(['0.0.0.0/0']), True)
+    assertEqual('::1' in AddressSet(['0.0.0.0/0']), False)
+    for network in ['10.0.0.0/33', '10.0.0/8', 'nonsense/8', '::/129']:
+        try:
+            AddressSet([network])
+        except PermissionSetupError:
+            pass
+        else:
+            raise AssertionError('Expected %r to be rejected'%network)
+    # Thousands of networks
+    networks = []
+    for i in range(64):
+        for j in range(64):
+            networks.append('10.%s.%s.0/24'%(i, j*4))
+    addresses = AddressSet(networks)
+    assertEqual('10.63.252.9' in addresses, True)
+    assertEqual('10.63.253.9' in addresses, False)
+    # Trusted proxies
+    def environ(remote_addr, forwarded=None):
+        environ = {
+            'authkit.config': {'setup.enable': True},
+            'REMOTE_ADDR': remote_addr,
+        }
+        if forwarded is not None:
+            environ['HTTP_X_FORWARDED_FOR'] = forwarded
+        return environ
+    permission = FromIP('192.168.0.0/16', trusted_proxies=['10.0.0.0/8'])
+    for env, expected in [
+        (environ('192.168.1.1'), True),
+        (environ('192.168.1.1', '8.8.8.8'), True),
+        (environ('10.0.0.1'), False),
+        (environ('10.0.0.1', '192.168.1.1'), True),
+        (environ('10.0.0.1', '8.8.8.8, 192.168.1.1, 10.0.0.2'), True),
+        (environ('10.0.0.1', '192.168.1.1, 8.8.8.8'), False),
+        (environ('10.0.0.1', '10.0.0.3, 10.0.0.2'), False),
+    ]:
+        assertEqual(authorized(env, permission), expected)
+    assertEqual(authorized(environ('10.1.1.1'), FromIP(['10.1.1.1'])), True)
+
+def test_between_times():
+    import datetime, time
+    from authkit.permissions import BetweenTimes, PermissionSetupError
+    # 2009-06-01 is a Monday
+    def at(day, hour, minute=0, second=0):
+        return datetime.datetime(2009, 6, day, hour, minute, second)
+    office = BetweenTimes(
+        datetime.time(9), 
+        datetime.time(17, 30), 
+        days=['mon', 'Tuesday', 2, 3, 'fri'],
+    )
+    night = BetweenTimes(
+        datetime.time(22), 
+        datetime.time(6), 
+        days=['fri'],
+    )
+    for permission, now, expected in [
+        (office, at(1, 8, 59, 59), (False, 1)),
+        (office, at(1, 9), (True, 900)),
+        (office, at(1, 17, 20), (True, 600)),
+        (office, at(1, 17, 30), (False, 900)),
+        (office, at(6, 12), (False, 900)),
+        (night, at(5, 21, 50), (False, 600)),
+        (night, at(5, 23), (True, 900)),
+        (night, at(6, 5, 55), (True, 300)),
+        (night, at(6, 6), (False, 900)),
+        (night, at(6, 23), (False, 900)),
+        (night, at(4, 3), (False, 900)),
+    ]:
+        assertEqual(permission.decide(now), expected)
+    for days in [['someday'], [7]]:
+        try:
+            BetweenTimes(datetime.time(9), datetime.time(17), days=days)
+        except PermissionSetupError:
+            pass
+        else:
+            raise AssertionError('Expected %r to be rejected'%days)
+    # Decisions are remembered until they could next change
+    always = BetweenTimes(datetime.time(0), datetime.time(0))
+    assertEqual(always.evaluate({}), True)
+    until, result = always.decision
+    assert until > time.time()
+    always.decision = (until, False)
+    assertEqual(always.evaluate({}), False)
+    always.decision = (0, False)
+    assertEqual(always.evaluate({}), True)
+    # Times can be in a particular timezone
+    class Offset(datetime.tzinfo):
+        def __init__(self, hours):
+            self.offset = datetime.timedelta(hours=hours)
+        def utcoffset(self, dt):
+            return self.offset
+        def dst(self, dt):
+            return datetime.timedelta(0)
+    utc_hour = datetime.datetime.utcnow().hour
+    if datetime.datetime.utcnow().minute < 59:
+        for hours in [0, 5, -7]:
+            hour = (utc_hour + hours) % 24
+            permission = BetweenTimes(
+                datetime.time(hour), 
+                datetime.time((hour + 1) % 24), 
+                tzinfo=Offset(hours),
+            )
+            assertEqual(permission.evaluate({}), True)
+
+def test_user_in():
+    import tempfile, time
+    from authkit.authorize import authorized
+    from authkit.permissions import UserIn, PermissionSetupError
+    def environ(username):
+        return {
+            'authkit.config': {'setup.enable': True},
+            'REMOTE_USER': username,
+        }
+    permission = UserIn(['James', 'ben'])
+    assertEqual(permission.users, frozenset(['james', 'ben']))
+    for username, expected in [
+        ('james', True), ('JAMES', True), ('Ben', True), ('simon', False)
+    ]:
+        assertEqual(authorized(environ(username), permission), expected)
+    assertEqual(authorized(environ('JAMES'), UserIn('James')), True)
+    # Users can be loaded from a file which is reloaded when it changes
+    fd, filename = tempfile.mkstemp()
+    try:
+        fp = os.fdopen(fd, 'w')
+        fp.write('# Allowed users\nSimon\n\n')
+        for i in range(20000):
+            fp.write('user%s\n'%i)
+        fp.close()
+        permission = UserIn(['james'], filename=filename)
+        permission.reload_interval = 0
+        assertEqual(len(permission.users), 20002)
+        for username, expected in [
+            ('james', True), ('simon', True), ('User19999', True), 
+            ('ben', False),
+        ]:
+            assertEqual(authorized(environ(username), permission), expected)
+        users = permission.users
+        assertEqual(authorized(environ('user1'), permission), True)
+        assert permission.users is users
+        fp = open(filename, 'w')
+        fp.write('ben\n')
+        fp.close()
+        os.utime(filename, (time.time(), permission.mtime + 10))
+        assertEqual(authorized(environ('ben'), permission), True)
+        assertEqual(authorized(environ('simon'), permission), False)
+        assertEqual(authorized(environ('james'), permission), True)
+        # If the file can't be read the previous users are kept
+        os.remove(filename)
+        assertEqual(authorized(environ('ben'), permission), True)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+    for args in [{}, {'users': 1}, {'filename': filename}]:
+        try:
+            UserIn(**args)
+        except PermissionSetupError:
+            pass
+        else:
+            raise AssertionError('Expected %r to be rejected'%args)
+
+def test_acl():
+    from authkit.authenticate import middleware as authenticate_middleware
+    from authkit.authorize.acl import ACL, parse_rules
+    from authkit.permissions import RemoteUser, PermissionSetupError
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return ['OK']
+    rules = '''
+        # Admin pages
+        /admin          *          HasAuthKitRole('admin')
+        /admin/help     GET        None
+        /users/*/edit   GET,POST   HasAuthKitGroup('pylons')
+        /users/ben/edit POST       UserIn('ben')
+        /               POST       RemoteUser()
+    '''
+    acl = ACL(app, rules, default="Exists('authkit.test')")
+    assertEqual(len(parse_rules(rules)), 5)
+    admin = acl.match('/admin', 'GET')
+    for path, method, expected in [
+        ('/admin', 'GET', admin),
+        ('/admin/', 'POST', admin),
+        ('/admin/users/1', 'DELETE', admin),
+        ('/administrator', 'GET', None),
+        ('/admin/help', 'GET', app),
+        ('/admin/help', 'POST', admin),
+        ('/', 'GET', None),
+        ('/users/ben', 'GET', None),
+    ]:
+        assert acl.match(path, method) is expected, (path, method)
+    assertEqual(acl.match('/users/james/edit', 'GET').permission.groups, 
+                ['pylons'])
+    assertEqual(acl.match('/users/ben/edit', 'GET').permission.groups, 
+                ['pylons'])
+    assertEqual(acl.match('/users/ben/edit', 'POST').permission.users, 
+                frozenset(['ben']))
+    assertEqual(acl.match('/users/ben/edit/more', 'PUT'), None)
+    assert isinstance(acl.match('/other', 'POST').permission, RemoteUser)
+    # Rules with the same expression share the permission object
+    acl = ACL(app, [
+        ('/a', '*', 'RemoteUser()'), 
+        ('/b', ['GET'], 'RemoteUser()'),
+    ])
+    assert acl.match('/a', 'GET').permission is \
+       acl.match('/b', 'GET').permission
+    for rules in [
+        '/admin *', 
+        'admin * RemoteUser()', 
+        '/admin * NoSuchPermission()',
+        '/admin GET RemoteUser()\n/admin GET,POST None',
+        '/admin GET 42',
+    ]:
+        try:
+            ACL(app, rules)
+        except PermissionSetupError:
+            pass
+        else:
+            raise AssertionError('Expected %r to be rejected'%rules)
+    # Through the authenticate middleware
+    test_app = TestApp(authenticate_middleware(
+        ACL(app, '''
+            /admin      *    HasAuthKitRole('admin')
+            /admin/help GET  None
+        '''),
+        setup_method='basic', 
+        basic_realm='Test Realm', 
+        basic_authenticate_user_data='''
+            james:password1:pylons admin
+            ben:password2
+        ''',
+    ))
+    for path, username, status in [
+        ('/', None, 200),
+        ('/admin/help', None, 200),
+        ('/admin', None, 401),
+        ('/admin', 'ben', 403),
+        ('/admin/users', 'james', 200),
+    ]:
+        extra_environ = {}
+        if username:
+            extra_environ['REMOTE_USER'] = username
+        res = test_app.get(path, extra_environ=extra_environ, status=status)
+
+def test_users_index():
+    from authkit.users import UsersFromString, UsersReadOnly, \
+       AuthKitNoSuchUserError
+    users = UsersFromString('''
+        james:password1:pylons admin wiki
+        ben:password2:pylons editor
+        simon:password3:django wiki
+        ian:password4
+    ''')
+    index = users.index
+    assertEqual(index.user_list, ('ben', 'ian', 'james', 'simon'))
+    assertEqual(index.role_list, ('admin', 'editor', 'wiki'))
+    assertEqual(index.group_list, ('django', 'pylons'))
+    assertEqual(index.role_users, {
+        'admin': ('james',), 
+        'editor': ('ben',), 
+        'wiki': ('james', 'simon'),
+    })
+    assertEqual(index.group_users, {
+        'django': ('simon',), 
+        'pylons': ('ben', 'james'),
+    })
+    assertEqual(index.user_role_sets['ian'], frozenset())
+    assertEqual(users.user_role_set('JAMES'), frozenset(['admin', 'wiki']))
+    assertEqual(users.user_has_role('simon', 'WIKI'), True)
+    assertEqual(users.role_exists('Editor'), True)
+    assertEqual(users.group_exists('nosuchgroup'), False)
+    # The lists returned are copies
+    users.list_users().append('nobody')
+    assertEqual(users.list_users(), ['ben', 'ian', 'james', 'simon'])
+    # Subclasses which only set the attributes get an index built for them
+    class Users(UsersReadOnly):
+        def __init__(self):
+            self.usernames = ['james']
+            self.passwords = {'james': 'password1'}
+            self.roles = {'james': ['admin']}
+            self.groups = {'james': None}
+    users = Users()
+    assertEqual(users.index, None)
+    assertEqual(users.user_has_role('James', 'admin'), True)
+    assertEqual(users.list_groups(), [])
+    try:
+        users.user_roles('nobody')
+    except AuthKitNoSuchUserError:
+        pass
+    else:
+        raise AssertionError('Expected an AuthKitNoSuchUserError')
+
+def test_reloading_users_from_file():
+    import tempfile, time
+    from authkit.users import ReloadingUsersFromFile
+    fd, filename = tempfile.mkstemp()
+    def write(data, mtime):
+        fp = open(filename, 'w')
+        fp.write(data)
+        fp.close()
+        os.utime(filename, (mtime, mtime))
+    try:
+        os.close(fd)
+        now = time.time()
+        write('james:password1:pylons admin\n', now - 30)
+        users = ReloadingUsersFromFile(filename, reload_interval=0)
+        assertEqual(users.list_users(), ['james'])
+        assertEqual(users.usernames, ['james'])
+        assertEqual(users.check(), False)
+        index = users.index
+        write('james:password1:pylons admin\nben:password2 editor\n', now - 20)
+        assertEqual(users.check(), True)
+        assert users.index is not index
+        assertEqual(users.list_users(), ['ben', 'james'])
+        assertEqual(users.user_has_role('ben', 'editor'), True)
+        assertEqual(users.roles['ben'], ['editor'])
+        # A broken file keeps the previous users
+        write('james:password1\njames:password2\n', now - 10)
+        assertEqual(users.check(), False)
+        assertEqual(users.list_users(), ['ben', 'james'])
+        assertEqual(users.check(), False)
+        os.remove(filename)
+        assertEqual(users.check(), False)
+        assertEqual(users.list_users(), ['ben', 'james'])
+        # The file is checked in the background
+        write('simon:password3\n', now)
+        users = ReloadingUsersFromFile(filename, reload_interval=0.01)
+        # The thread is only started by the first lookup in the process
+        assertEqual(users.thread, None)
+        assertEqual(users.user_exists('simon'), True)
+        thread = users.thread
+        assert thread.isAlive()
+        assertEqual(users.user_exists('simon'), True)
+        assert users.thread is thread
+        write('ian:password4\n', now + 10)
+        for i in range(100):
+            if users.user_exists('ian'):
+                break
+            time.sleep(0.01)
+        users.stop()
+        users.thread.join()
+        assertEqual(users.list_users(), ['ian'])
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def test_parse_users():
+    from authkit.users import parse, parse_lines
+    from authkit.permissions import AuthKitConfigError
+    usernames, passwords, roles, groups = parse('''
+        James:Password1:Pylons wiki  Admin
+        ben:password2 editor\t
+
+        simon:password3:
+    ''')
+    assertEqual(usernames, ['ben', 'james', 'simon'])
+    assertEqual(passwords, 
+        {'james': 'Password1', 'ben': 'password2', 'simon': 'password3'})
+    assertEqual(roles, {'james': ['admin', 'wiki'], 'ben': ['editor'], 
+                        'simon': []})
+    assertEqual(groups, {'james': 'pylons', 'ben': None, 'simon': None})
+    # Any iterable of lines can be parsed
+    assertEqual(parse_lines(iter(['a:b c\n', 'd:e c\n']))[2], 
+                {'a': ['c'], 'd': ['c']})
+    # Only spaces separate the fields, as they always have
+    assertEqual(parse('a:b\tc d')[1], {'a': 'b\tc'})
+    for data, message in [
+        ('james:password1\n\nben', 'Syntax error on line 3'),
+        ('james:password1\nben:password2:group:extra', 'Syntax error on line 2'),
+        ('james:', "Password for 'james' on line 1"),
+        (':password1', 'Username on line 1'),
+        ('james:password1\nben:password2\nJames:password3', 
+         "Username 'james' on line 3 is already defined"),
+    ]:
+        try:
+            parse(data)
+        except AuthKitConfigError, e:
+            assert str(e).startswith(message), str(e)
+        else:
+            raise AssertionError('Expected %r to be rejected'%data)
+
+def test_compact_users():
+    import tempfile
+    from authkit.users import UsersFromString, CompactUsersFromString, \
+        CompactUsersFromFile, parse_table, AuthKitNoSuchUserError
+    from authkit.permissions import AuthKitConfigError
+    data = '''
+        James:Password1:Pylons wiki Admin
+        ben:password2 editor admin
+        simon:password3:django
+        ian:password4
+    '''
+    users = UsersFromString(data)
+    compact = CompactUsersFromString(data)
+    for method in ['list_users', 'list_roles', 'list_groups']:
+        assertEqual(getattr(compact, method)(), getattr(users, method)())
+    for username in ['james', 'Ben', 'simon', 'ian']:
+        assertEqual(compact.user(username), users.user(username))
+        assertEqual(compact.user_role_set(username), 
+                    users.user_role_set(username))
+        for role in ['admin', 'Wiki', 'editor', 'missing']:
+            assertEqual(compact.user_has_role(username, role), 
+                        users.user_has_role(username, role))
+        assertEqual(compact.user_has_group(username, 'pylons'), 
+                    users.user_has_group(username, 'pylons'))
+    assertEqual(compact.user_exists('SIMON'), True)
+    for username in ['a', 'jamesx', 'zzz']:
+        assertEqual(compact.user_exists(username), False)
+    usernames = ['James', 'ian', 'nobody']
+    assertEqual(compact.users_bulk(usernames), users.users_bulk(usernames))
+    assertEqual(compact.roles_for_users(usernames), 
+                users.roles_for_users(usernames))
+    for role in ['admin', 'Wiki', 'editor']:
+        assertEqual(compact.users_with_role(role), users.users_with_role(role))
+    for group in ['pylons', 'DJANGO']:
+        assertEqual(compact.users_in_group(group), users.users_in_group(group))
+    try:
+        compact.user_roles('nobody')
+    except AuthKitNoSuchUserError:
+        pass
+    else:
+        raise AssertionError('Expected AuthKitNoSuchUserError')
+    table = compact.index
+    assertEqual(table.group_ids.tolist(), [0, 0, 2, 1])
+    assertEqual(table.role_offsets.tolist(), [0, 2, 2, 4, 4])
+    assertEqual(table.role_ids.tolist(), [0, 1, 0, 2])
+    # The rows of the users with each role and in each group
+    assertEqual(table.role_row_offsets.tolist(), [0, 2, 3, 4])
+    assertEqual(table.role_rows.tolist(), [0, 2, 0, 2])
+    assertEqual(table.group_row_offsets.tolist(), [0, 1, 2])
+    assertEqual(table.group_rows.tolist(), [3, 2])
+    try:
+        parse_table(['james:password1', 'ben:password2', 'James:password3'])
+    except AuthKitConfigError, e:
+        assert str(e).startswith(
+            "Username 'james' on line 3 is already defined"), str(e)
+    else:
+        raise AssertionError('Expected the repeated username to be rejected')
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, data)
+    os.close(fd)
+    try:
+        assertEqual(CompactUsersFromFile(filename).list_users(), 
+                    users.list_users())
+    finally:
+        os.remove(filename)
+
+def test_users_from_mmap():
+    import tempfile, StringIO
+    from authkit.users import UsersFromString, AuthKitNoSuchUserError, \
+        AuthKitError
+    from authkit.users.binary import UsersFromMmap, compile_users, main
+    data = '''
+        James:Password1:Pylons wiki Admin
+        ben:password2 editor admin
+        simon:password3:django
+        ian:password4
+    '''
+    users = UsersFromString(data)
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'users.txt')
+    destination = os.path.join(directory, 'users.db')
+    fp = open(source, 'w')
+    fp.write(data)
+    fp.close()
+    try:
+        assertEqual(compile_users(source, destination), 4)
+        # Nothing is left behind by the temporary file
+        files = os.listdir(directory)
+        files.sort()
+        assertEqual(files, ['users.db', 'users.txt'])
+        mapped = UsersFromMmap(destination)
+        for method in ['list_users', 'list_roles', 'list_groups']:
+            assertEqual(getattr(mapped, method)(), getattr(users, method)())
+        for username in ['james', 'Ben', 'simon', 'ian']:
+            assertEqual(mapped.user(username), users.user(username))
+            assertEqual(mapped.user_has_role(username, 'Admin'), 
+                        users.user_has_role(username, 'admin'))
+        assertEqual(mapped.user_has_password('james', 'Password1'), True)
+        assertEqual(mapped.user_exists(u'simon'), True)
+        for username in ['a', 'jamesx', 'zzz']:
+            assertEqual(mapped.user_exists(username), False)
+        usernames = ['James', 'ian', 'nobody']
+        assertEqual(mapped.users_bulk(usernames), users.users_bulk(usernames))
+        assertEqual(mapped.roles_for_users(usernames), 
+                    users.roles_for_users(usernames))
+        assertEqual(mapped.users_with_role('admin'), ['ben', 'james'])
+        assertEqual(mapped.users_in_group('django'), ['simon'])
+        try:
+            mapped.user_group('nobody')
+        except AuthKitNoSuchUserError:
+            pass
+        else:
+            raise AssertionError('Expected AuthKitNoSuchUserError')
+        # Users can be used from the config like any other users object
+        app = middleware(
+            sample_app,
+            setup_method='basic',
+            basic_realm='test',
+            basic_authenticate_user_type='authkit.users.binary:UsersFromMmap',
+            basic_authenticate_user_data=destination,
+        )
+        res = TestApp(app).get('/private', extra_environ={
+            'HTTP_AUTHORIZATION': 'Basic ' + 'ian:password4'.encode('base64').strip()
+        })
+        assertEqual(res.body.startswith('You Have Access To This Page.'), True)
+        # The text file is the one which is checked for errors
+        fp = open(source, 'w')
+        fp.write('james:password1\nbad')
+        fp.close()
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            assertEqual(main([source, destination]), 1)
+        finally:
+            sys.stderr = stderr
+        assertEqual(mapped.user_exists('ben'), True)
+        try:
+            UsersFromMmap(source)
+        except AuthKitError:
+            pass
+        else:
+            raise AssertionError('Expected a text file to be rejected')
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+def test_cached_users():
+    import time
+    from authkit.users import UsersFromString, CachedUsers, UsersCache, \
+        AuthKitNoSuchUserError
+    class CountingUsers(UsersFromString):
+        def __init__(self, data, encrypt=None):
+            UsersFromString.__init__(self, data, encrypt)
+            self.calls = 0
+        def user_role_set(self, username):
+            self.calls += 1
+            return UsersFromString.user_role_set(self, username)
+        def user_roles(self, username):
+            self.calls += 1
+            return UsersFromString.user_roles(self, username)
+        def user_add_role(self, username, role, add_if_necessary=False):
+            self.roles[username.lower()].append(role.lower())
+            self.build_index()
+        def user_delete(self, username):
+            username = username.lower()
+            self.usernames.remove(username)
+            for data in [self.passwords, self.roles, self.groups]:
+                del data[username]
+            self.build_index()
+    wrapped = CountingUsers('''
+        james:password1:pylons wiki admin
+        ben:password2 editor
+    ''')
+    users = CachedUsers(wrapped, ttl={'user_roles': 0.05})
+    for i in range(3):
+        assertEqual(users.user_has_role('James', 'ADMIN'), True)
+    assertEqual(wrapped.calls, 1)
+    assertEqual(users.stats()['hits'], 2)
+    # Lists are copied so callers can't change the cached results
+    users.user_roles('james').append('changed')
+    assertEqual(users.user_roles('james'), ['admin', 'wiki'])
+    assertEqual(wrapped.calls, 2)
+    time.sleep(0.1)
+    assertEqual(users.user_roles('james'), ['admin', 'wiki'])
+    assertEqual(wrapped.calls, 3)
+    assertEqual(users.stats()['expired'], 1)
+    # Changes through the wrapper invalidate the results they affect
+    assertEqual(users.user_has_role('ben', 'wiki'), False)
+    users.user_add_role('ben', 'wiki')
+    assertEqual(users.user_has_role('ben', 'wiki'), True)
+    assertEqual(users.user_exists('ben'), True)
+    assertEqual(users.list_users(), ['ben', 'james'])
+    users.user_delete('Ben')
+    assertEqual(users.user_exists('ben'), False)
+    assertEqual(users.list_users(), ['james'])
+    try:
+        users.user_role_set('ben')
+    except AuthKitNoSuchUserError:
+        pass
+    else:
+        raise AssertionError('Expected AuthKitNoSuchUserError')
+    assertEqual(users.user_has_group('james', 'Pylons'), True)
+    assertEqual(users.user_has_group('james', None), False)
+    # Passwords are checked by the wrapped object rather than being cached
+    class PasswordUsers(CountingUsers):
+        def user_has_password(self, username, password):
+            self.calls += 1
+            return UsersFromString.user_has_password(self, username, password)
+    wrapped = PasswordUsers('james:password1:pylons wiki admin')
+    users = CachedUsers(wrapped)
+    for password, expected in [('password1', True), ('password2', False), 
+                               ('password1', True)]:
+        assertEqual(users.user_has_password('james', password), expected)
+    assertEqual(wrapped.calls, 3)
+    assertEqual(users.user('james')['roles'], ['admin', 'wiki'])
+    assertEqual(users.stats()['size'], 0)
+
+    cache = UsersCache(2)
+    cache.set('a', 1, 60)
+    cache.set('b', 2, 60)
+    assertEqual(cache.get('a'), 1)
+    cache.set('c', 3, 60)
+    assertEqual(cache.get('b', None), None)
+    assertEqual(cache.get('a'), 1)
+    assertEqual(cache.get('c'), 3)
+    assertEqual(cache.stats()['evictions'], 1)
+    assertEqual(cache.stats()['size'], 2)
+    cache.clear()
+    assertEqual(cache.get('a', None), None)
+
+    # As the users type in the config, which adds it to the environ with
+    # AddUsersObjectToEnviron
+    from authkit.authenticate import AddUsersObjectToEnviron
+    data = 'authkit.users:UsersFromString ttl=30\nian:password4'
+    def app(environ, start_response):
+        users = environ['authkit.users']
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return [str(users.user_exists('Ian'))]
+    app = TestApp(AddUsersObjectToEnviron(
+        app, 
+        'authkit.users', 
+        CachedUsers, 
+        encrypt=None, 
+        data=data,
+    ))
+    for i in range(2):
+        assertEqual(app.get('/').body, 'True')
+    cache = CachedUsers._shared[(data, None)].cache
+    assertEqual(cache.stats()['hits'], 1)
+    assertEqual(cache.stats()['misses'], 1)
+
+def test_username_filter():
+    from authkit.users import UsernameFilter, UsersFromString, CachedUsers, \
+        AuthKitNoSuchUserError
+    usernames = ['user%s' % i for i in range(1000)]
+    filter = UsernameFilter(usernames, 0.01)
+    for username in usernames:
+        assert username in filter, username
+    assert 'USER1' in filter
+    false_positives = len([
+        i for i in range(10000) if 'other%s' % i in filter
+    ])
+    assert false_positives < 300, false_positives
+    assert filter.error_rate() < 0.01, filter.error_rate()
+
+    class CountingUsers(UsersFromString):
+        calls = 0
+        def user_exists(self, username):
+            self.calls += 1
+            return UsersFromString.user_exists(self, username)
+        def user_create(self, username, password, group=None):
+            self.usernames.append(username.lower())
+            self.passwords[username.lower()] = password
+            self.roles[username.lower()] = []
+            self.groups[username.lower()] = group
+            self.build_index()
+    wrapped = CountingUsers('james:password1 admin\nben:password2')
+    users = CachedUsers(wrapped, filter_interval=300)
+    # The filter is built in the background, started by the first use
+    assertEqual(users.state.filter_ready.isSet(), False)
+    users.get_filter()
+    users.state.filter_ready.wait(5)
+    assert users.get_filter() is not None
+    for i in range(100):
+        assertEqual(users.user_exists('nobody%s' % i), False)
+    assert wrapped.calls < 10, wrapped.calls
+    try:
+        users.user_roles('nobody')
+    except AuthKitNoSuchUserError:
+        pass
+    else:
+        raise AssertionError('Expected AuthKitNoSuchUserError')
+    assertEqual(users.user_exists('James'), True)
+    users.user_create('simon', 'password3')
+    assertEqual(users.user_exists('simon'), True)
+    stats = users.stats()
+    assertEqual(stats['filter_users'], 3)
+    # The made up usernames and the user_roles() call
+    assertEqual(stats['filter_rejections'] + stats['filter_false_positives'], 
+                101)
+    # Neither rejected nor missing usernames are cached
+    assertEqual(stats['size'], 2)
+    # So users created without the wrapper are seen straight away
+    assertEqual(users.user_exists('bob'), False)
+    wrapped.user_create('bob', 'password4')
+    users.get_filter().add('bob')
+    assertEqual(users.user_exists('bob'), True)